@@ -0,0 +1,132 @@
+﻿"""
+Учет времени чтения: раскладка сессий по часам, дням, неделям и месяцам
+"""
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
+
+HOUR = timedelta(hours=1)
+
+# Колонка дневной статистики для каждого часа суток
+PERIOD_COLUMNS = ("night_seconds", "morning_seconds", "afternoon_seconds", "evening_seconds")
+
+# Периоды сводной статистики (reading_rollups)
+ROLLUP_PERIODS = ("week", "month")
+# category_id сводной строки по всем категориям пользователя
+ALL_CATEGORIES = 0
+
+
+def period_column(hour: int) -> str:
+    """Часть дня: 0-6 ночь, 6-12 утро, 12-18 день, 18-24 вечер"""
+    return PERIOD_COLUMNS[hour // 6]
+
+
+def period_start(period: str, day: datetime) -> datetime:
+    """Начало недели (понедельник) или месяца, в которые попадает день"""
+    if period == "week":
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+
+def split_by_hour(start: datetime, seconds: float) -> Iterator[Tuple[datetime, float]]:
+    """Разбить интервал [start, start + seconds) по границам часов.
+
+    Отдает (начало часа, секунд в этом часе) за один проход: сессия
+    23:30-01:00 дает 30 минут в 23:00 одного дня и час в 00:00 следующего
+    """
+    end = start + timedelta(seconds=seconds)
+    cursor = start
+    while cursor < end:
+        hour_start = cursor.replace(minute=0, second=0, microsecond=0)
+        boundary = min(hour_start + HOUR, end)
+        yield hour_start, (boundary - cursor).total_seconds()
+        cursor = boundary
+
+
+class ReadingLedger:
+    """Накопитель дневной и почасовой статистики для пачки сессий.
+
+    Сессии добавляются в память, одинаковые (пользователь, день) и
+    (пользователь, день, час) складываются; затем init_db.apply_reading_ledger
+    пишет итог пакетными upsert'ами. Сессия засчитывается (sessions_count
+    и заметки) в день своего начала, а время - в те часы и дни, на которые
+    она пришлась. Дни и часы - местные: время сессии (UTC) сдвигается на
+    смещение часового пояса пользователя.
+
+    Те же дневные приращения складываются в недельные и месячные итоги
+    (rollups): по всем категориям (ALL_CATEGORIES) и по категории сессии
+    """
+
+    def __init__(self):
+        self.daily: Dict[Tuple[int, datetime], Dict[str, float]] = {}
+        self.hourly: Dict[Tuple[int, datetime, int], float] = {}
+        self.rollups: Dict[Tuple[int, int, str, datetime], Dict[str, float]] = {}
+
+    def __len__(self) -> int:
+        return len(self.daily) + len(self.hourly) + len(self.rollups)
+
+    def _day(self, user_id: int, date: datetime) -> Dict[str, float]:
+        row = self.daily.get((user_id, date))
+        if row is None:
+            row = self.daily[(user_id, date)] = {
+                "total_seconds": 0.0, "sessions_count": 0, "notes_count": 0,
+                "night_seconds": 0.0, "morning_seconds": 0.0,
+                "afternoon_seconds": 0.0, "evening_seconds": 0.0,
+            }
+        return row
+
+    def _add_rollups(self, user_id: int, category_id: Optional[int], day: datetime, **values):
+        scopes = (ALL_CATEGORIES, category_id) if category_id else (ALL_CATEGORIES,)
+        for scope in scopes:
+            for period in ROLLUP_PERIODS:
+                key = (user_id, scope, period, period_start(period, day))
+                row = self.rollups.get(key)
+                if row is None:
+                    row = self.rollups[key] = {"total_seconds": 0.0, "sessions_count": 0, "notes_count": 0}
+                for column, value in values.items():
+                    row[column] += value
+
+    def add_session(self, user_id: int, start: datetime, seconds: float, notes_count: int = 0,
+                    utc_offset_minutes: int = 0, category_id: Optional[int] = None):
+        """Учесть сессию, начавшуюся в start (UTC) и длившуюся seconds секунд"""
+        start = start + timedelta(minutes=utc_offset_minutes)
+        first_day = datetime.combine(start.date(), datetime.min.time())
+        first = self._day(user_id, first_day)
+        first["sessions_count"] += 1
+        first["notes_count"] += notes_count
+
+        day_seconds: Dict[datetime, float] = {}
+        for hour_start, part in split_by_hour(start, seconds or 0.0):
+            day = hour_start.replace(hour=0)
+            row = first if day == first_day else self._day(user_id, day)
+            row["total_seconds"] += part
+            row[period_column(hour_start.hour)] += part
+            key = (user_id, day, hour_start.hour)
+            self.hourly[key] = self.hourly.get(key, 0.0) + part
+            day_seconds[day] = day_seconds.get(day, 0.0) + part
+
+        self._add_rollups(user_id, category_id, first_day, sessions_count=1, notes_count=notes_count)
+        for day, part in day_seconds.items():
+            self._add_rollups(user_id, category_id, day, total_seconds=part)
+
+    def daily_rows(self) -> List[dict]:
+        return [
+            {"user_id": user_id, "date": date, **values}
+            for (user_id, date), values in self.daily.items()
+        ]
+
+    def hourly_rows(self) -> List[dict]:
+        return [
+            {"user_id": user_id, "date": date, "hour": hour, "total_seconds": seconds}
+            for (user_id, date, hour), seconds in self.hourly.items()
+        ]
+
+    def rollup_rows(self) -> List[dict]:
+        return [
+            {"user_id": user_id, "category_id": category_id, "period": period, "period_start": start, **values}
+            for (user_id, category_id, period, start), values in self.rollups.items()
+        ]
+
+    def clear(self):
+        self.daily.clear()
+        self.hourly.clear()
+        self.rollups.clear()
@@ -0,0 +1,42 @@
+﻿"""
+Пересчет дневной и почасовой статистики чтения из таблицы reading_sessions.
+
+Старые записи daily_reading_stats складывали всю сессию в день и часть дня
+ее окончания; скрипт раскладывает каждую завершенную сессию по часам заново
+(в часовом поясе пользователя из /timezone).
+Полный пересчет запускать при остановленном боте: сессии, завершенные во
+время пересчета, могут быть учтены дважды. Пересчет одного пользователя
+(--user) идет одной транзакцией, его можно запускать и при работающем боте.
+
+Пример:
+    python backfill_stats.py
+    python backfill_stats.py --user 123456789 --chunk 2000
+"""
+import argparse
+import asyncio
+import time
+
+from init_db import init_db, rebuild_reading_stats
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Пересчет статистики чтения из сессий")
+    parser.add_argument("--user", type=int, default=None, help="пересчитать только этого пользователя")
+    parser.add_argument("--chunk", type=int, default=5000, help="сессий за одну транзакцию")
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+    await init_db()
+
+    started = time.perf_counter()
+    processed = await rebuild_reading_stats(
+        args.user, args.chunk,
+        lambda done: print(f"🔄 Обработано сессий: {done} ({time.perf_counter() - started:.1f} с)")
+    )
+    print(f"✅ Статистика пересчитана: {processed} сессий за {time.perf_counter() - started:.1f} с")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
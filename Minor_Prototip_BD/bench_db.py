@@ -0,0 +1,311 @@
+﻿"""
+Микробенчмарки функций доступа к данным из init_db.
+
+Создает синтетическую БД заданного размера, измеряет операции в секунду
+и перцентили задержки каждой функции и сохраняет результат в JSON, чтобы
+сравнивать коммиты между собой.
+
+Примеры:
+    python bench_db.py --users 200 --notes-per-category 50
+    python bench_db.py --compare bench_results/old.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарки функций init_db")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--categories-per-user", type=int, default=5)
+    parser.add_argument("--notes-per-category", type=int, default=40)
+    parser.add_argument("--sessions-per-user", type=int, default=60)
+    parser.add_argument("--iterations", type=int, default=300, help="вызовов каждой функции")
+    parser.add_argument("--concurrency", type=int, default=32, help="одновременных вызовов в *_concurrent")
+    parser.add_argument("--only", nargs="*", default=None, help="запустить только эти бенчмарки")
+    parser.add_argument("--db", default=None, help="файл БД (по умолчанию временный)")
+    parser.add_argument("--out", default=None, help="куда сохранить JSON (по умолчанию bench_results/)")
+    parser.add_argument("--compare", default=None, help="JSON предыдущего запуска для сравнения")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    if args.iterations < 1 or args.concurrency < 1:
+        parser.error("--iterations и --concurrency должны быть не меньше 1")
+    return args
+
+
+ARGS = parse_args()
+
+_tmp_dir = None
+if ARGS.db is None:
+    _tmp_dir = tempfile.TemporaryDirectory(prefix="notes_bench_")
+    ARGS.db = os.path.join(_tmp_dir.name, "notes.db")
+os.environ["NOTES_DB_PATH"] = ARGS.db
+os.environ["DB_ECHO"] = "0"
+
+from sqlalchemy import insert  # noqa: E402
+
+import init_db  # noqa: E402
+from accounting import ReadingLedger  # noqa: E402
+from init_db import (  # noqa: E402
+    AsyncSessionLocal, Category, DailyReadingStats, HourlyReadingStats, MediaType, Note, ReadingRollup,
+    ReadingSession, complete_reading_session, create_media_note, create_reading_session,
+    create_text_note, get_user_reading_stats, update_category_stats_after_session_start, update_daily_stats
+)
+
+BASE_USER_ID = 1_000_000
+CHUNK = 5000
+
+
+# ===========================================
+# ГЕНЕРАЦИЯ СИНТЕТИЧЕСКОЙ БД
+# ===========================================
+async def seed_database(rng: random.Random) -> Dict[int, List[int]]:
+    """Заполнить БД; вернуть user_id -> список id категорий"""
+    now = datetime.utcnow()
+    categories_by_user: Dict[int, List[int]] = {}
+
+    async with AsyncSessionLocal() as session:
+        category_rows = [
+            {"user_id": BASE_USER_ID + u, "name": f"Книга {u}-{c}", "created_at": now}
+            for u in range(ARGS.users) for c in range(ARGS.categories_per_user)
+        ]
+        await _bulk_insert(session, Category, category_rows)
+        result = await session.execute(Category.__table__.select().with_only_columns(Category.id, Category.user_id))
+        for category_id, user_id in result.all():
+            categories_by_user.setdefault(user_id, []).append(category_id)
+
+        note_rows = []
+        session_rows = []
+        ledger = ReadingLedger()
+        for user_id, category_ids in categories_by_user.items():
+            for category_id in category_ids:
+                for n in range(ARGS.notes_per_category):
+                    note_rows.append({
+                        "user_id": user_id, "category_id": category_id,
+                        "content": f"Синтетическая заметка {n} " + "текст " * rng.randint(5, 60),
+                        "media_type": MediaType.TEXT, "is_deleted": rng.random() < 0.05,
+                        "created_at": now - timedelta(minutes=rng.randint(0, 60 * 24 * 90)),
+                    })
+            for _ in range(ARGS.sessions_per_user):
+                start = now - timedelta(minutes=rng.randint(0, 60 * 24 * 90))
+                duration = rng.uniform(60, 3 * 3600)
+                category_id = rng.choice(category_ids)
+                session_rows.append({
+                    "user_id": user_id, "category_id": category_id,
+                    "start_time": start, "end_time": start + timedelta(seconds=duration),
+                    "duration_seconds": duration, "is_completed": True, "created_at": start,
+                })
+                ledger.add_session(user_id, start, duration, category_id=category_id)
+
+        await _bulk_insert(session, Note, note_rows)
+        await _bulk_insert(session, ReadingSession, session_rows)
+        daily_rows = ledger.daily_rows()
+        await _bulk_insert(session, DailyReadingStats, daily_rows)
+        await _bulk_insert(session, HourlyReadingStats, ledger.hourly_rows())
+        await _bulk_insert(session, ReadingRollup, ledger.rollup_rows())
+        await session.commit()
+
+    print(f"🌱 Сгенерировано: {ARGS.users} пользователей, {len(category_rows)} категорий, "
+          f"{len(note_rows)} заметок, {len(session_rows)} сессий, {len(daily_rows)} дней статистики")
+    return categories_by_user
+
+
+async def _bulk_insert(session, model, rows):
+    for i in range(0, len(rows), CHUNK):
+        await session.execute(insert(model), rows[i:i + CHUNK])
+
+
+# ===========================================
+# ИЗМЕРЕНИЯ
+# ===========================================
+async def measure(name: str, call: Callable[[int], Awaitable], iterations: int,
+                  concurrency: int = 1) -> Dict[str, float]:
+    latencies = []
+    counter = iter(range(iterations))
+
+    async def worker():
+        for i in counter:
+            t0 = time.perf_counter()
+            await call(i)
+            latencies.append(time.perf_counter() - t0)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    total = time.perf_counter() - started
+    latencies.sort()
+    result = {
+        "iterations": iterations,
+        "concurrency": concurrency,
+        "ops_per_sec": iterations / total,
+        "mean_ms": sum(latencies) / iterations * 1000,
+        "p50_ms": _percentile(latencies, 0.50) * 1000,
+        "p95_ms": _percentile(latencies, 0.95) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+    print(f"  {name:<36}{result['ops_per_sec']:>10.1f} оп/с  p50 {result['p50_ms']:>7.2f} мс  "
+          f"p95 {result['p95_ms']:>7.2f} мс")
+    return result
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def build_benchmarks(rng: random.Random, categories_by_user: Dict[int, List[int]]):
+    users = list(categories_by_user)
+    opened_sessions: List[int] = []
+
+    def pick():
+        user_id = rng.choice(users)
+        return user_id, rng.choice(categories_by_user[user_id])
+
+    async def bench_create_reading_session(i):
+        user_id, category_id = pick()
+        reading_session = await create_reading_session(user_id, category_id)
+        opened_sessions.append(reading_session.id)
+
+    async def bench_create_reading_session_refresh(i):
+        # Прежний путь: ORM add + commit + refresh (лишний SELECT после вставки)
+        user_id, category_id = pick()
+        async with AsyncSessionLocal() as session:
+            reading_session = ReadingSession(user_id=user_id, category_id=category_id,
+                                             start_time=datetime.utcnow(), is_completed=False)
+            session.add(reading_session)
+            await session.commit()
+            await session.refresh(reading_session)
+        await update_category_stats_after_session_start(category_id, user_id)
+        opened_sessions.append(reading_session.id)
+
+    async def open_sessions():
+        # Сессии для complete открываются заранее и в замер не входят: с --only
+        # бенчмарки create_reading_session* не запускаются
+        while len(opened_sessions) < ARGS.iterations:
+            user_id, category_id = pick()
+            opened_sessions.append((await create_reading_session(user_id, category_id)).id)
+
+    async def bench_complete_reading_session(i):
+        await complete_reading_session(opened_sessions[i % len(opened_sessions)], rng.uniform(60, 3600), 2, 1)
+
+    async def bench_update_daily_stats(i):
+        await update_daily_stats(rng.choice(users), datetime.utcnow(), rng.uniform(60, 3600))
+
+    async def bench_get_user_reading_stats(i):
+        await get_user_reading_stats(rng.choice(users))
+
+    async def bench_create_text_note(i):
+        user_id, category_id = pick()
+        await create_text_note(user_id, category_id, f"Новая заметка {i}")
+
+    async def bench_create_text_note_refresh(i):
+        # Прежний путь: отдельная транзакция и refresh на каждую заметку
+        user_id, category_id = pick()
+        async with AsyncSessionLocal() as session:
+            note = Note(category_id=category_id, user_id=user_id, content=f"Новая заметка {i}",
+                        media_type=MediaType.TEXT)
+            session.add(note)
+            await session.commit()
+            await session.refresh(note)
+
+    async def bench_create_media_note(i):
+        user_id, category_id = pick()
+        await create_media_note(user_id, category_id, MediaType.PHOTO, f"file-{i}", caption="Страница")
+
+    # Третий элемент - число одновременных вызовов: заметки пишутся пачками,
+    # и выигрыш виден, только когда заметки приходят от многих пользователей сразу.
+    # Четвертый - подготовка перед замером (None - не нужна)
+    return [
+        ("create_reading_session", bench_create_reading_session, 1, None),
+        ("create_reading_session_refresh", bench_create_reading_session_refresh, 1, None),
+        ("complete_reading_session", bench_complete_reading_session, 1, open_sessions),
+        ("update_daily_stats", bench_update_daily_stats, 1, None),
+        ("get_user_reading_stats", bench_get_user_reading_stats, 1, None),
+        ("create_text_note", bench_create_text_note, 1, None),
+        ("create_media_note", bench_create_media_note, 1, None),
+        ("create_text_note_refresh", bench_create_text_note_refresh, 1, None),
+        ("create_text_note_concurrent", bench_create_text_note, ARGS.concurrency, None),
+        ("create_text_note_refresh_concurrent", bench_create_text_note_refresh, ARGS.concurrency, None),
+    ]
+
+
+# ===========================================
+# СОХРАНЕНИЕ И СРАВНЕНИЕ
+# ===========================================
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(previous_path: str, current: Dict[str, Dict[str, float]]):
+    with open(previous_path, encoding="utf-8") as f:
+        previous = json.load(f)
+    print(f"\n📊 Сравнение с {previous_path} ({previous['meta'].get('git_revision')}):")
+    print(f"  {'функция':<36}{'было оп/с':>12}{'стало оп/с':>12}{'изм.':>9}{'p95 было':>11}{'p95 стало':>11}")
+    for name, now in current.items():
+        before = previous["results"].get(name)
+        if not before:
+            continue
+        change = (now["ops_per_sec"] / before["ops_per_sec"] - 1) * 100
+        print(f"  {name:<36}{before['ops_per_sec']:>12.1f}{now['ops_per_sec']:>12.1f}{change:>+8.1f}%"
+              f"{before['p95_ms']:>10.2f}м{now['p95_ms']:>10.2f}м")
+
+
+async def main():
+    rng = random.Random(ARGS.seed)
+    await init_db.init_db()
+    categories_by_user = await seed_database(rng)
+
+    print(f"\n⏱️ Бенчмарки ({ARGS.iterations} вызовов каждой функции):")
+    results = {}
+    for name, call, concurrency, setup in build_benchmarks(rng, categories_by_user):
+        if ARGS.only and name not in ARGS.only:
+            continue
+        if setup is not None:
+            await setup()
+        results[name] = await measure(name, call, ARGS.iterations, concurrency)
+
+    await init_db.note_write_queue.close()
+    await init_db.engine.dispose()
+
+    report = {
+        "meta": {
+            "git_revision": git_revision(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "users": ARGS.users,
+            "categories_per_user": ARGS.categories_per_user,
+            "notes_per_category": ARGS.notes_per_category,
+            "sessions_per_user": ARGS.sessions_per_user,
+            "iterations": ARGS.iterations,
+            "concurrency": ARGS.concurrency,
+        },
+        "results": results,
+    }
+    out = ARGS.out
+    if out is None:
+        os.makedirs("bench_results", exist_ok=True)
+        out = os.path.join("bench_results", f"bench_{datetime.now():%Y%m%d_%H%M%S}_{report['meta']['git_revision']}.json")
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 Результаты сохранены в {out}")
+
+    if ARGS.compare:
+        compare(ARGS.compare, results)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
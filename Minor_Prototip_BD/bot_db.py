@@ -4,7 +4,11 @@ HSEBookNotes Bot - основной файл бота с таймером чте
 """
 
 import asyncio
+import html
 import io
+import os
+import re
+import tempfile
 import time
 import random
 from datetime import datetime, timedelta
@@ -12,27 +16,52 @@ from typing import Dict, Any, Optional
 
 import matplotlib
 import matplotlib.pyplot as plt
+import numpy as np
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ContentType, ParseMode
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import (
     CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup,
-    KeyboardButton, Message, ReplyKeyboardMarkup, BufferedInputFile
+    KeyboardButton, Message, ReplyKeyboardMarkup, BufferedInputFile, FSInputFile,
+    InputMediaDocument, InputMediaPhoto, InputMediaVideo
 )
+from aiogram.dispatcher.event.bases import SkipHandler
 from aiogram.exceptions import TelegramBadRequest
-from sqlalchemy import func, select
+from sqlalchemy import func, select, update
 from aiogram.filters import StateFilter
 
 # Импортируем обновленные модели и функции
 from init_db import (
     Category, Note, MediaType, ReadingSession, DailyReadingStats,
     AsyncSessionLocal, create_reading_session, complete_reading_session,
-    get_user_reading_stats, update_daily_stats
+    get_user_reading_stats, update_daily_stats, engine,
+    create_text_note, create_media_note, create_album_note, append_album_parts, get_note_attachments, get_notes_attachments,
+    note_write_queue, search_notes,
+    SEARCH_PAGE_SIZE, get_user_utc_offset, set_user_utc_offset, has_user_timezone,
+    MIN_UTC_OFFSET_MINUTES, MAX_UTC_OFFSET_MINUTES,
+    user_now, get_reading_rollups
 )
+from category_cache import category_cache
+from exporter import EXPORT_MAX_BYTES, LibraryExporter
+from importer import IMPORT_FORMATS, IMPORT_MAX_BYTES, NoteReader, import_format, import_notes
+from media_archive import MediaArchive
+from media_groups import ALBUM_MAX_ITEMS, media_groups, pack_media_groups
+from maintenance import CATEGORY_DELETE_CHUNK, MaintenanceJob, delete_category_notes
+from category_picker import CategoryPicker, PICKERS, PICKER_MAX_PREFIX, parse_picker_callback
+from metrics import (
+    ApiTimingMiddleware, HandlerMetricsMiddleware, install_db_timing,
+    register_gauges, start_metrics_server
+)
+from outbound import outbound, Priority
+from sql_profiler import SQLProfiler, install_profiler_routes
+from accounting import ALL_CATEGORIES, period_start
+from stats_engine import WEEKDAY_NAMES, load_reading_heatmaps, load_user_series
+from charts import chart_renderer, draw_reading_heatmaps
+from leaderboard import TOP_SIZE, board_key, leaderboard
 
 # ===========================================
 # НАСТРОЙКИ
@@ -40,6 +69,15 @@ from init_db import (
 plt.style.use('seaborn-v0_8-darkgrid')
 matplotlib.use('Agg')
 
+# Локальный эндпоинт метрик Prometheus (None - не запускать)
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9101
+
+# Профилировщик SQL можно включать и выключать на лету:
+# curl -X POST http://127.0.0.1:9101/debug/sql/enable
+# curl http://127.0.0.1:9101/debug/sql
+SQL_PROFILER_ENABLED = False
+
 # ===========================================
 # ОПРЕДЕЛЕНИЕ СОСТОЯНИЙ FSM
 # ===========================================
@@ -63,6 +101,16 @@ class TimerState(StatesGroup):
     waiting_for_timer_category = State()
     timer_running = State()
 
+class SearchState(StatesGroup):
+    waiting_for_query = State()
+
+class CategoryPickerState(StatesGroup):
+    waiting_for_prefix = State()
+
+class ImportState(StatesGroup):
+    waiting_for_document = State()
+    waiting_for_category = State()
+
 # ===========================================
 # ИНИЦИАЛИЗАЦИЯ БОТА
 # ===========================================
@@ -73,11 +121,77 @@ bot = Bot(
 
 dp = Dispatcher(storage=MemoryStorage())
 
+# ===========================================
+# МЕТРИКИ
+# ===========================================
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+bot.session.middleware(ApiTimingMiddleware())
+install_db_timing(engine)
+
+sql_profiler = SQLProfiler(engine)
+if SQL_PROFILER_ENABLED:
+    sql_profiler.enable()
+
+register_gauges(
+    "bot_outbound_queue_depth", "Длина очереди исходящих по приоритетам", ("priority",),
+    lambda: (((name,), s["depth"]) for name, s in outbound.stats().items())
+)
+register_gauges(
+    "bot_note_write_queue", "Очередь отложенной записи заметок", ("stat",),
+    lambda: (((name,), value) for name, value in note_write_queue.stats().items())
+)
+register_gauges(
+    "bot_category_cache", "Кэш списков категорий: попадания, промахи, размер", ("stat",),
+    lambda: (((name,), value) for name, value in category_cache.stats().items())
+)
+register_gauges(
+    "bot_maintenance", "Фоновое обслуживание БД: очищено строк, проходов", ("stat",),
+    lambda: (((name,), value) for name, value in maintenance_job.stats().items())
+)
+register_gauges(
+    "bot_media_groups", "Сборка альбомов: ожидают частей, собрано альбомов и частей, помним сохраненных", ("stat",),
+    lambda: (((name,), value) for name, value in media_groups.stats().items())
+)
+register_gauges(
+    "bot_media_archive", "Локальный архив медиа: скачано, повторы, вытеснено, байт", ("stat",),
+    lambda: (((name,), value) for name, value in media_archive.stats().items())
+)
+register_gauges(
+    "bot_charts", "Графики: в кэше, попадания, промахи, время отрисовки", ("stat",),
+    lambda: (((name,), value) for name, value in chart_renderer.stats().items())
+)
+register_gauges(
+    "bot_leaderboard", "Рейтинги: число рейтингов, участников, обновлений, пересборок", ("stat",),
+    lambda: (((name,), value) for name, value in leaderboard.stats().items())
+)
+register_gauges(
+    "bot_outbound_latency_p95_seconds", "p95 задержки исходящих от постановки в очередь до отправки", ("priority",),
+    lambda: (((name,), s["latency_p95"]) for name, s in outbound.stats().items())
+)
+
 # ===========================================
 # ГЛОБАЛЬНОЕ ХРАНИЛИЩЕ АКТИВНЫХ ТАЙМЕРОВ
 # ===========================================
 active_timers: Dict[int, Dict[str, Any]] = {}
 
+# Фоновые задачи (удаление больших категорий): держим ссылки, пока они идут
+background_tasks = set()
+
+# Как часто обновлять сообщение с прогрессом удаления, секунд
+DELETE_PROGRESS_INTERVAL = 2.0
+
+# Пользователи, для которых сейчас собирается экспорт (не больше одного на человека)
+exports_running = set()
+
+# Очистка удаленных заметок и брошенных сессий; сессии запущенных таймеров не трогает
+maintenance_job = MaintenanceJob(
+    active_sessions=lambda: [timer["session_id"] for timer in active_timers.values()]
+)
+
+# Локальная копия медиа заметок (включается переменной MEDIA_ARCHIVE_DIR)
+media_archive = MediaArchive(bot)
+
 # ===========================================
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
 # ===========================================
@@ -99,18 +213,107 @@ def format_time_short(seconds: int) -> str:
         minutes = (seconds % 3600) // 60
         return f"{hours}ч {minutes:02d}м"
 
+def format_utc_offset(offset_minutes: int) -> str:
+    """Смещение часового пояса: UTC+3, UTC-3:30"""
+    sign = "+" if offset_minutes >= 0 else "-"
+    hours, minutes = divmod(abs(offset_minutes), 60)
+    return f"UTC{sign}{hours}" + (f":{minutes:02d}" if minutes else "")
+
+async def reply_interactive(message: Message, text: str, **kwargs) -> Message:
+    """Быстрый ответ пользователю через приоритетную очередь исходящих"""
+    return await outbound.send(Priority.INTERACTIVE, message.chat.id, message.answer, text, **kwargs)
+
+async def answer_html_or_plain(message: Message, html_text: str, plain_text: str, reply_markup=None) -> Message:
+    """Отправить HTML, а если Telegram не принял разметку - простой текст"""
+    try:
+        return await message.answer(html_text, reply_markup=reply_markup, parse_mode='HTML')
+    except TelegramBadRequest:
+        return await message.answer(plain_text, reply_markup=reply_markup)
+
+# Типы частей, из которых Telegram собирает альбом (голосовые в альбом не входят)
+ALBUM_INPUT_MEDIA = {
+    MediaType.PHOTO: InputMediaPhoto,
+    MediaType.VIDEO: InputMediaVideo,
+    MediaType.DOCUMENT: InputMediaDocument
+}
+
+MEDIA_EMOJI = {
+    MediaType.TEXT: "📝",
+    MediaType.PHOTO: "📸",
+    MediaType.VIDEO: "🎥",
+    MediaType.VOICE: "🎤",
+    MediaType.DOCUMENT: "📄"
+}
+
+# ===========================================
+# КЛАВИАТУРЫ
+# ===========================================
+# Клавиатуры только отправляются и не изменяются, поэтому один объект
+# можно переиспользовать для всех пользователей
+MAIN_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="📚 Категории"), KeyboardButton(text="📝 Заметки")],
+        [KeyboardButton(text="➕ Новая категория"), KeyboardButton(text="📸 Медиа")],
+        [KeyboardButton(text="⏱️ Таймер чтения"), KeyboardButton(text="📊 Статистика")],
+        [KeyboardButton(text="ℹ️ О нас")]
+    ],
+    resize_keyboard=True,
+    input_field_placeholder="Выбери действие..."
+)
+
 def get_main_keyboard():
     """Основная клавиатура"""
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="📚 Категории"), KeyboardButton(text="📝 Заметки")],
-            [KeyboardButton(text="➕ Новая категория"), KeyboardButton(text="📸 Медиа")],
-            [KeyboardButton(text="⏱️ Таймер чтения"), KeyboardButton(text="📊 Статистика")],
-            [KeyboardButton(text="ℹ️ О нас")]
-        ],
-        resize_keyboard=True,
-        input_field_placeholder="Выбери действие..."
-    )
+    return MAIN_KEYBOARD
+
+# Списки категорий показываются постранично через CategoryPicker: страница
+# берется из category_cache и строится один раз на версию набора категорий.
+# Для пустого списка keyboard() возвращает None - обработчик предлагает
+# создать категорию
+TIMER_PICKER = CategoryPicker(
+    "timer", "Выберите категорию (книгу) для таймера:",
+    lambda cat: [InlineKeyboardButton(text=f"📖 {cat.name}", callback_data=f"timer_cat_{cat.id}")],
+    footer=[
+        [InlineKeyboardButton(text="⏱️ Без категории", callback_data="timer_no_category")],
+        [InlineKeyboardButton(text="❌ Отмена", callback_data="timer_cancel")]
+    ]
+)
+
+MANAGE_PICKER = CategoryPicker(
+    "manage", "Выбери категорию (✏️-переименовать, 🗑️-удалить):",
+    lambda cat: [
+        InlineKeyboardButton(text=cat.name, callback_data=f"cat_{cat.id}"),
+        InlineKeyboardButton(text="✏️", callback_data=f"renamecat_{cat.id}"),
+        InlineKeyboardButton(text="🗑️", callback_data=f"deletecat_{cat.id}")
+    ],
+    footer=[[InlineKeyboardButton(text="+ Создать новую категорию", callback_data="cat_new")]]
+)
+
+NOTES_PICKER = CategoryPicker(
+    "notes", "Выбери категорию для просмотра заметок:",
+    lambda cat: [InlineKeyboardButton(text=cat.name, callback_data=f"showcat_{cat.id}")],
+    footer=[[InlineKeyboardButton(text="Сменить категорию", callback_data="change_category")]]
+)
+
+BACK_PICKER = CategoryPicker(
+    "back", "Выбери категорию:",
+    lambda cat: [InlineKeyboardButton(text=cat.name, callback_data=f"showcat_{cat.id}")],
+    footer=[[InlineKeyboardButton(text="+ Создать новую категорию", callback_data="cat_new")]]
+)
+
+IMPORT_PICKER = CategoryPicker(
+    "import", "В какую категорию импортировать заметки?",
+    lambda cat: [InlineKeyboardButton(text=cat.name, callback_data=f"import_cat_{cat.id}")],
+    footer=[
+        [InlineKeyboardButton(text="➕ Новая категория", callback_data="import_new")],
+        [InlineKeyboardButton(text="❌ Отмена", callback_data="import_cancel")]
+    ]
+)
+
+MEDIA_PICKER = CategoryPicker(
+    "media", "Выберите категорию для медиа-заметки:",
+    lambda cat: [InlineKeyboardButton(text=cat.name, callback_data=f"media_cat_{cat.id}")],
+    footer=[[InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_media")]]
+)
 
 # ===========================================
 # ФУНКЦИЯ СОЗДАНИЯ ГРАФИКОВ
@@ -186,44 +389,42 @@ def create_reading_stats_chart(notes_by_date: dict, time_by_date: dict):
 # ===========================================
 # ФУНКЦИИ ДЛЯ РАБОТЫ С ЗАМЕТКАМИ
 # ===========================================
-async def create_text_note(user_id: int, category_id: int, text: str, session_id: int = None) -> Note:
-    """Создание текстовой заметки"""
-    async with AsyncSessionLocal() as session:
-        new_note = Note(
-            category_id=category_id,
-            user_id=user_id,
-            content=text,
-            media_type=MediaType.TEXT,
-            reading_session_id=session_id
-        )
-        session.add(new_note)
-        await session.commit()
-        await session.refresh(new_note)
-        return new_note
-
-async def create_media_note(user_id: int, category_id: int, media_type: MediaType, 
-                           file_id: str, caption: str = "", content: str = "", session_id: int = None) -> Note:
-    """Создание медиа-заметки"""
-    async with AsyncSessionLocal() as session:
-        new_note = Note(
-            category_id=category_id,
-            user_id=user_id,
-            content=content or caption or f"{media_type.value.capitalize()} заметка",
-            media_type=media_type,
-            media_file_id=file_id,
-            media_caption=caption,
-            reading_session_id=session_id
-        )
-        session.add(new_note)
-        await session.commit()
-        await session.refresh(new_note)
-        return new_note
+def message_media(message: Message):
+    """(тип, file_id) медиа из сообщения; None, если такого медиа бот не хранит"""
+    if message.photo:
+        return MediaType.PHOTO, message.photo[-1].file_id
+    if message.video:
+        return MediaType.VIDEO, message.video.file_id
+    if message.voice:
+        return MediaType.VOICE, message.voice.file_id
+    if message.document:
+        return MediaType.DOCUMENT, message.document.file_id
+    return None
+
+def album_caption(album) -> str:
+    """Подпись альбома: Telegram хранит ее у одной из частей (обычно первой)"""
+    return next((part.caption for part in album if part.caption), "")
+
+def media_kind(data: dict) -> str:
+    """Тип медиа-заметки из состояния для подтверждения"""
+    items = data.get("media_items")
+    if items:
+        return f"Альбом ({len(items)} шт.)"
+    return data.get("media_type").value.capitalize()
 
 async def save_media_note(data: dict, user_id: int, category_id: int):
     """Сохранение медиа-заметки с данными из состояния"""
     media_type = data.get("media_type")
     file_id = data.get("media_file_id")
     caption = data.get("media_caption", "")
+    items = data.get("media_items")
+    
+    if items:
+        note = await create_album_note(user_id, category_id, items, caption=caption)
+        media_groups.finish(user_id, data.get("media_group_id"), note.id, len(items))
+        for _, item_file_id in items:
+            media_archive.submit(item_file_id)
+        return note
     
     note = await create_media_note(
         user_id=user_id,
@@ -233,6 +434,7 @@ async def save_media_note(data: dict, user_id: int, category_id: int):
         caption=caption,
         content=caption or f"{media_type.value.capitalize()} заметка"
     )
+    media_archive.submit(file_id)
     return note
 
 async def update_timer(user_id: int, stop_event: asyncio.Event):
@@ -248,7 +450,8 @@ async def update_timer(user_id: int, stop_event: asyncio.Event):
         try:
             elapsed = int(time.time() - start_time)
             time_str = f"⏱️ {format_time(elapsed)}"
-            await bot.edit_message_text(
+            await outbound.send(
+                Priority.TIMER, user_id, bot.edit_message_text,
                 chat_id=user_id,
                 message_id=message_id,
                 text=time_str
@@ -285,6 +488,10 @@ async def stop_and_report(user_id: int) -> int:
         notes_count = timer_data.get("notes_count", 0)
         media_notes_count = timer_data.get("media_notes_count", 0)
         await complete_reading_session(session_id, elapsed_time, notes_count, media_notes_count)
+        try:
+            await leaderboard.refresh_user(user_id)
+        except Exception as e:
+            print(f"⚠️ Ошибка обновления рейтинга: {e}")
     
     try:
         await bot.delete_message(
@@ -316,7 +523,13 @@ async def cmd_start(message: Message):
         "/category – выбрать категорию\n"
         "/notes – посмотреть заметки\n"
         "/addmedia – добавить медиа\n"
-        "/stats – статистика чтения\n"
+        "/search – поиск по заметкам\n"
+        "/stats – статистика чтения (/stats week|month|year – за период)\n"
+        "/heatmap – тепловая карта: дни и часы чтения\n"
+        "/top – рейтинг читателей и ваше место\n"
+        "/timezone – часовой пояс для статистики\n"
+        "/export – выгрузить все заметки в ZIP\n"
+        "/import – загрузить заметки из файла\n"
         "/about – информация о проекте\n\n"
         "ℹ️ Нажми «О нас» чтобы узнать больше!"
     )
@@ -341,13 +554,9 @@ async def start_timer_command(message: Message, state: FSMContext, user_id: int
         )
         return
     
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(Category).where(Category.user_id == user_id)
-        )
-        categories = result.scalars().all()
+    keyboard = await TIMER_PICKER.keyboard(user_id)
     
-    if not categories:
+    if keyboard is None:
         await message.answer(
             "📚 <b>Сначала создайте категорию!</b>\n\n"
             "Таймер будет привязан к конкретной книге/категории.\n"
@@ -356,14 +565,6 @@ async def start_timer_command(message: Message, state: FSMContext, user_id: int
         )
         return
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=f"📖 {cat.name}", callback_data=f"timer_cat_{cat.id}")]
-        for cat in categories
-    ] + [
-        [InlineKeyboardButton(text="⏱️ Без категории", callback_data="timer_no_category")],
-        [InlineKeyboardButton(text="❌ Отмена", callback_data="timer_cancel")]
-    ])
-    
     await message.answer(
         "⏱️ <b>Запуск таймера чтения</b>\n\n"
         "Выберите категорию (книгу) для таймера:\n"
@@ -373,7 +574,7 @@ async def start_timer_command(message: Message, state: FSMContext, user_id: int
     )
     await state.set_state(TimerState.waiting_for_timer_category)
 
-@dp.callback_query(TimerState.waiting_for_timer_category)
+@dp.callback_query(TimerState.waiting_for_timer_category, F.data.startswith("timer_"))
 async def select_timer_category(query: CallbackQuery, state: FSMContext):
     """Выбор категории для таймера"""
     try:
@@ -387,14 +588,13 @@ async def select_timer_category(query: CallbackQuery, state: FSMContext):
             return
         else:
             category_id = int(query.data.split("_")[2])
-            async with AsyncSessionLocal() as session:
-                result = await session.execute(
-                    select(Category).where(Category.id == category_id)
-                )
-                category = result.scalar_one_or_none()
-                category_name = category.name if category else "Неизвестно"
+            category = await category_cache.get_category(query.from_user.id, category_id)
+            category_name = category.name if category else "Неизвестно"
         
         reading_session = await create_reading_session(query.from_user.id, category_id)
+        if category_id:
+            # Категория поднимается в начало списков выбора
+            category_cache.invalidate(query.from_user.id)
         await start_timer_function(query, category_id, category_name, reading_session.id)
         await state.set_state(TimerState.timer_running)
     except Exception as e:
@@ -436,7 +636,7 @@ async def start_timer_function(query: CallbackQuery, category_id: int, category_
         f"✅ <b>Таймер запущен!</b>\n\n"
         f"📖 <b>Книга:</b> {category_name}\n"
         f"⏱️ <b>Таймер:</b> Отслеживается в сообщении выше ⬆️\n"
-        f"🕐 <b>Старт:</b> {datetime.now().strftime('%H:%M')}\n\n"
+        f"🕐 <b>Старт:</b> {user_now(await get_user_utc_offset(user_id)).strftime('%H:%M')}\n\n"
         f"<i>Читайте с удовольствием! 📚</i>\n"
         f"<i>Для удобства советуем запинить данное сообщение!</i>\n"
         f"<i>Во время чтения можно делать заметки</i>",
@@ -628,7 +828,8 @@ async def handle_media_from_timer(message: Message, state: FSMContext):
             content=caption or "Фото заметка из чтения",
             session_id=timer_data.get("session_id")
         )
-        await message.answer(
+        await reply_interactive(
+            message,
             f"📸 <b>Фото-заметка сохранена во время чтения!</b>\n\n"
             f"📖 Книга: <b>{category_name}</b>\n"
             f"⏱️ Таймер: <b>Продолжает работать</b>",
@@ -645,7 +846,8 @@ async def handle_media_from_timer(message: Message, state: FSMContext):
             content=caption or "Видео заметка из чтения",
             session_id=timer_data.get("session_id")
         )
-        await message.answer(
+        await reply_interactive(
+            message,
             f"🎥 <b>Видео-заметка сохранена во время чтения!</b>\n\n"
             f"📖 Книга: <b>{category_name}</b>\n"
             f"⏱️ Таймер: <b>Продолжает работать</b>",
@@ -662,7 +864,8 @@ async def handle_media_from_timer(message: Message, state: FSMContext):
             content=caption or "Голосовая заметка из чтения",
             session_id=timer_data.get("session_id")
         )
-        await message.answer(
+        await reply_interactive(
+            message,
             f"🎤 <b>Голосовая заметка сохранена во время чтения!</b>\n\n"
             f"📖 Книга: <b>{category_name}</b>\n"
             f"⏱️ Таймер: <b>Продолжает работать</b>",
@@ -680,22 +883,154 @@ async def handle_media_from_timer(message: Message, state: FSMContext):
             content=caption or f"Документ из чтения: {file_name}",
             session_id=timer_data.get("session_id")
         )
-        await message.answer(
+        await reply_interactive(
+            message,
             f"📄 <b>Документ-заметка сохранена во время чтения!</b>\n\n"
             f"📖 Книга: <b>{category_name}</b>\n"
             f"⏱️ Таймер: <b>Продолжает работать</b>",
             parse_mode='HTML'
         )
     
+    media = message_media(message)
+    if media:
+        media_archive.submit(media[1])
+    
     # Очищаем состояние после добавления медиа (чтобы не оставаться в режиме ожидания)
     await state.clear()
 
+ALBUM_UNSUPPORTED_TEXT = (
+    "❌ В альбоме нет файлов, которые можно сохранить.\n\n"
+    "Отправьте фото, видео, голосовое сообщение или документ."
+)
+
+async def handle_album_from_timer(album, state: FSMContext):
+    """Альбом во время чтения: одна заметка и одно подтверждение на весь альбом"""
+    message = album[0]
+    user_id = message.from_user.id
+    
+    if user_id not in active_timers:
+        await message.answer("❌ Таймер больше не активен")
+        await state.clear()
+        return
+    
+    items = [media for media in map(message_media, album) if media]
+    if not items:
+        await message.answer(ALBUM_UNSUPPORTED_TEXT)
+        return
+    
+    timer_data = active_timers[user_id]
+    caption = album_caption(album)
+    timer_data["media_notes_count"] = timer_data.get("media_notes_count", 0) + 1
+    
+    note = await create_album_note(
+        user_id,
+        timer_data["category_id"],
+        items,
+        caption=caption,
+        content=caption or "Альбом из чтения",
+        session_id=timer_data.get("session_id")
+    )
+    # Состояние сейчас очистится - опоздавшие части найдут заметку по media_group_id
+    media_groups.finish(message.chat.id, message.media_group_id, note.id, len(items))
+    for _, file_id in items:
+        media_archive.submit(file_id)
+    await reply_interactive(
+        message,
+        f"🖼️ <b>Альбом сохранен во время чтения!</b>\n\n"
+        f"📖 Книга: <b>{timer_data['category_name']}</b>\n"
+        f"🗂️ Файлов: <b>{len(items)}</b>\n"
+        f"⏱️ Таймер: <b>Продолжает работать</b>",
+        parse_mode='HTML'
+    )
+    await state.clear()
+
+async def handle_album_input(album, state: FSMContext):
+    """Альбом целиком: запоминаем все части и спрашиваем одну подпись"""
+    message = album[0]
+    data = await state.get_data()
+    
+    if not data.get("current_category"):
+        await message.answer(
+            "❌ Сначала выберите категорию!\n\n"
+            "Нажмите «📚 Категории» или используйте /category"
+        )
+        await state.clear()
+        return
+    
+    items = [media for media in map(message_media, album) if media]
+    if not items:
+        await message.answer(ALBUM_UNSUPPORTED_TEXT)
+        return
+    
+    caption = album_caption(album)
+    first_type, first_file_id = items[0]
+    await state.update_data(
+        media_type=first_type,
+        media_file_id=first_file_id,
+        media_caption=caption,
+        media_items=items,
+        media_group_id=message.media_group_id
+    )
+    await state.set_state(AddMediaNoteState.waiting_for_caption)
+    if caption:
+        await message.answer(
+            f"🖼️ <b>Альбом получен: {len(items)} шт.</b>\n\n"
+            f"Текущая подпись: <i>{caption}</i>\n\n"
+            "Хотите изменить подпись?\n"
+            "Отправьте новый текст или напишите 'пропустить' чтобы оставить как есть.",
+            parse_mode='HTML'
+        )
+    else:
+        await message.answer(
+            f"🖼️ <b>Альбом получен: {len(items)} шт.</b>\n\n"
+            "Хотите добавить подпись к альбому?\n"
+            "Отправьте текст подписи или напишите 'пропустить' для сохранения без подписи.",
+            parse_mode='HTML'
+        )
+
+def is_late_album_part(message: Message) -> bool:
+    """Фильтр: часть альбома, который уже сохранен заметкой"""
+    return media_groups.finished(message) is not None
+
+@dp.message(is_late_album_part)
+async def handle_late_album_part(message: Message):
+    """Часть, опоздавшая к уже сохраненному альбому: дописываем ее в ту же заметку"""
+    album = await media_groups.collect(message)
+    if album is None:
+        return
+    finished = media_groups.finished(message)
+    if finished is None:
+        return
+    note_id, count = finished
+    items = [media for media in map(message_media, album) if media]
+    items = items[:max(ALBUM_MAX_ITEMS - count, 0)]
+    if not items:
+        return
+    
+    # Счетчик обновляем до записи: следующая опоздавшая часть не превысит лимит
+    finished[1] = count + len(items)
+    finished[1] = await append_album_parts(note_id, items)
+    for _, file_id in items:
+        media_archive.submit(file_id)
+    await message.answer(f"🖼️ Добавлено к альбому: {len(items)} шт. (всего {finished[1]})")
+
 @dp.message(AddMediaNoteState.waiting_for_media)
 async def handle_media_input(message: Message, state: FSMContext):
     """Обработка входящего медиа или текста"""
     data = await state.get_data()
     from_timer = data.get("from_timer", False)
     
+    if message.media_group_id:
+        album = await media_groups.collect(message)
+        # Остальные части альбома забирает обработчик первой части
+        if album is None:
+            return
+        if from_timer:
+            await handle_album_from_timer(album, state)
+        else:
+            await handle_album_input(album, state)
+        return
+    
     if from_timer:
         await handle_media_from_timer(message, state)
         return
@@ -718,7 +1053,8 @@ async def handle_media_input(message: Message, state: FSMContext):
         await state.update_data(
             media_type=MediaType.PHOTO,
             media_file_id=file_id,
-            media_caption=caption
+            media_caption=caption,
+            media_items=None
         )
         await state.set_state(AddMediaNoteState.waiting_for_caption)
         if caption:
@@ -741,7 +1077,8 @@ async def handle_media_input(message: Message, state: FSMContext):
         await state.update_data(
             media_type=MediaType.VIDEO,
             media_file_id=file_id,
-            media_caption=caption
+            media_caption=caption,
+            media_items=None
         )
         await state.set_state(AddMediaNoteState.waiting_for_caption)
         if caption:
@@ -764,7 +1101,8 @@ async def handle_media_input(message: Message, state: FSMContext):
         await state.update_data(
             media_type=MediaType.VOICE,
             media_file_id=file_id,
-            media_caption=caption
+            media_caption=caption,
+            media_items=None
         )
         await state.set_state(AddMediaNoteState.waiting_for_caption)
         if caption:
@@ -789,7 +1127,8 @@ async def handle_media_input(message: Message, state: FSMContext):
             media_type=MediaType.DOCUMENT,
             media_file_id=file_id,
             media_caption=caption,
-            document_name=file_name
+            document_name=file_name,
+            media_items=None
         )
         await state.set_state(AddMediaNoteState.waiting_for_caption)
         if caption:
@@ -813,7 +1152,7 @@ async def handle_media_input(message: Message, state: FSMContext):
             await message.answer("❌ Добавление медиа отменено")
             return
         await create_text_note(user_id, category_id, message.text)
-        await message.answer("✅ Текстовая заметка сохранена!")
+        await reply_interactive(message, "✅ Текстовая заметка сохранена!")
         await state.clear()
 
 @dp.message(AddMediaNoteState.waiting_for_caption)
@@ -823,14 +1162,25 @@ async def handle_media_caption(message: Message, state: FSMContext):
     user_id = message.from_user.id
     category_id = data.get("current_category")
     
-    if message.text and message.text.lower() in ['/skip', 'пропустить', 'skip', 'нет']:
+    if not message.text:
+        # Часть альбома, опоздавшая больше чем на ALBUM_WAIT, приходит уже
+        # сюда - добавляем ее к альбому, а не принимаем за подпись
+        media = message_media(message)
+        items = data.get("media_items")
+        if (media and items and message.media_group_id
+                and message.media_group_id == data.get("media_group_id")):
+            if len(items) < ALBUM_MAX_ITEMS:
+                await state.update_data(media_items=items + [media])
+            return
+        await message.answer(
+            "✏️ Отправьте текст подписи или напишите 'пропустить' для сохранения без подписи."
+        )
+        return
+    
+    if message.text.lower() in ['/skip', 'пропустить', 'skip', 'нет']:
         if category_id:
             note = await save_media_note(data, user_id, category_id)
-            async with AsyncSessionLocal() as session:
-                result = await session.execute(
-                    select(Category).where(Category.id == category_id)
-                )
-                category = result.scalar_one_or_none()
+            category = await category_cache.get_category(user_id, category_id)
             
             media_emoji = {
                 MediaType.PHOTO: "📸",
@@ -839,10 +1189,11 @@ async def handle_media_caption(message: Message, state: FSMContext):
                 MediaType.DOCUMENT: "📄"
             }.get(data.get("media_type"), "📎")
             
-            await message.answer(
+            await reply_interactive(
+                message,
                 f"{media_emoji} <b>Медиа-заметка сохранена!</b>\n\n"
                 f"📁 Категория: <b>{category.name if category else 'Неизвестно'}</b>\n"
-                f"📌 Тип: <b>{data.get('media_type').value.capitalize()}</b>",
+                f"📌 Тип: <b>{media_kind(data)}</b>",
                 parse_mode='HTML'
             )
         await state.clear()
@@ -854,11 +1205,7 @@ async def handle_media_caption(message: Message, state: FSMContext):
     
     if category_id:
         note = await save_media_note(data, user_id, category_id)
-        async with AsyncSessionLocal() as session:
-            result = await session.execute(
-                select(Category).where(Category.id == category_id)
-            )
-            category = result.scalar_one_or_none()
+        category = await category_cache.get_category(user_id, category_id)
         
         media_emoji = {
             MediaType.PHOTO: "📸",
@@ -867,10 +1214,11 @@ async def handle_media_caption(message: Message, state: FSMContext):
             MediaType.DOCUMENT: "📄"
         }.get(data.get("media_type"), "📎")
         
-        await message.answer(
+        await reply_interactive(
+            message,
             f"{media_emoji} <b>Медиа-заметка сохранена!</b>\n\n"
             f"📁 Категория: <b>{category.name if category else 'Неизвестно'}</b>\n"
-            f"📌 Тип: <b>{data.get('media_type').value.capitalize()}</b>\n"
+            f"📌 Тип: <b>{media_kind(data)}</b>\n"
             f"📝 Подпись: {message.text}",
             parse_mode='HTML'
         )
@@ -881,34 +1229,20 @@ async def handle_media_caption(message: Message, state: FSMContext):
 # ===========================================
 FORBIDDEN_NAMES = ["📚 Категории", "📝 Заметки", "➕ Новая категория", "📊 Статистика", 
                    "📸 Медиа", "⏱️ Таймер чтения", "ℹ️ О нас", "/start", "/stats", 
-                   "/category", "/notes", "/timer", "/about", "/addmedia"]
+                   "/category", "/notes", "/timer", "/about", "/addmedia", "/search", "/timezone", "/export", "/import",
+                   "/heatmap", "/top"]
 
 @dp.message(Command("category"))
 async def choose_category(message: Message, state: FSMContext):
     """Показать список категорий"""
     user_id = message.from_user.id
 
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(Category).where(Category.user_id == user_id)
-        )
-        categories = result.scalars().all()
+    keyboard = await MANAGE_PICKER.keyboard(user_id)
 
-    if not categories:
+    if keyboard is None:
         await message.answer("Категорий ещё нет. Введите название новой категории:")
         await state.set_state(CategoryState.waiting_for_category_name)
         return
-
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text=cat.name, callback_data=f"cat_{cat.id}"),
-            InlineKeyboardButton(text="✏️", callback_data=f"renamecat_{cat.id}"),
-            InlineKeyboardButton(text="🗑️", callback_data=f"deletecat_{cat.id}")
-        ]
-        for cat in categories
-    ] + [
-        [InlineKeyboardButton(text="+ Создать новую категорию", callback_data="cat_new")]
-    ])
     
     await message.answer("Выбери категорию (✏️-переименовать, 🗑️-удалить):", reply_markup=keyboard)
 
@@ -951,16 +1285,9 @@ async def save_new_category(message: Message, state: FSMContext):
         return
 
     # Проверка на дубликат
-    async with AsyncSessionLocal() as session:
-        existing = await session.execute(
-            select(Category).where(
-                Category.user_id == user_id,
-                Category.name == name
-            )
-        )
-        if existing.scalar_one_or_none():
-            await message.answer(f"❌ Категория с названием «{name}» уже существует. Придумайте другое название:")
-            return
+    if any(cat.name == name for cat in await category_cache.get(user_id)):
+        await message.answer(f"❌ Категория с названием «{name}» уже существует. Придумайте другое название:")
+        return
 
     # Создаём категорию
     new_cat = Category(user_id=user_id, name=name)
@@ -968,7 +1295,7 @@ async def save_new_category(message: Message, state: FSMContext):
     async with AsyncSessionLocal() as session:
         session.add(new_cat)
         await session.commit()
-        await session.refresh(new_cat)
+    category_cache.invalidate(user_id)
 
     await state.update_data(current_category=new_cat.id)
     await state.set_state(None)
@@ -992,11 +1319,7 @@ async def select_category(query: CallbackQuery, state: FSMContext):
     
     await state.update_data(current_category=cat_id)
 
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(Category).where(Category.id == cat_id)
-        )
-        category = result.scalar_one_or_none()
+    category = await category_cache.get_category(query.from_user.id, cat_id)
 
     if category:
         await query.message.answer(f"✅ Выбрана категория: <b>{category.name}</b>\nТеперь можно писать заметки!")
@@ -1032,7 +1355,8 @@ async def save_note(message: Message, state: FSMContext):
         return
     
     if text.startswith('/'):
-        return
+        # Команды (/stats, /notes, /about...) зарегистрированы ниже - передаем им
+        raise SkipHandler()
 
     # Если пользователь в режиме таймера и пишет заметку
     user_id = message.from_user.id
@@ -1045,7 +1369,8 @@ async def save_note(message: Message, state: FSMContext):
             await create_text_note(user_id, category_id, text, session_id)
             timer_data["notes_count"] = timer_data.get("notes_count", 0) + 1
             
-            await message.answer(
+            await reply_interactive(
+                message,
                 f"✅ <b>Заметка сохранена во время чтения!</b>\n\n"
                 f"📖 Книга: <b>{timer_data.get('category_name', 'Неизвестно')}</b>\n"
                 f"⏱️ Таймер: <b>Продолжает работать</b>\n\n"
@@ -1066,7 +1391,8 @@ async def save_note(message: Message, state: FSMContext):
         return
     
     await create_text_note(user_id, category_id, text)
-    await message.answer(
+    await reply_interactive(
+        message,
         "✅ <b>Текстовая заметка сохранена!</b>\n\n"
         f"<blockquote>{text[:100]}...</blockquote>",
         parse_mode='HTML'
@@ -1079,22 +1405,11 @@ async def save_note(message: Message, state: FSMContext):
 async def cmd_notes(message: Message):
     user_id = message.from_user.id
 
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(Category).where(Category.user_id == user_id)
-        )
-        categories = result.scalars().all()
+    kb = await NOTES_PICKER.keyboard(user_id)
 
-    if not categories:
+    if kb is None:
         await message.answer("Категорий пока нет. Создай → /category")
         return
-
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=cat.name, callback_data=f"showcat_{cat.id}")]
-        for cat in categories
-    ] + [
-        [InlineKeyboardButton(text="Сменить категорию", callback_data="change_category")]
-    ])
     
     await message.answer("Выбери категорию для просмотра заметок:", reply_markup=kb)
 
@@ -1111,6 +1426,12 @@ async def show_category_notes(query: CallbackQuery):
         await query.answer("❌ Ошибка")
         return
 
+    category = await category_cache.get_category(query.from_user.id, category_id)
+    if not category:
+        await query.message.answer("❌ Категория не найдена")
+        await query.answer()
+        return
+
     async with AsyncSessionLocal() as session:
         result = await session.execute(
             select(Note).where(
@@ -1120,18 +1441,9 @@ async def show_category_notes(query: CallbackQuery):
         )
         notes = result.scalars().all()
 
-        cat_result = await session.execute(
-            select(Category).where(Category.id == category_id)
-        )
-        category = cat_result.scalar_one_or_none()
-    
-    if not category:
-        await query.message.answer("❌ Категория не найдена")
-        await query.answer()
-        return
-
     nav_keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="← Вернуться к категориям", callback_data="back_cats")],
+        [InlineKeyboardButton(text="🖼️ Все медиа", callback_data=f"allmedia_{category_id}")],
         [
             InlineKeyboardButton(text="✏️ Переименовать", callback_data=f"renamecat_{category_id}"),
             InlineKeyboardButton(text="🗑️ Удалить", callback_data=f"deletecat_{category_id}"),
@@ -1167,13 +1479,7 @@ async def show_category_notes(query: CallbackQuery):
         return
 
     for i, note in enumerate(notes, 1):
-        media_emoji = {
-            MediaType.TEXT: "📝",
-            MediaType.PHOTO: "📸",
-            MediaType.VIDEO: "🎥",
-            MediaType.VOICE: "🎤",
-            MediaType.DOCUMENT: "📄"
-        }.get(note.media_type, "📎")
+        media_emoji = MEDIA_EMOJI.get(note.media_type, "📎")
         
         created_time = note.created_at.strftime('%d.%m.%Y %H:%M') if note.created_at else "без даты"
         
@@ -1200,15 +1506,19 @@ async def show_category_notes(query: CallbackQuery):
                 f"🕒 <i>{created_time}</i>"
             )
             
-            try:
-                await query.message.answer(formatted_note, reply_markup=kb, parse_mode='HTML')
-            except Exception:
-                await query.message.answer(
-                    f"Заметка #{i}\n\n{note_content}\n\n🕒 {created_time}",
-                    reply_markup=kb
-                )
+            # Массовый вывод идет с низким приоритетом и не задерживает
+            # ответы другим пользователям; enqueue ждет только места в очереди
+            await outbound.enqueue(
+                Priority.BULK, query.message.chat.id, answer_html_or_plain,
+                query.message, formatted_note,
+                f"Заметка #{i}\n\n{note_content}\n\n🕒 {created_time}",
+                reply_markup=kb
+            )
         else:
-            media_info = f"{media_emoji} <b>Медиа-заметка #{i}</b>\n"
+            if note.attachments_count:
+                media_info = f"🖼️ <b>Альбом #{i}</b> · {note.attachments_count} шт.\n"
+            else:
+                media_info = f"{media_emoji} <b>Медиа-заметка #{i}</b>\n"
             
             if note.media_caption:
                 media_info += f"📝 <i>{note.media_caption}</i>\n\n"
@@ -1217,10 +1527,198 @@ async def show_category_notes(query: CallbackQuery):
             
             media_info += f"🕒 <i>{created_time}</i>"
             
-            await query.message.answer(media_info, reply_markup=kb, parse_mode='HTML')
+            await outbound.enqueue(
+                Priority.BULK, query.message.chat.id, query.message.answer,
+                media_info, reply_markup=kb, parse_mode='HTML'
+            )
     
     await query.answer()
 
+# ===========================================
+# ПОИСК ПО ЗАМЕТКАМ
+# ===========================================
+def build_search_page(query: str, page: int, found: dict):
+    """Текст и клавиатура страницы результатов поиска"""
+    results = found["results"]
+    header = f"🔎 <b>Поиск:</b> «{html.escape(query)}»"
+    if page > 0 or found["has_more"]:
+        header += f" · стр. {page + 1}"
+
+    if not results:
+        text = header + "\n\nНичего не найдено 🤷\nПопробуй другое слово или начало слова."
+        return text, None
+
+    lines = [header, ""]
+    view_buttons = []
+    for number, hit in enumerate(results, page * SEARCH_PAGE_SIZE + 1):
+        created = hit["created_at"].strftime('%d.%m.%Y') if hit["created_at"] else "без даты"
+        lines.append(
+            f"{number}. {MEDIA_EMOJI.get(hit['media_type'], '📎')} "
+            f"<b>{html.escape(hit['category_name'])}</b> · <i>{created}</i>\n"
+            f"{hit['snippet']}\n"
+        )
+        if hit["media_type"] != MediaType.TEXT:
+            view_buttons.append(InlineKeyboardButton(text=f"👁️ {number}", callback_data=f"view_{hit['id']}"))
+
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="◀️ Назад", callback_data=f"search_p_{page - 1}"))
+    if found["has_more"]:
+        nav.append(InlineKeyboardButton(text="Дальше ▶️", callback_data=f"search_p_{page + 1}"))
+    rows = [row for row in (view_buttons, nav) if row]
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=rows) if rows else None
+
+async def run_search(message: Message, state: FSMContext, user_id: int, query: str):
+    """Выполнить поиск и отправить первую страницу"""
+    try:
+        found = await search_notes(user_id, query)
+    except Exception as e:
+        print(f"⚠️ Ошибка поиска: {e}")
+        await message.answer("⚠️ Поиск сейчас недоступен, попробуй позже.")
+        return
+    # Запрос храним в FSM: в callback_data он может не поместиться
+    await state.update_data(search_query=query)
+    text, keyboard = build_search_page(query, 0, found)
+    await reply_interactive(message, text, reply_markup=keyboard, parse_mode='HTML')
+
+@dp.message(Command("search"))
+async def cmd_search(message: Message, state: FSMContext, command: CommandObject):
+    """Поиск по заметкам: /search слово или /search и запрос следующим сообщением"""
+    query = (command.args or "").strip()
+    if query:
+        await run_search(message, state, message.from_user.id, query)
+        return
+
+    # Запоминаем состояние (например, запущенный таймер), чтобы вернуть его после поиска
+    await state.update_data(search_return_state=await state.get_state())
+    await state.set_state(SearchState.waiting_for_query)
+    await message.answer(
+        "🔎 Что ищем? Напиши слово или начало слова\n"
+        "<i>Например: «рефлекс» найдет и «рефлексия», и «рефлексировать»</i>"
+    )
+
+@dp.message(SearchState.waiting_for_query, F.text)
+async def handle_search_query(message: Message, state: FSMContext):
+    """Запрос для поиска, введенный после /search"""
+    data = await state.get_data()
+    await state.set_state(data.get("search_return_state"))
+    if message.text.startswith('/'):
+        raise SkipHandler()
+    await run_search(message, state, message.from_user.id, message.text.strip())
+
+@dp.callback_query(F.data.startswith("search_p_"))
+async def search_page_callback(query: CallbackQuery, state: FSMContext):
+    """Переключение страниц результатов поиска"""
+    try:
+        page = max(0, int(query.data.split("_")[2]))
+    except (IndexError, ValueError):
+        await query.answer("❌ Ошибка")
+        return
+
+    search_query = (await state.get_data()).get("search_query")
+    if not search_query:
+        await query.answer("Поиск устарел, повтори /search", show_alert=True)
+        return
+
+    try:
+        found = await search_notes(query.from_user.id, search_query, page)
+    except Exception as e:
+        print(f"⚠️ Ошибка поиска: {e}")
+        await query.answer("⚠️ Поиск сейчас недоступен")
+        return
+
+    text, keyboard = build_search_page(search_query, page, found)
+    try:
+        await query.message.edit_text(text, reply_markup=keyboard, parse_mode='HTML')
+    except TelegramBadRequest:
+        pass
+    await query.answer()
+
+# ===========================================
+# ВЫБОР КАТЕГОРИИ: СТРАНИЦЫ И ФИЛЬТР
+# ===========================================
+async def show_picker_page(query: CallbackQuery, picker: CategoryPicker, page: int, prefix: Optional[str]):
+    """Заменить клавиатуру выбора в том же сообщении"""
+    keyboard = await picker.keyboard(query.from_user.id, page, prefix)
+    if keyboard is None:
+        await query.answer("Категорий пока нет. Создай → /category", show_alert=True)
+        return
+    try:
+        await query.message.edit_reply_markup(reply_markup=keyboard)
+    except TelegramBadRequest:
+        pass
+    await query.answer()
+
+@dp.callback_query(F.data.startswith("pick_") | F.data.startswith("pickq_"))
+async def picker_page_callback(query: CallbackQuery, state: FSMContext):
+    """Листание списка категорий"""
+    parsed = parse_picker_callback(query.data)
+    if parsed is None:
+        await query.answer("❌ Ошибка")
+        return
+    picker, page = parsed
+
+    prefix = None
+    if query.data.startswith("pickq_"):
+        prefix = (await state.get_data()).get("picker_prefixes", {}).get(picker.kind)
+    await show_picker_page(query, picker, page, prefix)
+
+@dp.callback_query(F.data.startswith("pickf_"))
+async def picker_filter_callback(query: CallbackQuery, state: FSMContext):
+    """Запросить начало названия категории"""
+    kind = query.data.split("_", 1)[1]
+    if kind not in PICKERS:
+        await query.answer("❌ Ошибка")
+        return
+
+    # Возвращаем исходное состояние (например, выбор категории для таймера) после ввода
+    await state.update_data(picker_filter_kind=kind, picker_return_state=await state.get_state())
+    await state.set_state(CategoryPickerState.waiting_for_prefix)
+    await query.message.answer("🔎 Напиши начало названия категории:")
+    await query.answer()
+
+@dp.message(CategoryPickerState.waiting_for_prefix, F.text)
+async def handle_picker_prefix(message: Message, state: FSMContext):
+    """Показать категории, названия которых начинаются с введенного текста"""
+    data = await state.get_data()
+    await state.set_state(data.get("picker_return_state"))
+    if message.text.startswith('/'):
+        raise SkipHandler()
+
+    picker = PICKERS.get(data.get("picker_filter_kind"))
+    prefix = message.text.strip()[:PICKER_MAX_PREFIX]
+    if picker is None or not prefix:
+        await message.answer("❌ Пустой запрос, фильтр не применен")
+        return
+
+    prefixes = dict(data.get("picker_prefixes", {}))
+    prefixes[picker.kind] = prefix
+    await state.update_data(picker_prefixes=prefixes)
+
+    keyboard = await picker.keyboard(message.from_user.id, 0, prefix)
+    if keyboard is None:
+        await message.answer("Категорий пока нет. Создай → /category")
+        return
+    await message.answer(picker.title, reply_markup=keyboard)
+
+@dp.callback_query(F.data.startswith("pickc_"))
+async def picker_clear_callback(query: CallbackQuery, state: FSMContext):
+    """Сбросить фильтр и вернуться к полному списку"""
+    picker = PICKERS.get(query.data.split("_", 1)[1])
+    if picker is None:
+        await query.answer("❌ Ошибка")
+        return
+
+    prefixes = dict((await state.get_data()).get("picker_prefixes", {}))
+    prefixes.pop(picker.kind, None)
+    await state.update_data(picker_prefixes=prefixes)
+    await show_picker_page(query, picker, 0, None)
+
+@dp.callback_query(F.data == "picker_noop")
+async def picker_noop_callback(query: CallbackQuery):
+    """Номер страницы и пустой результат - не кнопки"""
+    await query.answer()
+
 # ===========================================
 # МЕДИА-ЗАМЕТКИ
 # ===========================================
@@ -1235,11 +1733,7 @@ async def add_media_to_category(query: CallbackQuery, state: FSMContext):
     
     await state.update_data(current_category=category_id)
     
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(Category).where(Category.id == category_id)
-        )
-        category = result.scalar_one_or_none()
+    category = await category_cache.get_category(query.from_user.id, category_id)
     
     await query.message.answer(
         f"📸 <b>Добавление медиа в категорию: {category.name if category else 'Неизвестно'}</b>\n\n"
@@ -1260,23 +1754,12 @@ async def start_media_note(message: Message, state: FSMContext):
     if not category_id:
         await message.answer("📁 Сначала выберите категорию для медиа-заметки:")
         
-        async with AsyncSessionLocal() as session:
-            result = await session.execute(
-                select(Category).where(Category.user_id == message.from_user.id)
-            )
-            categories = result.scalars().all()
+        keyboard = await MEDIA_PICKER.keyboard(message.from_user.id)
         
-        if not categories:
+        if keyboard is None:
             await message.answer("❌ У вас нет категорий. Создайте сначала категорию.")
             return
         
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text=cat.name, callback_data=f"media_cat_{cat.id}")]
-            for cat in categories
-        ] + [
-            [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_media")]
-        ])
-        
         await message.answer("Выберите категорию для медиа-заметки:", reply_markup=keyboard)
         return
     
@@ -1300,11 +1783,7 @@ async def select_category_for_media(query: CallbackQuery, state: FSMContext):
     
     await state.update_data(current_category=category_id)
     
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(Category).where(Category.id == category_id)
-        )
-        category = result.scalar_one_or_none()
+    category = await category_cache.get_category(query.from_user.id, category_id)
     
     await query.message.edit_text(
         f"✅ Выбрана категория: <b>{category.name if category else 'Неизвестно'}</b>\n\n"
@@ -1340,19 +1819,29 @@ async def view_media_note(query: CallbackQuery):
         if not note or not note.media_file_id:
             await query.answer("❌ Заметка не найдена или не содержит медиа")
             return
-        
-        cat_result = await session.execute(
-            select(Category).where(Category.id == note.category_id)
-        )
-        category = cat_result.scalar_one_or_none()
+    
+    category = await category_cache.get_category(query.from_user.id, note.category_id)
     
     caption = f"📁 {category.name if category else 'Категория'}\n"
     if note.media_caption:
         caption += f"📝 {note.media_caption}\n"
     caption += f"🕒 {note.created_at.strftime('%d.%m.%Y %H:%M')}"
     
+    attachments = await get_note_attachments(note.id) if note.attachments_count else []
+    
     try:
-        if note.media_type == MediaType.PHOTO:
+        if len(attachments) > 1:
+            # Альбом возвращается альбомом; подпись - у первой части, как в Telegram
+            await bot.send_media_group(
+                chat_id=query.from_user.id,
+                media=[
+                    ALBUM_INPUT_MEDIA[media_type](
+                        media=file_id, caption=caption if position == 0 else None
+                    )
+                    for position, (media_type, file_id) in enumerate(attachments)
+                ]
+            )
+        elif note.media_type == MediaType.PHOTO:
             await bot.send_photo(
                 chat_id=query.from_user.id,
                 photo=note.media_file_id,
@@ -1385,24 +1874,158 @@ async def view_media_note(query: CallbackQuery):
     
     await query.answer()
 
+# ===========================================
+# ВСЕ МЕДИА КАТЕГОРИИ
+# ===========================================
+# Медиа-заметок за одно нажатие «Все медиа»; части альбома считаются вместе с заметкой
+ALL_MEDIA_PAGE_SIZE = 30
+
+# Подпись к части альбома в Telegram не длиннее этого
+MEDIA_CAPTION_LIMIT = 1024
+
+# Отправка одиночного медиа: метод бота и имя его аргумента
+SINGLE_MEDIA_SENDERS = {
+    MediaType.PHOTO: (bot.send_photo, "photo"),
+    MediaType.VIDEO: (bot.send_video, "video"),
+    MediaType.VOICE: (bot.send_voice, "voice"),
+    MediaType.DOCUMENT: (bot.send_document, "document")
+}
+
+def media_caption_html(caption: Optional[str]) -> Optional[str]:
+    """Подпись медиа для parse_mode='HTML': экранирована и вместе с сущностями
+    укладывается в MEDIA_CAPTION_LIMIT - иначе Telegram отклонит весь альбом"""
+    if not caption:
+        return None
+    escaped = html.escape(caption)
+    if len(escaped) <= MEDIA_CAPTION_LIMIT:
+        return escaped
+    # Обрезаем по целым символам, чтобы не разрезать &amp; и подобные
+    pieces = []
+    length = 0
+    for char in caption:
+        piece = html.escape(char)
+        if length + len(piece) > MEDIA_CAPTION_LIMIT:
+            break
+        pieces.append(piece)
+        length += len(piece)
+    return "".join(pieces)
+
+async def send_media_items(chat_id: int, items) -> list:
+    """Поставить медиа (тип, file_id, подпись) в очередь альбомами до 10 штук.
+
+    Возвращает futures отправок - по одному на альбом или одиночное медиа
+    """
+    futures = []
+    for group in pack_media_groups(items):
+        if len(group) == 1:
+            media_type, file_id, caption = group[0]
+            method, field = SINGLE_MEDIA_SENDERS[media_type]
+            futures.append(await outbound.enqueue(
+                Priority.BULK, chat_id, method, chat_id=chat_id, caption=caption, **{field: file_id}
+            ))
+        else:
+            futures.append(await outbound.enqueue(
+                Priority.BULK, chat_id, bot.send_media_group, chat_id=chat_id,
+                media=[ALBUM_INPUT_MEDIA[media_type](media=file_id, caption=caption)
+                       for media_type, file_id, caption in group]
+            ))
+    return futures
+
+@dp.callback_query(F.data.startswith("allmedia_"))
+async def show_all_media(query: CallbackQuery):
+    """Все медиа категории альбомами: allmedia_<категория>[_<после id заметки>]"""
+    try:
+        parts = query.data.split("_")
+        category_id = int(parts[1])
+        after_id = int(parts[2]) if len(parts) > 2 else 0
+    except (IndexError, ValueError):
+        await query.answer("❌ Ошибка")
+        return
+    
+    category = await category_cache.get_category(query.from_user.id, category_id)
+    if not category:
+        await query.answer("❌ Категория не найдена")
+        return
+    
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(Note.id, Note.media_type, Note.media_file_id, Note.media_caption, Note.attachments_count)
+            .where(
+                (Note.category_id == category_id) &
+                (Note.is_deleted == False) &
+                (Note.media_file_id.is_not(None)) &
+                (Note.id > after_id)
+            )
+            .order_by(Note.id)
+            .limit(ALL_MEDIA_PAGE_SIZE + 1)
+        )
+        notes = result.all()
+    
+    if not notes:
+        await query.answer("В категории нет медиа" if not after_id else "Больше медиа нет")
+        return
+    
+    has_more = len(notes) > ALL_MEDIA_PAGE_SIZE
+    notes = notes[:ALL_MEDIA_PAGE_SIZE]
+    attachments = await get_notes_attachments([n.id for n in notes if n.attachments_count])
+    
+    items = []
+    for note in notes:
+        caption = media_caption_html(note.media_caption)
+        for position, (media_type, file_id) in enumerate(
+                attachments.get(note.id) or [(note.media_type, note.media_file_id)]):
+            items.append((media_type, file_id, caption if position == 0 else None))
+    
+    chat_id = query.message.chat.id
+    await query.answer(f"Отправляю медиа: {len(items)} шт.")
+    futures = await send_media_items(chat_id, items)
+    # Ошибку отправки очередь только логирует - дожидаемся отправок и говорим о ней
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    failed = sum(1 for result in results if isinstance(result, Exception))
+    if failed:
+        await outbound.enqueue(
+            Priority.BULK, chat_id, query.message.answer,
+            f"⚠️ Не удалось отправить часть медиа: {failed} из {len(futures)} отправок"
+        )
+    
+    if has_more:
+        await outbound.enqueue(
+            Priority.BULK, chat_id, query.message.answer,
+            f"🖼️ <b>{html.escape(category.name)}</b>: отправлено медиа - {len(items)} шт. В категории есть еще.",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
+                InlineKeyboardButton(text="▶️ Показать еще",
+                                     callback_data=f"allmedia_{category_id}_{notes[-1].id}")
+            ]]),
+            parse_mode='HTML'
+        )
+
 # ===========================================
 # СТАТИСТИКА (ПОЛНАЯ ВЕРСИЯ)
 # ===========================================
 @dp.message(Command("stats"))
 @dp.message(F.text == "📊 Статистика")
-async def show_statistics(message: Message):
+async def show_statistics(message: Message, command: CommandObject = None):
     """Показать статистику чтения (2 графика + достижения в столбец)"""
     user_id = message.from_user.id
     
+    # /stats week|month|year - итоги за период из сводных таблиц
+    if command is not None and command.args:
+        period = STATS_PERIODS.get(command.args.strip().lower())
+        if period is None:
+            await message.answer("📊 Использование: /stats, /stats week, /stats month или /stats year")
+        else:
+            await show_period_statistics(message, period)
+        return
+    
     loading_msg = await message.answer("📊 Собираю статистику...")
     
+    # Дни считаются по часовому поясу пользователя
+    utc_offset = await get_user_utc_offset(user_id)
+    
     async with AsyncSessionLocal() as session:
         try:
             # ОСНОВНЫЕ ПОКАЗАТЕЛИ
-            cat_result = await session.execute(
-                select(func.count(Category.id)).where(Category.user_id == user_id)
-            )
-            categories_count = cat_result.scalar() or 0
+            categories_count = len(await category_cache.get(user_id))
             
             notes_result = await session.execute(
                 select(func.count(Note.id)).where(
@@ -1440,65 +2063,19 @@ async def show_statistics(message: Message):
             )
             notes_by_category = dict(cat_stats.all())
             
-            # АКТИВНОСТЬ ПО ДНЯМ
-            thirty_days_ago = datetime.utcnow() - timedelta(days=30)
+            # АКТИВНОСТЬ ПО ДНЯМ И СТРЕЙК: ряды по дням загружаются один раз,
+            # показатели считаются по массивам (stats_engine)
+            series = await load_user_series(user_id, utc_offset)
+            summary = series.summary(30)
+            notes_by_date = series.by_date("notes", 30)
+            time_by_date = series.by_date("seconds", 30)
             
-            daily_notes = await session.execute(
-                select(func.date(Note.created_at), func.count(Note.id))
-                .where(
-                    Note.user_id == user_id,
-                    Note.created_at >= thirty_days_ago,
-                    Note.is_deleted == False
-                )
-                .group_by(func.date(Note.created_at))
-                .order_by(func.date(Note.created_at))
-            )
-            
-            notes_by_date = {}
-            total_days_with_notes = 0
-            max_notes_in_day = 0
-            most_active_day = "—"
-            
-            for date_str, count in daily_notes.all():
-                if date_str:
-                    try:
-                        date_obj = datetime.strptime(str(date_str), '%Y-%m-%d')
-                        formatted_date = date_obj.strftime('%d.%m')
-                        notes_by_date[formatted_date] = count
-                        total_days_with_notes += 1
-                        if count > max_notes_in_day:
-                            max_notes_in_day = count
-                            most_active_day = formatted_date
-                    except:
-                        continue
-            
-            daily_time = await session.execute(
-                select(func.date(ReadingSession.start_time), func.sum(ReadingSession.duration_seconds))
-                .where(
-                    ReadingSession.user_id == user_id,
-                    ReadingSession.start_time >= thirty_days_ago,
-                    ReadingSession.is_completed == True
-                )
-                .group_by(func.date(ReadingSession.start_time))
-            )
-            
-            time_by_date = {}
-            total_reading_days = 0
-            max_time_in_day = 0
-            most_reading_day = "—"
-            
-            for date_str, seconds in daily_time.all():
-                if date_str and seconds:
-                    try:
-                        date_obj = datetime.strptime(str(date_str), '%Y-%m-%d')
-                        formatted_date = date_obj.strftime('%d.%m')
-                        time_by_date[formatted_date] = seconds
-                        total_reading_days += 1
-                        if seconds > max_time_in_day:
-                            max_time_in_day = seconds
-                            most_reading_day = formatted_date
-                    except:
-                        continue
+            total_days_with_notes = summary["notes_days"]
+            max_notes_in_day = summary["max_notes"]
+            most_active_day = summary["max_notes_day"].strftime('%d.%m') if summary["max_notes_day"] else "—"
+            total_reading_days = summary["reading_days"]
+            max_time_in_day = summary["max_seconds"]
+            most_reading_day = summary["max_seconds_day"].strftime('%d.%m') if summary["max_seconds_day"] else "—"
             
             # СРЕДНИЕ ПОКАЗАТЕЛИ
             avg_notes_per_day = notes_count / 30 if notes_count > 0 else 0
@@ -1506,26 +2083,8 @@ async def show_statistics(message: Message):
             avg_time_per_day = total_time / 30 if total_time > 0 else 0
             avg_time_per_reading_day = total_time / total_reading_days if total_reading_days > 0 else 0
             
-            # СТРЕЙК
-            today = datetime.utcnow().date()
-            streak = 0
-            check_date = today
-            
-            while True:
-                day_activity = await session.execute(
-                    select(Note.id)
-                    .where(
-                        Note.user_id == user_id,
-                        func.date(Note.created_at) == check_date.strftime('%Y-%m-%d'),
-                        Note.is_deleted == False
-                    )
-                    .limit(1)
-                )
-                if day_activity.first():
-                    streak += 1
-                    check_date -= timedelta(days=1)
-                else:
-                    break
+            streak = summary["current_streak"]
+            best_streak = summary["best_streak"]
             
             # ПОСЛЕДНИЕ ЗАМЕТКИ
             recent_notes_result = await session.execute(
@@ -1544,12 +2103,15 @@ async def show_statistics(message: Message):
             await message.answer(f"❌ Ошибка загрузки статистики: {e}")
             return
     
-    # ОТПРАВКА ГРАФИКОВ
+    # ОТПРАВКА ГРАФИКОВ (рисуются в отдельном потоке, повтор без изменений - из кэша)
     try:
-        chart_buf = create_reading_stats_chart(notes_by_date, time_by_date)
-        if chart_buf:
-            await message.answer_photo(
-                BufferedInputFile(chart_buf.getvalue(), filename="stats.png"),
+        chart_png = await chart_renderer.render(
+            "stats", user_id, create_reading_stats_chart, notes_by_date, time_by_date
+        )
+        if chart_png:
+            await outbound.send(
+                Priority.UPLOAD, message.chat.id, message.answer_photo,
+                BufferedInputFile(chart_png, filename="stats.png"),
                 caption="📈 Активность чтения за 30 дней"
             )
     except Exception as e:
@@ -1684,7 +2246,10 @@ async def show_statistics(message: Message):
     text = f"📊 <b>СТАТИСТИКА ЧТЕНИЯ</b>\n"
     text += f"{'─' * 40}\n\n"
     
-    text += f"{fire}  <b>{streak_text}</b>\n"
+    text += f"{fire}  <b>{streak_text}</b>"
+    if best_streak > streak:
+        text += f"  (рекорд: {best_streak})"
+    text += "\n"
     text += f"{level_title}  •  Уровень {level}\n"
     text += f"{level_bar}  {exp_current}/5 XP\n"
     text += f"✨ Всего опыта: {notes_count} XP\n\n"
@@ -1724,7 +2289,7 @@ async def show_statistics(message: Message):
     if recent_notes:
         text += f"🕐 <b>ПОСЛЕДНИЕ ЗАМЕТКИ:</b>\n"
         for content, date in recent_notes[:3]:
-            date_str = date.strftime('%d.%m')
+            date_str = (date + timedelta(minutes=utc_offset)).strftime('%d.%m')
             short_content = content[:25] + "..." if len(content) > 25 else content
             text += f"  • {date_str}: {short_content}\n"
         text += "\n"
@@ -1766,9 +2331,595 @@ async def show_statistics(message: Message):
         tip = random.choice(tips)
     
     text += f"💡 <b>СОВЕТ ДНЯ:</b>\n  {tip}"
+    text += f"\n\n📅 <i>Итоги за период: /stats week, /stats month, /stats year. Тепловая карта: /heatmap</i>"
+    
+    if not await has_user_timezone(user_id):
+        text += f"\n\n🌍 <i>Дни считаются по {format_utc_offset(utc_offset)}. Свой часовой пояс: /timezone</i>"
     
     await message.answer(text, parse_mode='HTML')
 
+# ===========================================
+# ТЕПЛОВАЯ КАРТА ЧТЕНИЯ (/heatmap)
+# ===========================================
+@dp.message(Command("heatmap"))
+async def cmd_heatmap(message: Message):
+    """Календарь дней чтения за год и карта «день недели x час» одной картинкой"""
+    user_id = message.from_user.id
+    utc_offset = await get_user_utc_offset(user_id)
+    heatmaps = await load_reading_heatmaps(user_id, utc_offset)
+    if not heatmaps.total_seconds:
+        await message.answer(
+            "🗓️ За последний год нет данных о времени чтения.\n"
+            "Запустите таймер (/timer) - время попадет на тепловую карту."
+        )
+        return
+    
+    png = await chart_renderer.render(
+        "heatmap", user_id, draw_reading_heatmaps, heatmaps.first_day, heatmaps.daily, heatmaps.hourly
+    )
+    if png is None:
+        await message.answer("❌ Не удалось построить тепловую карту, попробуйте позже")
+        return
+    
+    reading_days = int(np.count_nonzero(heatmaps.daily))
+    caption = (f"🗓️ Чтение за год: {reading_days} дн., всего "
+               f"{format_time_short(int(heatmaps.total_seconds))}")
+    peak = heatmaps.peak()
+    if peak is not None:
+        caption += f"\n⏰ Чаще всего вы читаете: {WEEKDAY_NAMES[peak[0]]}, {peak[1]:02d}:00"
+    await outbound.send(
+        Priority.UPLOAD, message.chat.id, message.answer_photo,
+        BufferedInputFile(png, filename="heatmap.png"), caption=caption
+    )
+
+# ===========================================
+# РЕЙТИНГ ЧИТАТЕЛЕЙ (/top)
+# ===========================================
+TOP_PERIOD_TITLES = {"week": "НЕДЕЛЮ", "month": "МЕСЯЦ"}
+TOP_MEDALS = {1: "🥇", 2: "🥈", 3: "🥉"}
+
+async def build_top_view(user_id: int, period: str, category_id: int = 0):
+    """Текст и кнопки рейтинга: общего или по книге (категории с таким же названием)"""
+    category = await category_cache.get_category(user_id, category_id) if category_id else None
+    board = await leaderboard.board(period, board_key(category.name) if category else "")
+    
+    title = f"🏆 <b>РЕЙТИНГ ЗА {TOP_PERIOD_TITLES[period]}</b>"
+    if category:
+        title += f"\n📚 Книга: {html.escape(category.name)}"
+    text = f"{title}\n{'─' * 40}\n\n"
+    
+    top = board.top(TOP_SIZE)
+    if not top:
+        text += "📭 В этом периоде еще никто не читал с таймером. Будьте первым: /timer\n"
+    for other_id, seconds in top:
+        place = board.rank(other_id)
+        medal = TOP_MEDALS.get(place, f"{place}.")
+        # Других участников не называем - в рейтинге только время
+        who = "👉 <b>Вы</b>" if other_id == user_id else "Читатель"
+        text += f"{medal} {who} — {format_time_short(int(seconds))}\n"
+    
+    place = board.rank(user_id)
+    if place is not None:
+        text += f"\n📍 Ваше место: <b>{place}</b> из {len(board)} • {format_time_short(int(board.score(user_id)))}"
+    elif top:
+        text += "\n📍 Вас пока нет в рейтинге - запустите таймер: /timer"
+    
+    period_buttons = [
+        InlineKeyboardButton(
+            text=("• " if value == period else "") + label,
+            callback_data=f"top_{value}_{category_id}"
+        )
+        for value, label in (("week", "Неделя"), ("month", "Месяц"))
+    ]
+    keyboard = [period_buttons]
+    if category:
+        keyboard.append([InlineKeyboardButton(text="🌍 Общий рейтинг", callback_data=f"top_{period}_0")])
+    return text, InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+async def top_book_button(user_id: int, category_id: int, period: str) -> list:
+    """Кнопка рейтинга по текущей книге (если она выбрана)"""
+    category = await category_cache.get_category(user_id, category_id) if category_id else None
+    if not category:
+        return []
+    name = category.name if len(category.name) <= 30 else category.name[:27] + "..."
+    return [InlineKeyboardButton(text=f"📚 По книге «{name}»", callback_data=f"top_{period}_{category.id}")]
+
+@dp.message(Command("top"))
+async def cmd_top(message: Message, state: FSMContext):
+    """Рейтинг читателей за неделю и ваше место"""
+    user_id = message.from_user.id
+    text, keyboard = await build_top_view(user_id, "week")
+    book_button = await top_book_button(user_id, (await state.get_data()).get("current_category"), "week")
+    if book_button:
+        keyboard.inline_keyboard.append(book_button)
+    await message.answer(text, reply_markup=keyboard, parse_mode='HTML')
+
+@dp.callback_query(F.data.startswith("top_"))
+async def top_callback(query: CallbackQuery, state: FSMContext):
+    """Переключение рейтинга: top_<week|month>_<категория или 0>"""
+    try:
+        _, period, category_id = query.data.split("_")
+        category_id = int(category_id)
+    except ValueError:
+        await query.answer("❌ Ошибка")
+        return
+    if period not in TOP_PERIOD_TITLES:
+        await query.answer("❌ Ошибка")
+        return
+    
+    user_id = query.from_user.id
+    text, keyboard = await build_top_view(user_id, period, category_id)
+    if not category_id:
+        book_button = await top_book_button(user_id, (await state.get_data()).get("current_category"), period)
+        if book_button:
+            keyboard.inline_keyboard.append(book_button)
+    try:
+        await query.message.edit_text(text, reply_markup=keyboard, parse_mode='HTML')
+    except TelegramBadRequest:
+        pass
+    await query.answer()
+
+# ===========================================
+# СТАТИСТИКА ЗА ПЕРИОД (/stats week|month|year)
+# ===========================================
+# Аргумент /stats -> период; год собирается из 12 месячных итогов
+STATS_PERIODS = {
+    "week": "week", "неделя": "week",
+    "month": "month", "месяц": "month",
+    "year": "year", "год": "year",
+}
+MONTH_NAMES = ("Январь", "Февраль", "Март", "Апрель", "Май", "Июнь",
+               "Июль", "Август", "Сентябрь", "Октябрь", "Ноябрь", "Декабрь")
+# Категорий в итогах за период
+PERIOD_TOP_CATEGORIES = 5
+
+def format_change(current: float, previous: float) -> str:
+    """Изменение к прошлому периоду в процентах"""
+    if not previous:
+        return "впервые" if current else "—"
+    change = (current - previous) / previous * 100
+    return f"{change:+.0f}%"
+
+def format_period_categories(totals: dict, total_seconds: float) -> str:
+    """Блок «по категориям»: {название: секунды} -> строки с полосками"""
+    if not totals or not total_seconds:
+        return ""
+    text = f"📚 <b>ПО КАТЕГОРИЯМ:</b>\n"
+    top = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:PERIOD_TOP_CATEGORIES]
+    for name, seconds in top:
+        percent = seconds / total_seconds * 100
+        bar_len = int(percent / 10)
+        if len(name) > 25:
+            name = name[:22] + "..."
+        text += f"  • {html.escape(name)}\n"
+        text += f"    {'█' * bar_len}{'░' * (10 - bar_len)}  {format_time_short(int(seconds))} ({percent:.0f}%)\n"
+    return text + "\n"
+
+def rollup_category_totals(rows, period_starts=None) -> dict:
+    """Секунды по категориям из строк итогов (удаленные категории пропускаются)"""
+    totals = {}
+    for start, category_id, name, seconds, _, _ in rows:
+        if category_id == ALL_CATEGORIES or name is None:
+            continue
+        if period_starts is not None and start not in period_starts:
+            continue
+        totals[name] = totals.get(name, 0.0) + (seconds or 0.0)
+    return totals
+
+async def show_period_statistics(message: Message, period: str):
+    """Итоги за текущую неделю, месяц или год: несколько строк из reading_rollups"""
+    user_id = message.from_user.id
+    utc_offset = await get_user_utc_offset(user_id)
+    today = datetime.combine(user_now(utc_offset).date(), datetime.min.time())
+    
+    if period == "year":
+        year_start = today.replace(month=1, day=1)
+        rows = await get_reading_rollups(user_id, "month", year_start, today)
+        text = format_year_statistics(year_start, today, rows)
+    else:
+        current = period_start(period, today)
+        previous = period_start(period, current - timedelta(days=1))
+        rows = await get_reading_rollups(user_id, period, previous, current)
+        text = format_period_statistics(period, previous, current, rows)
+    
+    text = text.rstrip("\n") + "\n\n<i>Другие периоды: /stats week · /stats month · /stats year</i>"
+    await message.answer(text, parse_mode='HTML')
+
+def format_period_statistics(period: str, previous: datetime, current: datetime, rows) -> str:
+    """Текст итогов недели или месяца со сравнением с прошлым периодом"""
+    totals = {row[0]: row for row in rows if row[1] == ALL_CATEGORIES}
+    now_row, prev_row = totals.get(current), totals.get(previous)
+    seconds = (now_row[3] or 0.0) if now_row else 0.0
+    sessions = (now_row[4] or 0) if now_row else 0
+    notes = (now_row[5] or 0) if now_row else 0
+    prev_seconds = (prev_row[3] or 0.0) if prev_row else 0.0
+    
+    if period == "week":
+        title = f"📅 <b>НЕДЕЛЯ {current:%d.%m} – {current + timedelta(days=6):%d.%m}</b>"
+        previous_title = "прошлой неделе"
+    else:
+        title = f"🗓️ <b>{MONTH_NAMES[current.month - 1].upper()} {current.year}</b>"
+        previous_title = "прошлому месяцу"
+    
+    text = f"{title}\n{'─' * 40}\n\n"
+    if not seconds and not sessions:
+        text += "📭 За этот период чтения еще не было. Запустите таймер: /timer\n"
+        if prev_seconds:
+            text += f"\n⏮️ В прошлом периоде: {format_time_short(int(prev_seconds))}\n"
+        return text
+    
+    text += f"⏱️ Время чтения:  {format_time_short(int(seconds))}\n"
+    text += f"📖 Сессий:        {sessions}\n"
+    text += f"📝 Заметок:       {notes}\n"
+    if sessions:
+        text += f"📊 Среднее/сессия: {format_time_short(int(seconds / sessions))}\n"
+    text += f"↕️ К {previous_title}: {format_change(seconds, prev_seconds)} "
+    text += f"({format_time_short(int(prev_seconds))})\n\n"
+    text += format_period_categories(rollup_category_totals(rows, {current}), seconds)
+    return text
+
+def format_year_statistics(year_start: datetime, today: datetime, rows) -> str:
+    """Текст итогов года: по месяцам (полоски) и по категориям"""
+    months = {row[0].month: row for row in rows if row[1] == ALL_CATEGORIES}
+    seconds = sum(row[3] or 0.0 for row in months.values())
+    sessions = sum(row[4] or 0 for row in months.values())
+    notes = sum(row[5] or 0 for row in months.values())
+    
+    text = f"📆 <b>{year_start.year} ГОД</b>\n{'─' * 40}\n\n"
+    if not seconds and not sessions:
+        return text + "📭 В этом году чтения еще не было. Запустите таймер: /timer\n"
+    
+    text += f"⏱️ Время чтения:  {format_time_short(int(seconds))} ({seconds / 3600:.1f}ч)\n"
+    text += f"📖 Сессий:        {sessions}\n"
+    text += f"📝 Заметок:       {notes}\n\n"
+    
+    best_seconds = max((row[3] or 0.0) for row in months.values())
+    text += f"📈 <b>ПО МЕСЯЦАМ:</b>\n"
+    for month in range(1, today.month + 1):
+        month_seconds = (months[month][3] or 0.0) if month in months else 0.0
+        bar_len = int(month_seconds / best_seconds * 10) if best_seconds else 0
+        text += f"  <code>{MONTH_NAMES[month - 1][:3]} {'█' * bar_len}{'░' * (10 - bar_len)}</code> "
+        text += f"{format_time_short(int(month_seconds))}\n"
+    if best_seconds:
+        best_month = max(months, key=lambda month: months[month][3] or 0.0)
+        text += f"🏆 Лучший месяц: {MONTH_NAMES[best_month - 1]}\n"
+    text += "\n"
+    text += format_period_categories(rollup_category_totals(rows), seconds)
+    return text
+
+# ===========================================
+# ЧАСОВОЙ ПОЯС
+# ===========================================
+# Часовые пояса России для быстрого выбора: (название, смещение в минутах)
+TIMEZONE_CHOICES = [
+    ("Калининград", 120), ("Москва", 180), ("Самара", 240),
+    ("Екатеринбург", 300), ("Омск", 360), ("Новосибирск", 420),
+    ("Иркутск", 480), ("Якутск", 540), ("Владивосток", 600),
+    ("Магадан", 660), ("Камчатка", 720), ("UTC", 0),
+]
+
+TIMEZONE_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text=f"{name} ({format_utc_offset(offset)})", callback_data=f"tz_{offset}")
+        for name, offset in TIMEZONE_CHOICES[i:i + 2]
+    ]
+    for i in range(0, len(TIMEZONE_CHOICES), 2)
+])
+
+_UTC_OFFSET_RE = re.compile(r"^(utc|gmt|мск)?\s*([+\-−]?)\s*(\d{1,2})(?::?(\d{2}))?$", re.IGNORECASE)
+
+def parse_utc_offset(value: str) -> Optional[int]:
+    """«+3», «UTC+5:30», «МСК+4», «-0800» -> смещение в минутах; None, если не разобрали"""
+    match = _UTC_OFFSET_RE.match(value.strip())
+    if not match:
+        return None
+    base, sign, hours, minutes = match.groups()
+    offset = int(hours) * 60 + int(minutes or 0)
+    if sign in ("-", "−"):
+        offset = -offset
+    if base and base.lower() == "мск":
+        offset += 180
+    if int(minutes or 0) >= 60 or not MIN_UTC_OFFSET_MINUTES <= offset <= MAX_UTC_OFFSET_MINUTES:
+        return None
+    return offset
+
+async def apply_timezone(message: Message, user_id: int, offset: int):
+    """Сохранить часовой пояс и сообщить о результате"""
+    changed = await set_user_utc_offset(user_id, offset)
+    if changed:
+        # Итоги периодов пересчитаны по новому поясу - место в рейтинге тоже
+        try:
+            await leaderboard.refresh_user(user_id)
+        except Exception as e:
+            print(f"⚠️ Ошибка обновления рейтинга: {e}")
+    local_time = user_now(offset).strftime('%H:%M')
+    text = f"✅ Часовой пояс: <b>{format_utc_offset(offset)}</b> (сейчас у вас {local_time})"
+    if changed:
+        text += "\n📊 Статистика пересчитана по местному времени"
+    await message.answer(text, parse_mode='HTML')
+
+@dp.message(Command("timezone"))
+async def cmd_timezone(message: Message, command: CommandObject):
+    """Часовой пояс: /timezone +3 или выбор из списка"""
+    user_id = message.from_user.id
+    if command.args:
+        offset = parse_utc_offset(command.args)
+        if offset is None:
+            await message.answer(
+                "❌ Не понял часовой пояс. Примеры: <code>/timezone +3</code>, "
+                "<code>/timezone UTC+5:30</code>, <code>/timezone МСК+4</code>",
+                parse_mode='HTML'
+            )
+            return
+        await apply_timezone(message, user_id, offset)
+        return
+    
+    offset = await get_user_utc_offset(user_id)
+    await message.answer(
+        f"🌍 <b>Часовой пояс:</b> {format_utc_offset(offset)} "
+        f"(сейчас у вас {user_now(offset).strftime('%H:%M')})\n\n"
+        "По нему считаются дни в статистике, серия дней и время суток чтения.\n"
+        "Выберите город или отправьте смещение: <code>/timezone +5:30</code>",
+        reply_markup=TIMEZONE_KEYBOARD,
+        parse_mode='HTML'
+    )
+
+@dp.callback_query(F.data.startswith("tz_"))
+async def timezone_callback(query: CallbackQuery):
+    """Выбор часового пояса кнопкой"""
+    try:
+        offset = int(query.data.split("_")[1])
+    except (IndexError, ValueError):
+        await query.answer("❌ Ошибка")
+        return
+    if not MIN_UTC_OFFSET_MINUTES <= offset <= MAX_UTC_OFFSET_MINUTES:
+        await query.answer("❌ Такого часового пояса нет", show_alert=True)
+        return
+    
+    await query.answer()
+    await apply_timezone(query.message, query.from_user.id, offset)
+
+# ===========================================
+# ЭКСПОРТ
+# ===========================================
+@dp.message(Command("export"))
+async def cmd_export(message: Message):
+    """Выгрузка всех заметок, сессий и статистики в ZIP"""
+    user_id = message.from_user.id
+    if user_id in exports_running:
+        await message.answer("⏳ Экспорт уже собирается, пришлю архив, как только он будет готов.")
+        return
+    
+    # Отмечаем до первого await, чтобы второй /export не проскочил проверку
+    exports_running.add(user_id)
+    try:
+        progress_message = await reply_interactive(message, "📦 <b>Собираю экспорт...</b>", parse_mode='HTML')
+        task = asyncio.create_task(export_in_background(user_id, progress_message.message_id))
+    except BaseException:
+        # Фоновая задача не запущена - снять отметку больше некому
+        exports_running.discard(user_id)
+        raise
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def export_in_background(user_id: int, message_id: int):
+    """Собрать архив во временный файл, показывая прогресс, и отправить документом"""
+    last_edit = time.monotonic()
+    
+    async def edit(text: str, priority: Priority):
+        try:
+            await outbound.send(
+                priority, user_id, bot.edit_message_text,
+                chat_id=user_id, message_id=message_id, text=text
+            )
+        except TelegramBadRequest:
+            pass
+    
+    async def report(rows: int):
+        nonlocal last_edit
+        if time.monotonic() - last_edit < DELETE_PROGRESS_INTERVAL:
+            return
+        last_edit = time.monotonic()
+        await edit(f"📦 <b>Собираю экспорт...</b>\n\n📝 Выгружено записей: <b>{rows}</b>", Priority.BULK)
+    
+    fd, path = tempfile.mkstemp(prefix="booknotes-export-", suffix=".zip")
+    os.close(fd)
+    try:
+        offset = await get_user_utc_offset(user_id)
+        started = time.perf_counter()
+        counts = await LibraryExporter(user_id, offset, report).export(path)
+        size = os.path.getsize(path)
+        if size > EXPORT_MAX_BYTES:
+            await edit(
+                f"⚠️ <b>Архив получился слишком большим</b> ({size / 1024 / 1024:.0f} МБ)\n\n"
+                f"Telegram не дает ботам отправлять файлы больше {EXPORT_MAX_BYTES // 1024 // 1024} МБ.",
+                Priority.INTERACTIVE
+            )
+            return
+        
+        await outbound.send(
+            Priority.UPLOAD, user_id, bot.send_document,
+            chat_id=user_id,
+            document=FSInputFile(path, filename=f"booknotes-{user_now(offset):%Y-%m-%d}.zip"),
+            caption=(
+                f"📦 <b>Экспорт готов</b>\n\n"
+                f"📁 Категорий: <b>{counts.get('categories', 0)}</b>\n"
+                f"📝 Заметок: <b>{counts.get('notes', 0)}</b>\n"
+                f"⏱️ Сессий чтения: <b>{counts.get('sessions', 0)}</b>"
+            ),
+            parse_mode='HTML'
+        )
+        await edit(
+            f"✅ <b>Экспорт готов</b> за {time.perf_counter() - started:.1f} с "
+            f"({size / 1024:.0f} КБ)",
+            Priority.INTERACTIVE
+        )
+    except Exception as e:
+        print(f"⚠️ Ошибка экспорта пользователя {user_id}: {e}")
+        await edit("❌ Не удалось собрать экспорт, попробуйте позже.", Priority.INTERACTIVE)
+    finally:
+        exports_running.discard(user_id)
+        os.remove(path)
+
+# ===========================================
+# ИМПОРТ
+# ===========================================
+@dp.message(Command("import"))
+async def cmd_import(message: Message, state: FSMContext, command: CommandObject):
+    """Импорт заметок из файла: /import или /import <строка-разделитель>"""
+    await state.set_state(ImportState.waiting_for_document)
+    await state.update_data(import_delimiter=(command.args or "").strip() or None)
+    await message.answer(
+        "📥 <b>Импорт заметок</b>\n\n"
+        "Пришлите файл документом:\n"
+        "• <b>.md</b> – каждая заметка начинается с заголовка или после <code>---</code>\n"
+        "• <b>.txt</b> – заметки через пустую строку "
+        "(или через свой разделитель: <code>/import ===</code>)\n"
+        "• <b>.csv</b> – колонка <code>text</code> или <code>content</code>\n"
+        "• <b>.json</b> / <b>.jsonl</b> – строки или объекты с полем <code>text</code> "
+        "(подходит и notes.jsonl из /export)\n\n"
+        f"Размер файла – до {IMPORT_MAX_BYTES // 1024 // 1024} МБ.",
+        parse_mode='HTML'
+    )
+
+@dp.message(ImportState.waiting_for_document, F.document)
+async def handle_import_document(message: Message, state: FSMContext):
+    """Файл для импорта получен: проверяем и спрашиваем категорию"""
+    document = message.document
+    fmt = import_format(document.file_name)
+    if fmt is None:
+        await message.answer(
+            f"❌ Такой файл не поддерживается. Подойдут: {', '.join(IMPORT_FORMATS)}"
+        )
+        return
+    if (document.file_size or 0) > IMPORT_MAX_BYTES:
+        await message.answer(f"❌ Файл больше {IMPORT_MAX_BYTES // 1024 // 1024} МБ")
+        return
+    
+    await state.update_data(
+        import_file_id=document.file_id,
+        import_file_name=document.file_name,
+        import_format=fmt
+    )
+    await state.set_state(ImportState.waiting_for_category)
+    keyboard = await IMPORT_PICKER.keyboard(message.from_user.id)
+    if keyboard is None:
+        keyboard = InlineKeyboardMarkup(inline_keyboard=IMPORT_PICKER.footer)
+    await message.answer(IMPORT_PICKER.title, reply_markup=keyboard)
+
+@dp.message(ImportState.waiting_for_document)
+async def handle_import_not_document(message: Message, state: FSMContext):
+    """Вместо файла пришло что-то другое"""
+    if message.text and message.text.startswith('/'):
+        await state.clear()
+        raise SkipHandler()
+    await message.answer(
+        "📎 Пришлите файл документом",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="❌ Отмена", callback_data="import_cancel")]
+        ])
+    )
+
+@dp.callback_query(F.data.startswith("import_cat_") | (F.data == "import_new"))
+async def import_category_callback(query: CallbackQuery, state: FSMContext):
+    """Категория для импорта выбрана (или создаем новую по имени файла)"""
+    user_id = query.from_user.id
+    data = await state.get_data()
+    if not data.get("import_file_id"):
+        await query.answer("❌ Сначала пришлите файл: /import", show_alert=True)
+        return
+    
+    if query.data == "import_new":
+        names = {cat.name for cat in await category_cache.get(user_id)}
+        base = os.path.splitext(data["import_file_name"])[0].strip()[:90] or "Импорт"
+        name = base
+        number = 2
+        while name in names:
+            name = f"{base} ({number})"
+            number += 1
+        new_cat = Category(user_id=user_id, name=name)
+        async with AsyncSessionLocal() as session:
+            session.add(new_cat)
+            await session.commit()
+        category_cache.invalidate(user_id)
+        category_id, category_name = new_cat.id, name
+    else:
+        try:
+            category = await category_cache.get_category(user_id, int(query.data.split("_")[2]))
+        except (IndexError, ValueError):
+            category = None
+        if category is None:
+            await query.answer("❌ Категория не найдена")
+            return
+        category_id, category_name = category.id, category.name
+    
+    await state.clear()
+    await state.update_data(current_category=category_id)
+    await query.message.edit_text(
+        f"📥 <b>Импортирую в «{category_name}»...</b>", parse_mode='HTML'
+    )
+    await query.answer()
+    task = asyncio.create_task(import_in_background(
+        user_id, query.message.message_id, category_id, category_name, data["import_file_id"],
+        data["import_format"], data.get("import_delimiter")
+    ))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+@dp.callback_query(F.data == "import_cancel")
+async def import_cancel_callback(query: CallbackQuery, state: FSMContext):
+    """Отмена импорта"""
+    await state.clear()
+    await query.message.edit_text("❌ Импорт отменен.")
+    await query.answer()
+
+async def import_in_background(user_id: int, message_id: int, category_id: int, category_name: str,
+                               file_id: str, fmt: str, delimiter: Optional[str]):
+    """Скачать файл и записать заметки пачками, показывая прогресс"""
+    last_edit = time.monotonic()
+    
+    async def edit(text: str, priority: Priority):
+        try:
+            await outbound.send(
+                priority, user_id, bot.edit_message_text,
+                chat_id=user_id, message_id=message_id, text=text
+            )
+        except TelegramBadRequest:
+            pass
+    
+    async def report(imported: int):
+        nonlocal last_edit
+        if time.monotonic() - last_edit < DELETE_PROGRESS_INTERVAL:
+            return
+        last_edit = time.monotonic()
+        await edit(
+            f"📥 <b>Импортирую в «{category_name}»...</b>\n\n📝 Записано заметок: <b>{imported}</b>",
+            Priority.BULK
+        )
+    
+    fd, path = tempfile.mkstemp(prefix="booknotes-import-")
+    os.close(fd)
+    try:
+        await bot.download(file_id, destination=path)
+        result = await import_notes(user_id, category_id, NoteReader(path, fmt, delimiter), report)
+    except Exception as e:
+        print(f"⚠️ Ошибка импорта пользователя {user_id}: {e}")
+        await edit("❌ Не удалось импортировать файл. Заметки, записанные до ошибки, сохранены.",
+                   Priority.INTERACTIVE)
+        return
+    finally:
+        os.remove(path)
+    
+    text = (
+        f"✅ <b>Импорт завершен</b>\n\n"
+        f"📁 Категория: <b>{category_name}</b>\n"
+        f"📝 Импортировано заметок: <b>{result['imported']}</b>\n"
+    )
+    if result["skipped"]:
+        text += f"⏭️ Пропущено пустых и нераспознанных записей: <b>{result['skipped']}</b>\n"
+    text += f"⏱️ За {result['seconds']:.1f} с"
+    await edit(text, Priority.INTERACTIVE)
+
 # ===========================================
 # ОСТАЛЬНЫЕ ОБРАБОТЧИКИ (КАТЕГОРИИ, ЗАМЕТКИ, УДАЛЕНИЕ, ПЕРЕИМЕНОВАНИЕ)
 # ===========================================
@@ -1777,24 +2928,13 @@ async def back_to_categories(query: CallbackQuery):
     """Вернуться к списку категорий"""
     user_id = query.from_user.id
 
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(Category).where(Category.user_id == user_id)
-        )
-        categories = result.scalars().all()
+    keyboard = await BACK_PICKER.keyboard(user_id)
 
-    if not categories:
+    if keyboard is None:
         await query.message.answer("Категорий пока нет. Создай → /category")
         await query.answer()
         return
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=cat.name, callback_data=f"showcat_{cat.id}")]
-        for cat in categories
-    ] + [
-        [InlineKeyboardButton(text="+ Создать новую категорию", callback_data="cat_new")]
-    ])
-
     await query.message.answer("Выбери категорию:", reply_markup=keyboard)
     await query.answer()
 
@@ -1822,6 +2962,7 @@ async def delete_note(query: CallbackQuery):
         
         if note:
             note.is_deleted = True
+            note.deleted_at = datetime.utcnow()
             await session.commit()
             await query.message.edit_text("✅ Заметка удалена.")
     
@@ -1914,17 +3055,12 @@ async def start_rename_category(query: CallbackQuery, state: FSMContext):
         await query.answer("❌ Ошибка")
         return
     
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(Category).where(Category.id == category_id)
-        )
-        category = result.scalar_one_or_none()
-        
-        if not category:
-            await query.answer("❌ Категория не найдена")
-            return
-        
-        current_name = category.name
+    category = await category_cache.get_category(query.from_user.id, category_id)
+    if not category:
+        await query.answer("❌ Категория не найдена")
+        return
+    
+    current_name = category.name
     
     await state.update_data(
         rename_category_id=category_id,
@@ -1973,30 +3109,21 @@ async def apply_rename_category(message: Message, state: FSMContext):
         return
     
     user_id = message.from_user.id
+    if any(cat.name == new_name and cat.id != category_id for cat in await category_cache.get(user_id)):
+        await message.answer(f"❌ У вас уже есть категория с названием <b>{new_name}</b>")
+        await state.clear()
+        return
+    
     async with AsyncSessionLocal() as session:
-        duplicate_result = await session.execute(
-            select(Category).where(
-                (Category.user_id == user_id) &
-                (Category.name == new_name) &
-                (Category.id != category_id)
-            )
-        )
-        duplicate = duplicate_result.scalar_one_or_none()
-        
-        if duplicate:
-            await message.answer(f"❌ У вас уже есть категория с названием <b>{new_name}</b>")
-            await state.clear()
-            return
-        
         result = await session.execute(
-            select(Category).where(Category.id == category_id)
+            update(Category)
+            .where((Category.id == category_id) & (Category.user_id == user_id))
+            .values(name=new_name)
         )
-        category = result.scalar_one_or_none()
+        await session.commit()
         
-        if category:
-            category.name = new_name
-            await session.commit()
-            
+        if result.rowcount:
+            category_cache.invalidate(user_id)
             await message.answer(
                 f"✅ <b>Категория переименована!</b>\n\n"
                 f"📝 <b>Было:</b> {old_name}\n"
@@ -2024,20 +3151,19 @@ async def start_delete_category(query: CallbackQuery, state: FSMContext):
         await query.answer("❌ Ошибка")
         return
     
+    category = await category_cache.get_category(query.from_user.id, category_id)
+    if not category:
+        await query.answer("❌ Категория не найдена")
+        return
+    
     async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(Category).where(Category.id == category_id)
-        )
-        category = result.scalar_one_or_none()
-        
-        if not category:
-            await query.answer("❌ Категория не найдена")
-            return
-        
-        notes_result = await session.execute(
-            select(Note).where(Note.category_id == category_id)
+        # Счетчик читается из индекса ix_notes_category, сами заметки не загружаем
+        notes_count = await session.scalar(
+            select(func.count(Note.id)).where(
+                Note.category_id == category_id,
+                Note.is_deleted == False
+            )
         )
-        notes_count = len(notes_result.scalars().all())
         category_name = category.name
     
     await state.update_data(
@@ -2080,33 +3206,56 @@ async def confirm_delete_category(query: CallbackQuery, state: FSMContext):
         return
     
     user_id = query.from_user.id
+    # Небольшую категорию удаляем вместе с заметками сразу, большую - в фоне
+    in_background = notes_count > CATEGORY_DELETE_CHUNK
     
     async with AsyncSessionLocal() as session:
         try:
-            if notes_count > 0:
-                await session.execute(
-                    Note.__table__.delete().where(Note.category_id == category_id)
-                )
-            
-            await session.execute(
+            result = await session.execute(
                 Category.__table__.delete().where(
                     (Category.id == category_id) &
                     (Category.user_id == user_id)
                 )
             )
+            if result.rowcount:
+                # Сессии чтения остаются в статистике как «Без категории»
+                await session.execute(
+                    update(ReadingSession)
+                    .where(ReadingSession.category_id == category_id, ReadingSession.user_id == user_id)
+                    .values(category_id=None)
+                )
+                if not in_background:
+                    await session.execute(
+                        Note.__table__.delete().where(Note.category_id == category_id)
+                    )
             
             await session.commit()
-            
-            await query.message.edit_text(
-                f"✅ <b>Категория удалена!</b>\n\n"
-                f"📂 Категория: <b>{category_name}</b>\n"
-                f"🗑️ Удалено заметок: <b>{notes_count}</b>"
-            )
+            category_cache.invalidate(user_id)
             
             current_data = await state.get_data()
             current_category_id = current_data.get("current_category")
             if current_category_id == category_id:
                 await state.update_data(current_category=None)
+            
+            if not result.rowcount:
+                await query.message.edit_text("❌ Категория не найдена")
+            elif in_background:
+                await query.message.edit_text(
+                    f"🗑️ <b>Удаляем категорию...</b>\n\n"
+                    f"📂 Категория: <b>{category_name}</b>\n"
+                    f"📝 Заметок: <b>{notes_count}</b>"
+                )
+                task = asyncio.create_task(delete_category_notes_in_background(
+                    user_id, query.message.message_id, category_id, category_name, notes_count
+                ))
+                background_tasks.add(task)
+                task.add_done_callback(background_tasks.discard)
+            else:
+                await query.message.edit_text(
+                    f"✅ <b>Категория удалена!</b>\n\n"
+                    f"📂 Категория: <b>{category_name}</b>\n"
+                    f"🗑️ Удалено заметок: <b>{notes_count}</b>"
+                )
                 
         except Exception as e:
             await query.message.edit_text(f"❌ Ошибка при удалении: {e}")
@@ -2114,6 +3263,54 @@ async def confirm_delete_category(query: CallbackQuery, state: FSMContext):
     await state.clear()
     await query.answer()
 
+async def delete_category_notes_in_background(user_id: int, message_id: int, category_id: int,
+                                              category_name: str, notes_count: int):
+    """Удалить заметки большой категории пачками, показывая прогресс в сообщении"""
+    last_edit = time.monotonic()
+    
+    async def edit(text: str, priority: Priority):
+        try:
+            await outbound.send(
+                priority, user_id, bot.edit_message_text,
+                chat_id=user_id, message_id=message_id, text=text
+            )
+        except TelegramBadRequest:
+            pass
+    
+    # Вместе с видимыми стираются и ранее удаленные заметки, поэтому
+    # пользователю показываем не больше, чем он видел при подтверждении
+    async def report(deleted: int):
+        nonlocal last_edit
+        # Редактируем не чаще раза в DELETE_PROGRESS_INTERVAL секунд
+        if time.monotonic() - last_edit < DELETE_PROGRESS_INTERVAL:
+            return
+        last_edit = time.monotonic()
+        await edit(
+            f"🗑️ <b>Удаляем категорию...</b>\n\n"
+            f"📂 Категория: <b>{category_name}</b>\n"
+            f"📝 Удалено заметок: <b>{min(deleted, notes_count)}</b> из <b>{notes_count}</b>",
+            Priority.BULK
+        )
+    
+    try:
+        await delete_category_notes(category_id, report)
+    except Exception as e:
+        # Оставшиеся заметки удалит фоновое обслуживание БД
+        print(f"⚠️ Ошибка при удалении заметок категории {category_id}: {e}")
+        await edit(
+            f"⚠️ <b>Категория удалена, но часть заметок еще удаляется</b>\n\n"
+            f"📂 Категория: <b>{category_name}</b>",
+            Priority.INTERACTIVE
+        )
+        return
+    
+    await edit(
+        f"✅ <b>Категория удалена!</b>\n\n"
+        f"📂 Категория: <b>{category_name}</b>\n"
+        f"🗑️ Удалено заметок: <b>{notes_count}</b>",
+        Priority.INTERACTIVE
+    )
+
 @dp.callback_query(F.data == "cancel_delete")
 async def cancel_delete_category(query: CallbackQuery, state: FSMContext):
     """Отмена удаления категории"""
@@ -2287,7 +3484,14 @@ async def help_info_handler(query: CallbackQuery):
         "/timer_status - Проверить состояние таймера\n"
         "/category - Выбрать категорию\n"
         "/notes - Просмотреть заметки\n"
+        "/search - Поиск по заметкам\n"
         "/stats - Статистика чтения\n"
+        "/stats week|month|year - Итоги за неделю, месяц, год\n"
+        "/heatmap - Тепловая карта дней и часов чтения\n"
+        "/top - Рейтинг читателей за неделю и месяц\n"
+        "/timezone - Часовой пояс для статистики\n"
+        "/export - Выгрузить все заметки в ZIP\n"
+        "/import - Загрузить заметки из файла\n"
         "/addmedia – добавить медиа\n"
         "/about - Информация о боте\n"
     )
@@ -2354,11 +3558,23 @@ async def main():
     print("📚 HSEBookNotes Bot с Таймером Чтения")
     print("=" * 50)
     
+    metrics_runner = None
     try:
         from init_db import init_db
         await init_db()
         
         print("✅ База данных готова")
+        
+        maintenance_job.start()
+        await media_archive.start()
+        await leaderboard.rebuild()
+        
+        if METRICS_PORT:
+            metrics_runner = await start_metrics_server(
+                METRICS_HOST, METRICS_PORT,
+                lambda app: install_profiler_routes(app, sql_profiler)
+            )
+        
         print("🚀 Запуск бота...")
         
         await bot.delete_webhook(drop_pending_updates=True)
@@ -2369,7 +3585,14 @@ async def main():
         import traceback
         traceback.print_exc()
     finally:
+        await maintenance_job.stop()
+        await media_archive.stop()
+        chart_renderer.shutdown()
         await cleanup_timers()
+        await note_write_queue.close()
+        await outbound.stop()
+        if metrics_runner:
+            await metrics_runner.cleanup()
 
 if __name__ == "__main__":
     print("🚀 Запуск бота HSEBookNotes...")
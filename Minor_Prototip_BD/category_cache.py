@@ -0,0 +1,164 @@
+﻿"""
+Кэш списков категорий пользователей (LRU с ограничением по памяти)
+"""
+import asyncio
+from collections import OrderedDict, namedtuple
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from sqlalchemy import func, select
+
+from init_db import AsyncSessionLocal, Category
+
+# Обработчикам нужны только id и название категории; статистику чтения
+# в кэше не держим. Порядок списка - по последней активности (чтение или
+# создание), поэтому после начала сессии чтения кэш пользователя сбрасывается
+CategoryInfo = namedtuple("CategoryInfo", ("id", "name"))
+
+CategoryList = Tuple[CategoryInfo, ...]
+
+# Сколько пользователей и сколько категорий суммарно держать в памяти
+CATEGORY_CACHE_MAX_USERS = 10000
+CATEGORY_CACHE_MAX_ROWS = 100000
+
+
+async def load_user_categories(user_id: int) -> CategoryList:
+    """Категории пользователя из БД: сначала те, что читались недавно"""
+    async with AsyncSessionLocal() as session:
+        # Выражение сортировки совпадает с индексом ix_categories_user_activity,
+        # так что SQLite читает строки в нужном порядке без сортировки
+        result = await session.execute(
+            select(Category.id, Category.name)
+            .where(Category.user_id == user_id)
+            .order_by(func.coalesce(Category.last_read_at, Category.created_at).desc(), Category.id.desc())
+        )
+        return tuple(CategoryInfo(category_id, name) for category_id, name in result.all())
+
+
+class _CacheEntry:
+    """Одна версия набора категорий пользователя и то, что из нее построено"""
+    __slots__ = ("categories", "derived")
+
+    def __init__(self, categories: CategoryList):
+        self.categories = categories
+        self.derived: Dict[Tuple[Hashable, ...], Any] = {}
+
+
+class CategoryCache:
+    """Read-through кэш: user_id -> кортеж CategoryInfo.
+
+    Вытесняет давно не использованных пользователей, когда превышен лимит
+    пользователей или суммарного числа категорий. Обработчики, которые
+    создают, переименовывают или удаляют категории, вызывают invalidate().
+
+    Вместе с категориями хранятся построенные из них значения (клавиатуры):
+    они живут ровно столько, сколько эта версия набора категорий, и
+    сбрасываются вместе с ней при инвалидации или вытеснении.
+    """
+
+    def __init__(self, loader: Callable[[int], Awaitable[CategoryList]],
+                 max_users: int = CATEGORY_CACHE_MAX_USERS, max_rows: int = CATEGORY_CACHE_MAX_ROWS):
+        self.loader = loader
+        self.max_users = max_users
+        self.max_rows = max_rows
+        self._entries: "OrderedDict[int, _CacheEntry]" = OrderedDict()
+        self._rows = 0
+        # Одна загрузка на пользователя, даже если промахнулись сразу несколько апдейтов
+        self._loading: Dict[int, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    async def get(self, user_id: int) -> CategoryList:
+        """Все категории пользователя"""
+        return (await self._get_entry(user_id)).categories
+
+    async def derive(self, user_id: int, build: Callable[..., Any], *args: Hashable) -> Any:
+        """Значение build(категории, *args) для категорий пользователя.
+
+        build вызывается один раз на версию набора категорий и набор args;
+        результат разделяется между вызовами, поэтому изменять его нельзя
+        """
+        entry = await self._get_entry(user_id)
+        key = (build,) + args
+        value = entry.derived.get(key)
+        if value is None:
+            value = entry.derived[key] = build(entry.categories, *args)
+        return value
+
+    async def _get_entry(self, user_id: int) -> _CacheEntry:
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        pending = self._loading.get(user_id)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._loading[user_id] = future
+        try:
+            entry = _CacheEntry(await self.loader(user_id))
+        except BaseException as e:
+            if self._loading.get(user_id) is future:
+                del self._loading[user_id]
+            # Ожидающие ту же загрузку получают ошибку, а не зависают
+            future.set_exception(e if isinstance(e, Exception) else RuntimeError("загрузка категорий прервана"))
+            future.exception()
+            raise
+
+        future.set_result(entry)
+        # Если за время загрузки категории изменились, invalidate() уже
+        # снял нашу загрузку - устаревший результат в кэш не кладем
+        if self._loading.get(user_id) is future:
+            del self._loading[user_id]
+            self._store(user_id, entry)
+        return entry
+
+    async def get_category(self, user_id: int, category_id: int) -> Optional[CategoryInfo]:
+        """Категория пользователя по id (None, если ее нет или она чужая)"""
+        for category in await self.get(user_id):
+            if category.id == category_id:
+                return category
+        return None
+
+    def invalidate(self, user_id: int):
+        """Сбросить кэш пользователя после изменения его категорий"""
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._rows -= len(entry.categories)
+        # Идущая загрузка могла прочитать старые данные: ее результат не
+        # сохраняем, а новые запросы идут в БД, а не ждут ее
+        self._loading.pop(user_id, None)
+        self.invalidations += 1
+
+    def _store(self, user_id: int, entry: _CacheEntry):
+        previous = self._entries.pop(user_id, None)
+        if previous is not None:
+            self._rows -= len(previous.categories)
+        self._entries[user_id] = entry
+        self._rows += len(entry.categories)
+        # Только что сохраненную запись не вытесняем, даже если она одна
+        # больше max_rows: иначе у такого пользователя кэш никогда не срабатывает
+        while len(self._entries) > 1 and (len(self._entries) > self.max_users or self._rows > self.max_rows):
+            _, evicted = self._entries.popitem(last=False)
+            self._rows -= len(evicted.categories)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "users": len(self._entries),
+            "rows": self._rows,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+category_cache = CategoryCache(load_user_categories)
@@ -0,0 +1,97 @@
+﻿"""
+Постраничный выбор категории с фильтром по началу названия
+"""
+import math
+from typing import Callable, Dict, List, Optional, Sequence
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from category_cache import CategoryInfo, CategoryList, category_cache
+
+# Категорий на одной странице выбора
+PICKER_PAGE_SIZE = 8
+
+# Максимальная длина префикса для фильтра
+PICKER_MAX_PREFIX = 50
+
+# Все выборщики по короткому имени - для обработчиков навигации
+PICKERS: Dict[str, "CategoryPicker"] = {}
+
+
+def fold_name(name: str) -> str:
+    """Название для сравнения: без учета регистра, «ё» как «е» (как в поиске по заметкам)"""
+    return name.casefold().replace("ё", "е")
+
+
+class CategoryPicker:
+    """Клавиатура выбора категории: одна страница, навигация и фильтр.
+
+    callback_data навигации: pick_<kind>_<страница> (без фильтра),
+    pickq_<kind>_<страница> (с фильтром пользователя), pickf_<kind> -
+    ввести фильтр, pickc_<kind> - сбросить его. Категории приходят из
+    category_cache в порядке последней активности.
+    """
+
+    def __init__(self, kind: str, title: str,
+                 item_buttons: Callable[[CategoryInfo], List[InlineKeyboardButton]],
+                 footer: Sequence[Sequence[InlineKeyboardButton]] = (),
+                 page_size: int = PICKER_PAGE_SIZE):
+        self.kind = kind
+        self.title = title
+        self.item_buttons = item_buttons
+        self.footer = [list(row) for row in footer]
+        self.page_size = page_size
+        PICKERS[kind] = self
+
+    async def keyboard(self, user_id: int, page: int = 0,
+                       prefix: Optional[str] = None) -> Optional[InlineKeyboardMarkup]:
+        """Страница выбора; None, если у пользователя нет категорий"""
+        if prefix:
+            # Отфильтрованные страницы не кэшируем: префиксов может быть сколько угодно
+            return self.build(await category_cache.get(user_id), page, prefix)
+        return await category_cache.derive(user_id, self.build, page)
+
+    def build(self, categories: CategoryList, page: int = 0,
+              prefix: Optional[str] = None) -> Optional[InlineKeyboardMarkup]:
+        if not categories:
+            return None
+
+        items = categories
+        if prefix:
+            needle = fold_name(prefix)
+            items = [cat for cat in categories if fold_name(cat.name).startswith(needle)]
+
+        pages = max(1, math.ceil(len(items) / self.page_size))
+        page = min(max(page, 0), pages - 1)
+        start = page * self.page_size
+        rows = [self.item_buttons(cat) for cat in items[start:start + self.page_size]]
+        if not items:
+            rows.append([InlineKeyboardButton(text="Ничего не найдено", callback_data="picker_noop")])
+
+        nav_prefix = "pickq" if prefix else "pick"
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton(text="◀️", callback_data=f"{nav_prefix}_{self.kind}_{page - 1}"))
+        if pages > 1:
+            nav.append(InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="picker_noop"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton(text="▶️", callback_data=f"{nav_prefix}_{self.kind}_{page + 1}"))
+        if nav:
+            rows.append(nav)
+
+        if prefix:
+            rows.append([InlineKeyboardButton(text=f"✖️ Сбросить фильтр «{prefix}»",
+                                              callback_data=f"pickc_{self.kind}")])
+        elif len(categories) > self.page_size:
+            rows.append([InlineKeyboardButton(text="🔎 Найти по названию", callback_data=f"pickf_{self.kind}")])
+
+        return InlineKeyboardMarkup(inline_keyboard=rows + self.footer)
+
+
+def parse_picker_callback(data: str):
+    """pick_<kind>_<страница> -> (выборщик, страница); None, если данные не подходят"""
+    try:
+        _, kind, page = data.split("_")
+        return PICKERS[kind], int(page)
+    except (KeyError, ValueError):
+        return None
@@ -0,0 +1,166 @@
+﻿"""
+Графики статистики: отрисовка вне цикла событий и кэш готовых PNG
+"""
+import asyncio
+import hashlib
+import io
+import pickle
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+from matplotlib.colors import ListedColormap
+from matplotlib.figure import Figure
+
+from stats_engine import WEEKDAY_NAMES
+
+# Сколько пользователей x графиков держать в кэше (по последней картинке)
+CHART_CACHE_SIZE = 500
+
+# Цвета календаря активности: нет чтения и четыре квартиля дней с чтением
+CALENDAR_COLORS = ("#ebedf0", "#9be9a8", "#40c463", "#30a14e", "#216e39")
+MONTH_SHORT = ("янв", "фев", "мар", "апр", "май", "июн", "июл", "авг", "сен", "окт", "ноя", "дек")
+
+
+class ChartRenderer:
+    """Отрисовка графиков в отдельном потоке с кэшем PNG.
+
+    Matplotlib (pyplot) не потокобезопасен, поэтому все графики рисует один
+    поток, а цикл событий тем временем обслуживает остальных. Для каждой
+    пары (график, пользователь) хранится последняя картинка с отпечатком
+    входных данных: пока данные не изменились, график не перерисовывается,
+    а одинаковые запросы во время отрисовки ждут одну и ту же картинку
+    """
+
+    def __init__(self, cache_size: int = CHART_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[Tuple[str, int], Tuple[bytes, bytes]]" = OrderedDict()
+        self._rendering: Dict[tuple, asyncio.Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="charts")
+        # Статистика для метрик
+        self.hits = 0
+        self.misses = 0
+        self.failed = 0
+        self.render_seconds = 0.0
+
+    async def render(self, name: str, user_id: int, draw: Callable, *args) -> Optional[bytes]:
+        """PNG графика draw(*args) (BytesIO или bytes); None, если нарисовать не удалось"""
+        fingerprint = hashlib.blake2b(pickle.dumps(args), digest_size=16).digest()
+        key = (name, user_id)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] == fingerprint:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return cached[1]
+
+        pending = self._rendering.get((key, fingerprint))
+        if pending is not None:
+            self.hits += 1
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().run_in_executor(self._executor, self._draw, draw, args)
+        self._rendering[(key, fingerprint)] = future
+        try:
+            png = await asyncio.shield(future)
+        finally:
+            self._rendering.pop((key, fingerprint), None)
+        if png is not None:
+            self._cache[key] = (fingerprint, png)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return png
+
+    def _draw(self, draw: Callable, args: tuple) -> Optional[bytes]:
+        started = time.perf_counter()
+        try:
+            result = draw(*args)
+        except Exception as e:
+            self.failed += 1
+            print(f"⚠️ Ошибка отрисовки графика: {e}")
+            return None
+        finally:
+            self.render_seconds += time.perf_counter() - started
+        return result.getvalue() if isinstance(result, io.BytesIO) else result
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {
+            "cached": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "failed": self.failed,
+            "render_seconds": self.render_seconds,
+        }
+
+
+# ===========================================
+# ТЕПЛОВЫЕ КАРТЫ (/heatmap)
+# ===========================================
+def calendar_levels(daily: np.ndarray) -> np.ndarray:
+    """Уровень цвета дня: 0 - без чтения, 1-4 - квартиль среди дней с чтением"""
+    active = daily[daily > 0]
+    if not active.size:
+        return np.zeros(daily.shape, dtype=np.int64)
+    bounds = np.percentile(active, (25, 50, 75))
+    return np.where(daily > 0, 1 + np.searchsorted(bounds, daily), 0)
+
+
+def draw_reading_heatmaps(first_day: date, daily: np.ndarray, hourly: np.ndarray) -> bytes:
+    """Одна картинка: календарь активности по неделям и карта «день недели x час»"""
+    weeks = -(-len(daily) // 7)
+    # Дни после сегодняшнего в последней неделе - пустые клетки
+    levels = np.full(weeks * 7, np.nan)
+    levels[:len(daily)] = calendar_levels(daily)
+    grid = np.ma.masked_invalid(levels.reshape(weeks, 7).T)
+
+    fig = Figure(figsize=(11, 5.6), facecolor="white")
+    calendar_ax, hours_ax = fig.subplots(2, 1, gridspec_kw={"height_ratios": (1, 1.15)})
+
+    cmap = ListedColormap(CALENDAR_COLORS)
+    cmap.set_bad("white")
+    calendar_ax.imshow(grid, cmap=cmap, vmin=-0.5, vmax=len(CALENDAR_COLORS) - 0.5, aspect="equal")
+    # Границы между клетками, как в календаре GitHub
+    calendar_ax.set_xticks(np.arange(-0.5, weeks), minor=True)
+    calendar_ax.set_yticks(np.arange(-0.5, 7), minor=True)
+    calendar_ax.grid(which="minor", color="white", linewidth=1.5)
+    calendar_ax.grid(which="major", visible=False)
+    calendar_ax.tick_params(which="both", length=0)
+    # Подпись месяца - над первой неделей, начинающейся в этом месяце
+    mondays = np.datetime64(first_day, "D") + 7 * np.arange(weeks)
+    months = mondays.astype("datetime64[M]").astype(np.int64)
+    starts = np.flatnonzero(np.diff(months, prepend=months[0] - 1))
+    calendar_ax.set_xticks(starts)
+    calendar_ax.set_xticklabels([MONTH_SHORT[months[i] % 12] for i in starts], fontsize=9)
+    calendar_ax.set_yticks((0, 2, 4))
+    calendar_ax.set_yticklabels([WEEKDAY_NAMES[i] for i in (0, 2, 4)], fontsize=9)
+    calendar_ax.set_title("Дни чтения за год", fontsize=13, fontweight="bold", loc="left")
+    for spine in calendar_ax.spines.values():
+        spine.set_visible(False)
+
+    minutes = hourly / 60
+    image = hours_ax.imshow(minutes, cmap="Greens", aspect="auto", vmin=0)
+    hours_ax.grid(False)
+    hours_ax.set_xticks(np.arange(0, 24, 2))
+    hours_ax.set_xticklabels([f"{hour:02d}" for hour in range(0, 24, 2)], fontsize=9)
+    hours_ax.set_yticks(np.arange(7))
+    hours_ax.set_yticklabels(WEEKDAY_NAMES, fontsize=9)
+    hours_ax.set_xlabel("Час", fontsize=10)
+    hours_ax.set_title("Когда вы читаете: день недели × час", fontsize=13, fontweight="bold", loc="left")
+    colorbar = fig.colorbar(image, ax=hours_ax, fraction=0.025, pad=0.01)
+    colorbar.set_label("минут", fontsize=9)
+    colorbar.ax.tick_params(labelsize=8)
+
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=110, facecolor="white")
+    return buf.getvalue()
+
+
+chart_renderer = ChartRenderer()
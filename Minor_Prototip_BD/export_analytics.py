@@ -0,0 +1,299 @@
+﻿"""
+Выгрузка сессий чтения и дневной статистики в колоночные файлы для анализа.
+
+Каждый запуск дописывает только новые строки: для каждой таблицы в
+<out>/_watermarks.json хранится последний выгруженный id, новые строки
+ложатся отдельными файлами <out>/<таблица>/part-<первый id>-<последний id>.
+Формат - Parquet (если установлен pyarrow) или сжатый NumPy .npz.
+
+Выгружаются только «закрытые» строки: завершенные (или брошенные) сессии
+и дни, которые уже не изменятся. Первая незакрытая строка останавливает
+выгрузку таблицы до следующего запуска, поэтому ничего не теряется.
+
+Пересчет статистики (смена часового пояса, backfill_stats.py) создает
+дневные строки пользователя заново под новыми id и пишет об этом в
+stats_rebuilds. По журналу строки пересчитанных пользователей удаляются
+из выгруженных файлов и выгружаются заново файлом rebuild-*, а после
+пересчета всех пользователей таблица daily выгружается целиком.
+
+Пример:
+    python export_analytics.py --out analytics
+    python export_analytics.py --out analytics --format npz --chunk 20000
+    python export_analytics.py --out analytics --full --tables daily
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault("DB_ECHO", "0")
+
+import numpy as np  # noqa: E402
+from sqlalchemy import select  # noqa: E402
+
+from init_db import AsyncSessionLocal, DailyReadingStats, ReadingSession, StatsRebuild  # noqa: E402
+from maintenance import ABANDONED_SESSION_HOURS  # noqa: E402
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pc = pq = None
+
+# День считается закрытым через столько дней: сессия, начатая вечером,
+# может добавить время следующему дню, а местный день отстает от UTC
+DAY_CLOSED_AFTER = timedelta(days=2)
+
+# Колонки таблиц и их типы: int, float, bool, datetime. NULL в .npz:
+# int -> -1, float -> NaN, datetime -> NaT
+TABLES = {
+    "sessions": (ReadingSession, (
+        ("id", "int"), ("user_id", "int"), ("category_id", "int"),
+        ("start_time", "datetime"), ("end_time", "datetime"), ("duration_seconds", "float"),
+        ("notes_count", "int"), ("media_notes_count", "int"), ("is_completed", "bool"),
+    )),
+    "daily": (DailyReadingStats, (
+        ("id", "int"), ("user_id", "int"), ("date", "datetime"),
+        ("total_seconds", "float"), ("sessions_count", "int"), ("notes_count", "int"),
+        ("night_seconds", "float"), ("morning_seconds", "float"),
+        ("afternoon_seconds", "float"), ("evening_seconds", "float"),
+    )),
+}
+
+# Ключи _watermarks.json для журнала пересчетов: последняя обработанная
+# запись и пользователи, чьи строки еще надо заменить на следующем запуске
+REBUILDS_KEY = "daily_rebuilds"
+PENDING_USERS_KEY = "daily_pending_users"
+# Пользователей в одном запросе при замене строк
+REBUILD_USERS_BATCH = 500
+
+NUMPY_TYPES = {"int": np.int64, "float": np.float64, "bool": np.bool_}
+NUMPY_NULLS = {"int": -1, "float": np.nan, "bool": False}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Колоночная выгрузка сессий и статистики чтения")
+    parser.add_argument("--out", default="analytics", help="каталог выгрузки")
+    parser.add_argument("--chunk", type=int, default=50000, help="строк в одном файле")
+    parser.add_argument("--format", choices=("auto", "parquet", "npz"), default="auto",
+                        help="auto - Parquet, если установлен pyarrow, иначе .npz")
+    parser.add_argument("--tables", nargs="*", choices=tuple(TABLES), default=list(TABLES))
+    parser.add_argument("--full", action="store_true", help="выгрузить таблицы заново с первой строки")
+    return parser.parse_args()
+
+
+def is_closed(table: str, row, now: datetime) -> bool:
+    """Строка больше не изменится и ее можно выгружать"""
+    if table == "sessions":
+        return bool(row.is_completed) or row.end_time is not None or \
+            row.start_time < now - timedelta(hours=ABANDONED_SESSION_HOURS)
+    return row.date < now - DAY_CLOSED_AFTER
+
+
+def to_numpy(values: list, kind: str) -> np.ndarray:
+    if kind == "datetime":
+        return np.array([np.datetime64(v, "us") if v is not None else np.datetime64("NaT") for v in values],
+                        dtype="datetime64[us]")
+    null = NUMPY_NULLS[kind]
+    return np.array([null if v is None else v for v in values], dtype=NUMPY_TYPES[kind])
+
+
+def write_part(path: str, columns: dict, schema, fmt: str) -> str:
+    """Записать один файл выгрузки (через временный файл, чтобы не оставить обрезанный)"""
+    tmp_path = path + ".tmp"
+    if fmt == "parquet":
+        path += ".parquet"
+        pq.write_table(pa.table(columns), tmp_path, compression="zstd")
+    else:
+        path += ".npz"
+        kinds = dict(schema)
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, **{name: to_numpy(values, kinds[name]) for name, values in columns.items()})
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_watermarks(out: str) -> dict:
+    try:
+        with open(os.path.join(out, "_watermarks.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_watermarks(out: str, watermarks: dict):
+    path = os.path.join(out, "_watermarks.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(watermarks, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+async def export_table(table: str, out: str, watermarks: dict, chunk: int, fmt: str) -> int:
+    """Дописать новые закрытые строки таблицы файлами по chunk строк"""
+    model, schema = TABLES[table]
+    columns = [getattr(model, name) for name, _ in schema]
+    os.makedirs(os.path.join(out, table), exist_ok=True)
+    now = datetime.utcnow()
+    exported = 0
+
+    while True:
+        after = watermarks.get(table, 0)
+        # Одно окно - одно короткое чтение, чтобы не держать БД
+        async with AsyncSessionLocal() as session:
+            rows = (await session.execute(
+                select(*columns).where(model.id > after).order_by(model.id).limit(chunk)
+            )).all()
+
+        closed = []
+        for row in rows:
+            if not is_closed(table, row, now):
+                break
+            closed.append(row)
+        if not closed:
+            return exported
+
+        data = {name: [row[i] for row in closed] for i, (name, _) in enumerate(schema)}
+        path = write_part(
+            os.path.join(out, table, f"part-{closed[0].id:012d}-{closed[-1].id:012d}"), data, schema, fmt
+        )
+        watermarks[table] = closed[-1].id
+        save_watermarks(out, watermarks)
+        exported += len(closed)
+        print(f"📦 {table}: {len(closed)} строк -> {path}")
+        if len(closed) < len(rows) or len(rows) < chunk:
+            return exported
+
+
+def part_files(out: str, table: str) -> list:
+    directory = os.path.join(out, table)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.endswith((".parquet", ".npz")))
+
+
+def drop_users_from_part(path: str, user_ids: set) -> int:
+    """Удалить из файла выгрузки строки пользователей; возвращает число удаленных строк"""
+    users = sorted(user_ids)
+    if path.endswith(".parquet"):
+        if pq is None:
+            raise SystemExit(f"❌ Для замены строк в {path} нужен pyarrow")
+        data = pq.read_table(path)
+        keep = pc.invert(pc.is_in(data["user_id"], value_set=pa.array(users, type=data["user_id"].type)))
+        kept = data.filter(keep)
+        removed, left = data.num_rows - kept.num_rows, kept.num_rows
+    else:
+        with np.load(path) as f:
+            data = {name: f[name] for name in f.files}
+        keep = ~np.isin(data["user_id"], users)
+        removed, left = int((~keep).sum()), int(keep.sum())
+    if not removed:
+        return 0
+    if not left:
+        os.remove(path)
+        return removed
+    tmp_path = path + ".tmp"
+    if path.endswith(".parquet"):
+        pq.write_table(kept, tmp_path, compression="zstd")
+    else:
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, **{name: values[keep] for name, values in data.items()})
+    os.replace(tmp_path, path)
+    return removed
+
+
+async def load_rebuilds(after: int) -> list:
+    """Записи журнала пересчетов после after: (id, user_id), user_id None - пересчет всех"""
+    async with AsyncSessionLocal() as session:
+        return (await session.execute(
+            select(StatsRebuild.id, StatsRebuild.user_id).where(StatsRebuild.id > after).order_by(StatsRebuild.id)
+        )).all()
+
+
+async def resupersede_users(out: str, watermarks: dict, user_ids: set, fmt: str) -> set:
+    """Заменить выгруженные дневные строки пользователей их текущими строками.
+
+    Новые строки с id выше отметки выгрузятся обычным порядком (до этого
+    пользователя в выгрузке нет, но и дважды он не учтется), строки с id
+    не выше (SQLite отдает освободившиеся id заново) - здесь. Возвращает
+    пользователей, у которых среди таких строк есть незакрытые дни: их
+    замена повторится на следующем запуске
+    """
+    model, schema = TABLES["daily"]
+    columns = [getattr(model, name) for name, _ in schema]
+    removed = sum(drop_users_from_part(path, user_ids) for path in part_files(out, "daily"))
+    watermark = watermarks.get("daily", 0)
+    now = datetime.utcnow()
+    stamp = f"{now:%Y%m%d%H%M%S}"
+    users = sorted(user_ids)
+    pending = set()
+    written = 0
+    for start in range(0, len(users), REBUILD_USERS_BATCH):
+        async with AsyncSessionLocal() as session:
+            rows = (await session.execute(
+                select(*columns)
+                .where(model.user_id.in_(users[start:start + REBUILD_USERS_BATCH]), model.id <= watermark)
+                .order_by(model.id)
+            )).all()
+        closed = [row for row in rows if is_closed("daily", row, now)]
+        pending.update(row.user_id for row in rows if not is_closed("daily", row, now))
+        if closed:
+            data = {name: [row[i] for row in closed] for i, (name, _) in enumerate(schema)}
+            write_part(os.path.join(out, "daily", f"rebuild-{stamp}-{start // REBUILD_USERS_BATCH:04d}"),
+                       data, schema, fmt)
+            written += len(closed)
+    print(f"♻️ daily: пересчитано пользователей {len(user_ids)}, строк удалено {removed}, выгружено заново {written}")
+    return pending
+
+
+async def apply_rebuilds(out: str, watermarks: dict, fmt: str, full: bool) -> bool:
+    """Учесть пересчеты статистики с прошлого запуска; True - если daily надо выгрузить целиком"""
+    rebuilds = await load_rebuilds(watermarks.get(REBUILDS_KEY, 0))
+    if rebuilds:
+        watermarks[REBUILDS_KEY] = rebuilds[-1].id
+    pending = set(watermarks.get(PENDING_USERS_KEY, ()))
+    full = full or any(user_id is None for _, user_id in rebuilds)
+    if full or "daily" not in watermarks:
+        # Выгружать заново нечего: таблица и так пойдет с первой строки
+        pending.clear()
+    else:
+        pending.update(user_id for _, user_id in rebuilds)
+        if pending:
+            pending = await resupersede_users(out, watermarks, pending, fmt)
+    watermarks[PENDING_USERS_KEY] = sorted(pending)
+    return full
+
+
+async def main():
+    args = parse_args()
+    fmt = args.format
+    if fmt == "auto":
+        fmt = "parquet" if pa is not None else "npz"
+    if fmt == "parquet" and pa is None:
+        raise SystemExit("❌ Для Parquet нужен pyarrow: pip install pyarrow (или --format npz)")
+
+    os.makedirs(args.out, exist_ok=True)
+    watermarks = load_watermarks(args.out)
+    started = time.perf_counter()
+    for table in args.tables:
+        full = args.full
+        if table == "daily":
+            full = await apply_rebuilds(args.out, watermarks, fmt, full)
+            save_watermarks(args.out, watermarks)
+            if full and not args.full:
+                print("♻️ daily: статистика пересчитана для всех пользователей - выгружаем заново")
+        if full:
+            shutil.rmtree(os.path.join(args.out, table), ignore_errors=True)
+            watermarks.pop(table, None)
+            save_watermarks(args.out, watermarks)
+        exported = await export_table(table, args.out, watermarks, args.chunk, fmt)
+        print(f"✅ {table}: выгружено {exported} строк (до id {watermarks.get(table, 0)})")
+    print(f"⏱️ Готово за {time.perf_counter() - started:.1f} с, формат {fmt}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
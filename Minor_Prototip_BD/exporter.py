@@ -0,0 +1,241 @@
+﻿"""
+Экспорт библиотеки пользователя в ZIP: Markdown для чтения, JSON Lines для импорта
+"""
+import asyncio
+import json
+import re
+import zipfile
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from sqlalchemy import select
+
+from init_db import (
+    AsyncSessionLocal, Category, DailyReadingStats, HourlyReadingStats, MediaType,
+    Note, NoteAttachment, ReadingSession
+)
+
+# Строк за одно чтение из БД. Экспорт идет окнами по id, а не одним
+# курсором: в SQLite открытое чтение не дает писателю закоммитить, и
+# длинный экспорт остановил бы сохранение заметок всех пользователей
+EXPORT_WINDOW = 2000
+# Боты не могут отправлять файлы больше 50 МБ
+EXPORT_MAX_BYTES = 50 * 1024 * 1024
+# Версия формата архива (читает импорт)
+EXPORT_FORMAT_VERSION = 1
+
+MEDIA_TITLES = {
+    MediaType.PHOTO: "📸 Фото",
+    MediaType.VIDEO: "🎥 Видео",
+    MediaType.VOICE: "🎤 Голосовое",
+    MediaType.DOCUMENT: "📄 Документ",
+}
+
+NOTE_COLUMNS = (
+    Note.id, Note.category_id, Note.created_at, Note.media_type, Note.content,
+    Note.media_caption, Note.media_file_id, Note.attachments_count, Note.reading_session_id
+)
+SESSION_COLUMNS = (
+    ReadingSession.id, ReadingSession.category_id, ReadingSession.start_time, ReadingSession.end_time,
+    ReadingSession.duration_seconds, ReadingSession.notes_count, ReadingSession.media_notes_count,
+    ReadingSession.is_completed
+)
+DAILY_COLUMNS = (
+    DailyReadingStats.id, DailyReadingStats.date, DailyReadingStats.total_seconds,
+    DailyReadingStats.sessions_count, DailyReadingStats.notes_count,
+    DailyReadingStats.night_seconds, DailyReadingStats.morning_seconds,
+    DailyReadingStats.afternoon_seconds, DailyReadingStats.evening_seconds
+)
+HOURLY_COLUMNS = (
+    HourlyReadingStats.id, HourlyReadingStats.date, HourlyReadingStats.hour, HourlyReadingStats.total_seconds
+)
+
+Progress = Callable[[int], Awaitable[None]]
+
+
+def _json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, MediaType):
+        return value.value
+    return value
+
+
+def json_line(row) -> str:
+    """Строка результата запроса -> строка JSON Lines"""
+    return json.dumps({key: _json_value(value) for key, value in row._mapping.items()},
+                      ensure_ascii=False) + "\n"
+
+
+def category_file_name(number: int, name: str) -> str:
+    """Имя Markdown-файла категории, безопасное для любой ОС"""
+    slug = re.sub(r"[^\w\-]+", " ", name).strip()[:40].strip() or "category"
+    return f"notes/{number:03d} {slug}.md"
+
+
+async def iter_windows(query, id_column, session_factory=AsyncSessionLocal,
+                       window: int = EXPORT_WINDOW) -> AsyncIterator[list]:
+    """Строки запроса окнами по id; каждое окно читается отдельной короткой транзакцией"""
+    after = 0
+    while True:
+        async with session_factory() as session:
+            rows = (await session.execute(
+                query.where(id_column > after).order_by(id_column).limit(window)
+            )).all()
+        if not rows:
+            return
+        yield rows
+        after = rows[-1].id
+
+
+class _ZipStream:
+    """ZIP на диске, в который файлы пишутся по частям.
+
+    Сжатие и запись идут в пуле потоков, чтобы не держать цикл событий;
+    в памяти - только текущее окно строк
+    """
+
+    def __init__(self, path: str):
+        self.zip = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+
+    @asynccontextmanager
+    async def entry(self, name: str):
+        handle = await asyncio.to_thread(self.zip.open, name, "w", force_zip64=True)
+        try:
+            yield lambda text: asyncio.to_thread(handle.write, text.encode("utf-8"))
+        finally:
+            await asyncio.to_thread(handle.close)
+
+    async def close(self):
+        await asyncio.to_thread(self.zip.close)
+
+
+class LibraryExporter:
+    """Выгрузка категорий, заметок, сессий и статистики одного пользователя.
+
+    Состав архива:
+    - README.md - сводка;
+    - notes/NNN <категория>.md - заметки каждой категории в Markdown;
+    - categories.json, notes.jsonl, attachments.jsonl, sessions.jsonl,
+      daily_stats.jsonl, hourly_stats.jsonl - все данные для импорта и анализа.
+    Даты в Markdown - местные (по /timezone), в JSON - UTC
+    """
+
+    def __init__(self, user_id: int, utc_offset_minutes: int = 0,
+                 progress: Optional[Progress] = None, session_factory=AsyncSessionLocal):
+        self.user_id = user_id
+        self.offset = timedelta(minutes=utc_offset_minutes)
+        self.progress = progress
+        self.session_factory = session_factory
+        self.rows = 0
+        self.counts = {}
+
+    async def _advance(self, rows: int):
+        self.rows += rows
+        if self.progress is not None:
+            await self.progress(self.rows)
+
+    def _local(self, moment: Optional[datetime]) -> str:
+        return (moment + self.offset).strftime("%d.%m.%Y %H:%M") if moment else "без даты"
+
+    async def export(self, path: str) -> dict:
+        """Записать архив в path; возвращает число выгруженных строк по разделам"""
+        archive = _ZipStream(path)
+        try:
+            categories = await self._load_categories()
+            await self._write_categories(archive, categories)
+            for number, category in enumerate(categories, 1):
+                await self._write_category_markdown(archive, number, category)
+            await self._write_jsonl(archive, "notes.jsonl", select(*NOTE_COLUMNS).where(
+                (Note.user_id == self.user_id) & (Note.is_deleted == False)
+            ), Note.id)
+            await self._write_jsonl(archive, "attachments.jsonl", select(
+                NoteAttachment.id, NoteAttachment.note_id, NoteAttachment.position,
+                NoteAttachment.media_type, NoteAttachment.media_file_id
+            ).join(Note, Note.id == NoteAttachment.note_id).where(
+                (Note.user_id == self.user_id) & (Note.is_deleted == False)
+            ), NoteAttachment.id)
+            await self._write_jsonl(archive, "sessions.jsonl", select(*SESSION_COLUMNS).where(
+                ReadingSession.user_id == self.user_id
+            ), ReadingSession.id)
+            await self._write_jsonl(archive, "daily_stats.jsonl", select(*DAILY_COLUMNS).where(
+                DailyReadingStats.user_id == self.user_id
+            ), DailyReadingStats.id)
+            await self._write_jsonl(archive, "hourly_stats.jsonl", select(*HOURLY_COLUMNS).where(
+                HourlyReadingStats.user_id == self.user_id
+            ), HourlyReadingStats.id)
+            await self._write_readme(archive)
+        finally:
+            await archive.close()
+        return self.counts
+
+    async def _load_categories(self) -> list:
+        # Категорий у пользователя немного - читаем одним запросом
+        async with self.session_factory() as session:
+            result = await session.execute(
+                select(Category.id, Category.name, Category.created_at, Category.total_reading_time,
+                       Category.reading_sessions_count, Category.last_read_at)
+                .where(Category.user_id == self.user_id)
+                .order_by(Category.id)
+            )
+            return result.all()
+
+    async def _write_categories(self, archive: _ZipStream, categories: list):
+        async with archive.entry("categories.json") as write:
+            await write(json.dumps(
+                {"format_version": EXPORT_FORMAT_VERSION,
+                 "categories": [{key: _json_value(value) for key, value in row._mapping.items()}
+                                for row in categories]},
+                ensure_ascii=False, indent=2
+            ))
+        self.counts["categories"] = len(categories)
+
+    async def _write_category_markdown(self, archive: _ZipStream, number: int, category):
+        query = select(*NOTE_COLUMNS).where(
+            (Note.category_id == category.id) & (Note.is_deleted == False)
+        )
+        note_number = 0
+        async with archive.entry(category_file_name(number, category.name)) as write:
+            await write(f"# {category.name}\n\n")
+            async for rows in iter_windows(query, Note.id, self.session_factory):
+                parts = []
+                for note in rows:
+                    note_number += 1
+                    parts.append(self._note_markdown(note_number, note))
+                await write("".join(parts))
+                await self._advance(len(rows))
+            if not note_number:
+                await write("_Заметок нет._\n")
+
+    def _note_markdown(self, number: int, note) -> str:
+        title = f"## {number}. {self._local(note.created_at)}"
+        if note.media_type == MediaType.TEXT:
+            return f"{title}\n\n{note.content or ''}\n\n"
+        kind = (f"🖼️ Альбом ({note.attachments_count} шт.)" if note.attachments_count
+                else MEDIA_TITLES.get(note.media_type, "📎 Медиа"))
+        text = note.media_caption or note.content or ""
+        return f"{title} · {kind}\n\n{text}\n\n`file_id: {note.media_file_id}`\n\n"
+
+    async def _write_jsonl(self, archive: _ZipStream, name: str, query, id_column):
+        count = 0
+        async with archive.entry(name) as write:
+            async for rows in iter_windows(query, id_column, self.session_factory):
+                await write("".join(json_line(row) for row in rows))
+                count += len(rows)
+                await self._advance(len(rows))
+        self.counts[name.split(".")[0]] = count
+
+    async def _write_readme(self, archive: _ZipStream):
+        counts = self.counts
+        async with archive.entry("README.md") as write:
+            await write(
+                "# Экспорт HSEBookNotes\n\n"
+                f"Создан: {self._local(datetime.utcnow())}\n\n"
+                f"- Категорий: {counts.get('categories', 0)}\n"
+                f"- Заметок: {counts.get('notes', 0)} (частей альбомов: {counts.get('attachments', 0)})\n"
+                f"- Сессий чтения: {counts.get('sessions', 0)}\n"
+                f"- Дней статистики: {counts.get('daily_stats', 0)}\n\n"
+                "Заметки по категориям - в папке `notes/`. Файлы `.jsonl` содержат по\n"
+                "одному JSON-объекту на строку (даты в UTC); медиа хранятся как file_id Telegram.\n"
+            )
@@ -0,0 +1,254 @@
+﻿"""
+Локальная замена Telegram Bot API для нагрузочного тестирования (aiohttp)
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+BOT_USER = {"id": 8350095060, "is_bot": True, "first_name": "HSEBookNotes (fake)", "username": "fake_notes_bot"}
+# Больше getFile не отдает: Bot API отвечает "file is too big"
+GET_FILE_MAX_BYTES = 20 * 1024 * 1024
+
+# Методы, которые возвращают отправленное сообщение, и поле с медиа
+SEND_METHODS = {
+    "sendMessage": None,
+    "sendPhoto": "photo",
+    "sendVideo": "video",
+    "sendVoice": "voice",
+    "sendDocument": "document",
+}
+
+
+class FakeBotAPI:
+    """Имитирует ответы Bot API и запоминает, что бот отправил в каждый чат.
+
+    latency_ms - диапазон (мин, макс) искусственной задержки ответа;
+    rate_limit_ratio - доля запросов, на которые отвечаем 429 Too Many Requests.
+    """
+
+    def __init__(self, latency_ms: Tuple[float, float] = (20.0, 80.0), rate_limit_ratio: float = 0.0,
+                 retry_after: int = 1, seed: Optional[int] = None):
+        self.latency_ms = latency_ms
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls: Counter = Counter()
+        self.rate_limited: Counter = Counter()
+        # chat_id -> message_id -> сообщение
+        self.chats: Dict[int, Dict[int, Dict[str, Any]]] = defaultdict(dict)
+        self._message_ids: Dict[int, int] = defaultdict(int)
+        self._file_counter = 0
+        # file_id -> содержимое для getFile и скачивания (остальные файлы генерируются)
+        self.files: Dict[str, bytes] = {}
+        self._runner: Optional[web.AppRunner] = None
+        self.url: Optional[str] = None
+
+    # ===========================================
+    # СОСТОЯНИЕ ЧАТОВ
+    # ===========================================
+    def next_message_id(self, chat_id: int) -> int:
+        """Общая нумерация сообщений чата (и пользователя, и бота)"""
+        self._message_ids[chat_id] += 1
+        return self._message_ids[chat_id]
+
+    def find_button(self, chat_id: int, prefix: str) -> Optional[Tuple[Dict[str, Any], str]]:
+        """Последнее сообщение бота с inline-кнопкой, callback_data которой начинается с prefix"""
+        for message_id in sorted(self.chats[chat_id], reverse=True):
+            message = self.chats[chat_id][message_id]
+            markup = message.get("reply_markup") or {}
+            for row in markup.get("inline_keyboard", []):
+                for button in row:
+                    data = button.get("callback_data")
+                    if data and data.startswith(prefix):
+                        return message, data
+        return None
+
+    def _new_file_id(self, kind: str) -> Tuple[str, str]:
+        self._file_counter += 1
+        return f"fake-{kind}-{self._file_counter}", f"fake-uniq-{self._file_counter}"
+
+    def _message(self, chat_id: int, message_id: Optional[int] = None, **fields) -> Dict[str, Any]:
+        message = {
+            "message_id": message_id or self.next_message_id(chat_id),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": "User"},
+            "from": BOT_USER,
+        }
+        message.update({key: value for key, value in fields.items() if value is not None})
+        self.chats[chat_id][message["message_id"]] = message
+        # Как и настоящий API, в ответе возвращаем только inline-клавиатуру
+        markup = message.get("reply_markup")
+        if markup and "inline_keyboard" not in markup:
+            message = dict(message)
+            del message["reply_markup"]
+        return message
+
+    def _media_object(self, kind: str, value: Any) -> Any:
+        if isinstance(value, str) and not value.startswith("attach://"):
+            file_id, unique_id = value, f"uniq-{value}"
+        else:
+            file_id, unique_id = self._new_file_id(kind)
+        media = {"file_id": file_id, "file_unique_id": unique_id}
+        if kind == "photo":
+            return [dict(media, width=1280, height=960)]
+        if kind == "voice":
+            return dict(media, duration=5)
+        if kind == "video":
+            return dict(media, width=1280, height=720, duration=5)
+        return media
+
+    # ===========================================
+    # МЕТОДЫ API
+    # ===========================================
+    def handle_method(self, method: str, params: Dict[str, Any]) -> Any:
+        chat_id = int(params["chat_id"]) if "chat_id" in params else None
+        reply_markup = _json_param(params.get("reply_markup"))
+
+        if method == "getMe":
+            return BOT_USER
+        if method in SEND_METHODS:
+            media_field = SEND_METHODS[method]
+            media = self._media_object(media_field, params.get(media_field)) if media_field else None
+            fields = {"text": params.get("text"), "caption": params.get("caption"), "reply_markup": reply_markup}
+            if media_field:
+                fields[media_field] = media
+            return self._message(chat_id, **fields)
+        if method == "getFile":
+            file_id = params["file_id"]
+            if len(self.file_content(file_id)) > GET_FILE_MAX_BYTES:
+                raise ValueError("file is too big")
+            return {
+                "file_id": file_id,
+                "file_unique_id": f"uniq-{file_id}",
+                "file_size": len(self.file_content(file_id)),
+                "file_path": f"files/{file_id}",
+            }
+        if method == "sendMediaGroup":
+            result = []
+            for item in _json_param(params.get("media")) or []:
+                kind = item.get("type", "photo")
+                result.append(self._message(
+                    chat_id, caption=item.get("caption"), **{kind: self._media_object(kind, item.get("media"))}
+                ))
+            return result
+        if method in ("editMessageText", "editMessageReplyMarkup", "editMessageCaption"):
+            message_id = int(params["message_id"])
+            message = self.chats[chat_id].get(message_id) or {}
+            fields = dict(message)
+            for key in ("text", "caption"):
+                if key in params:
+                    fields[key] = params[key]
+            fields["reply_markup"] = reply_markup
+            fields.pop("message_id", None)
+            return self._message(chat_id, message_id=message_id, **fields)
+        if method == "deleteMessage":
+            self.chats[chat_id].pop(int(params["message_id"]), None)
+            return True
+        # answerCallbackQuery, deleteWebhook, setMyCommands и прочие
+        return True
+
+    def file_content(self, file_id: str) -> bytes:
+        """Содержимое файла для getFile и скачивания (по умолчанию - из file_id)"""
+        content = self.files.get(file_id)
+        if content is None:
+            content = f"fake file {file_id}\n".encode() * 64
+        return content
+
+    async def _handle_file(self, request: web.Request) -> web.Response:
+        self.calls["downloadFile"] += 1
+        path = request.match_info["path"]
+        if not path.startswith("files/"):
+            raise web.HTTPNotFound()
+        return web.Response(body=self.file_content(path[len("files/"):]))
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        params = dict(await request.post()) if request.can_read_body else {}
+        params.update(request.query)
+
+        low, high = self.latency_ms
+        await asyncio.sleep(self.random.uniform(low, high) / 1000)
+
+        if method != "getMe" and self.random.random() < self.rate_limit_ratio:
+            self.rate_limited[method] += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+
+        try:
+            result = self.handle_method(method, params)
+        except (KeyError, ValueError) as e:
+            return web.json_response(
+                {"ok": False, "error_code": 400, "description": f"Bad Request: {e}"}, status=400
+            )
+        return web.json_response({"ok": True, "result": result})
+
+    # ===========================================
+    # ЗАПУСК
+    # ===========================================
+    def create_app(self) -> web.Application:
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self._handle)
+        app.router.add_get("/file/bot{token}/{path:.+}", self._handle_file)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8081) -> str:
+        self._runner = web.AppRunner(self.create_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        if port == 0:
+            port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def summary(self) -> List[str]:
+        lines = []
+        for method, count in self.calls.most_common():
+            limited = self.rate_limited.get(method, 0)
+            lines.append(f"  {method}: {count}" + (f" (429: {limited})" if limited else ""))
+        return lines
+
+
+def _json_param(value: Any) -> Any:
+    if isinstance(value, str) and value[:1] in "[{":
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    return value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальный фейковый Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, nargs=2, default=(20.0, 80.0), metavar=("MIN", "MAX"))
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0)
+    args = parser.parse_args()
+
+    async def main():
+        fake = FakeBotAPI(tuple(args.latency_ms), args.rate_limit_ratio)
+        url = await fake.start(args.host, args.port)
+        print(f"🧪 Фейковый Bot API: {url}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await fake.stop()
+
+    asyncio.run(main())
@@ -0,0 +1,213 @@
+﻿"""
+Импорт заметок из файлов: Markdown, текст с разделителем, CSV, JSON и JSON Lines
+"""
+import asyncio
+import csv
+import itertools
+import json
+import os
+import re
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Iterator, Optional, Tuple
+
+from sqlalchemy import insert
+
+from init_db import AsyncSessionLocal, MediaType, Note
+
+# Больше 20 МБ бот скачать из Telegram не может
+IMPORT_MAX_BYTES = 20 * 1024 * 1024
+# Заметок в одной транзакции (один executemany)
+IMPORT_CHUNK = 500
+
+# Расширение файла -> формат
+IMPORT_FORMATS = {
+    ".md": "markdown",
+    ".markdown": "markdown",
+    ".txt": "text",
+    ".csv": "csv",
+    ".json": "json",
+    ".jsonl": "jsonl",
+    ".ndjson": "jsonl",
+}
+
+# Поля с текстом заметки и датой в CSV и JSON (регистр не важен)
+CONTENT_FIELDS = ("content", "text", "note", "body", "заметка", "текст")
+DATE_FIELDS = ("created_at", "created", "date", "дата")
+
+# Заголовок Markdown и разделитель --- / *** / ___
+_HEADING_RE = re.compile(r"^\s{0,3}#{1,6}\s+")
+_BREAK_RE = re.compile(r"^\s{0,3}([-*_])(\s*\1){2,}\s*$")
+_FENCE_RE = re.compile(r"^\s{0,3}(```|~~~)")
+
+ImportedNote = Tuple[str, Optional[datetime]]
+Progress = Callable[[int], Awaitable[None]]
+
+
+def import_format(file_name: str) -> Optional[str]:
+    """Формат по расширению файла; None, если такой файл не поддерживается"""
+    return IMPORT_FORMATS.get(os.path.splitext(file_name or "")[1].lower())
+
+
+def parse_date(value) -> Optional[datetime]:
+    """Дата из ISO-строки (в UTC без часового пояса, как в БД); None, если не разобрать"""
+    if not isinstance(value, str) or not value.strip():
+        return None
+    try:
+        moment = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def _pick(fields: dict, names) -> Optional[str]:
+    folded = {str(key).casefold(): value for key, value in fields.items()}
+    return next((folded[name] for name in names if folded.get(name) not in (None, "")), None)
+
+
+class NoteReader:
+    """Потоковый разбор файла: итератор по (текст, дата создания или None).
+
+    Файл читается построчно (JSON-массив - целиком, он не больше
+    IMPORT_MAX_BYTES); пустые и неразобранные записи пропускаются и
+    считаются в skipped
+    """
+
+    def __init__(self, path: str, fmt: str, delimiter: Optional[str] = None):
+        self.path = path
+        self.fmt = fmt
+        self.delimiter = delimiter
+        self.skipped = 0
+
+    def __iter__(self) -> Iterator[ImportedNote]:
+        with open(self.path, encoding="utf-8-sig", errors="replace", newline="") as file:
+            for text, created_at in getattr(self, f"_read_{self.fmt}")(file):
+                text = (text or "").strip()
+                if text:
+                    yield text, created_at
+                else:
+                    self.skipped += 1
+
+    def _read_markdown(self, file) -> Iterator[ImportedNote]:
+        """Новая заметка - с каждого заголовка или после разделителя ---"""
+        lines = []
+        in_fence = False
+        for line in file:
+            line = line.rstrip("\r\n")
+            if _FENCE_RE.match(line):
+                in_fence = not in_fence
+            elif not in_fence and (_HEADING_RE.match(line) or _BREAK_RE.match(line)):
+                if lines:
+                    yield "\n".join(lines), None
+                lines = []
+                if _BREAK_RE.match(line):
+                    continue
+                line = _HEADING_RE.sub("", line)
+            lines.append(line)
+        if lines:
+            yield "\n".join(lines), None
+
+    def _read_text(self, file) -> Iterator[ImportedNote]:
+        """Заметки разделены строкой-разделителем, а без него - пустыми строками"""
+        lines = []
+        for line in file:
+            line = line.rstrip("\r\n")
+            is_break = line.strip() == self.delimiter if self.delimiter else not line.strip()
+            if is_break:
+                if lines:
+                    yield "\n".join(lines), None
+                lines = []
+            else:
+                lines.append(line)
+        if lines:
+            yield "\n".join(lines), None
+
+    def _read_csv(self, file) -> Iterator[ImportedNote]:
+        """Колонка текста по заголовку; без заголовка - все ячейки строки через тире"""
+        rows = csv.reader(file)
+        header = next(rows, None)
+        if header is None:
+            return
+        names = [cell.strip().casefold() for cell in header]
+        content_column = next((names.index(name) for name in CONTENT_FIELDS if name in names), None)
+        if content_column is None:
+            rows = itertools.chain([header], rows)
+            for row in rows:
+                yield " — ".join(cell.strip() for cell in row if cell.strip()), None
+            return
+        date_column = next((names.index(name) for name in DATE_FIELDS if name in names), None)
+        for row in rows:
+            text = row[content_column] if content_column < len(row) else ""
+            created_at = row[date_column] if date_column is not None and date_column < len(row) else None
+            yield text, parse_date(created_at)
+
+    def _read_item(self, item) -> ImportedNote:
+        if isinstance(item, str):
+            return item, None
+        if not isinstance(item, dict):
+            return "", None
+        # Медиа-заметки из /export без файла не восстановить
+        if item.get("media_type") not in (None, MediaType.TEXT.value):
+            return "", None
+        text = _pick(item, CONTENT_FIELDS)
+        return text if isinstance(text, str) else "", parse_date(_pick(item, DATE_FIELDS))
+
+    def _read_json(self, file) -> Iterator[ImportedNote]:
+        """Массив строк или объектов; или объект с массивом в поле notes"""
+        try:
+            data = json.load(file)
+        except ValueError:
+            self.skipped += 1
+            return
+        if isinstance(data, dict):
+            data = data.get("notes", [])
+        for item in data if isinstance(data, list) else []:
+            yield self._read_item(item)
+
+    def _read_jsonl(self, file) -> Iterator[ImportedNote]:
+        """Один объект на строку (notes.jsonl из /export тоже подходит)"""
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                yield "", None
+                continue
+            yield self._read_item(item)
+
+
+async def import_notes(user_id: int, category_id: int, reader: NoteReader,
+                       progress: Optional[Progress] = None, session_factory=AsyncSessionLocal) -> dict:
+    """Записать заметки из reader в категорию пачками по IMPORT_CHUNK.
+
+    Файл разбирается в пуле потоков (по пачке за раз), каждая пачка
+    вставляется одним executemany и своей короткой транзакцией
+    """
+    started = time.perf_counter()
+    notes = iter(reader)
+    imported = 0
+    while True:
+        batch = await asyncio.to_thread(lambda: list(itertools.islice(notes, IMPORT_CHUNK)))
+        if not batch:
+            break
+        now = datetime.utcnow()
+        async with session_factory() as session:
+            await session.execute(insert(Note), [
+                {
+                    "user_id": user_id,
+                    "category_id": category_id,
+                    "content": text,
+                    "media_type": MediaType.TEXT,
+                    "created_at": created_at or now,
+                    "is_deleted": False,
+                }
+                for text, created_at in batch
+            ])
+            await session.commit()
+        imported += len(batch)
+        if progress is not None:
+            await progress(imported)
+    return {"imported": imported, "skipped": reader.skipped, "seconds": time.perf_counter() - started}
@@ -3,12 +3,18 @@
 """
 import asyncio
 import enum
+import html
 import os
+import re
 import shutil
-from datetime import datetime
+from datetime import datetime, timedelta
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import declarative_base
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Boolean, Enum, Float, select, update, text
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Boolean, Enum, Float, select, update, text, insert, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from accounting import ReadingLedger
+from note_writer import WriteBehindQueue
 
 # ===========================================
 # Определение Enum для типов медиа
@@ -50,10 +56,55 @@ class Note(Base):
     media_caption = Column(Text, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     is_deleted = Column(Boolean, default=False)
-    
+    deleted_at = Column(DateTime, nullable=True)
+
+    # Альбом: число вложений в note_attachments (0 - обычная заметка);
+    # media_type и media_file_id у альбома - от первой части
+    attachments_count = Column(Integer, default=0)
+
     # Связь с сессией чтения
     reading_session_id = Column(Integer, ForeignKey('reading_sessions.id'), nullable=True)
 
+class NoteAttachment(Base):
+    __tablename__ = 'note_attachments'
+
+    id = Column(Integer, primary_key=True)
+    note_id = Column(Integer, ForeignKey('notes.id'), nullable=False)
+
+    # Порядок части в альбоме, начиная с 0
+    position = Column(Integer, nullable=False)
+    media_type = Column(Enum(MediaType), nullable=False)
+    media_file_id = Column(String(500), nullable=False)
+
+class MediaBlob(Base):
+    __tablename__ = 'media_blobs'
+    
+    # Содержимое файла в локальном архиве лежит по пути из его sha256
+    sha256 = Column(String(64), primary_key=True)
+    size = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # Последнее обращение - для вытеснения по LRU при превышении квоты
+    last_used_at = Column(DateTime, default=datetime.utcnow)
+
+class MediaFile(Base):
+    __tablename__ = 'media_files'
+    
+    # Файл Telegram, уже скачанный в архив: разные file_id одного файла
+    # (и разные файлы с одинаковым содержимым) ведут к одному blob
+    file_id = Column(String(500), primary_key=True)
+    file_unique_id = Column(String(100), nullable=False)
+    sha256 = Column(String(64), nullable=False)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+class MediaFailure(Base):
+    __tablename__ = 'media_failures'
+
+    # Файл, который Telegram отказался отдавать (больше 20 МБ, неверный
+    # file_id): досылка его больше не ставит в очередь
+    file_id = Column(String(500), primary_key=True)
+    error = Column(String(500), nullable=False)
+    failed_at = Column(DateTime, default=datetime.utcnow)
+
 class ReadingSession(Base):
     __tablename__ = 'reading_sessions'
     
@@ -98,38 +149,104 @@ class DailyReadingStats(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+class StatsRebuild(Base):
+    __tablename__ = 'stats_rebuilds'
+    __table_args__ = {'sqlite_autoincrement': True}
+    
+    # Журнал пересчетов статистики: строки daily_reading_stats создаются
+    # заново с новыми id, и export_analytics.py по журналу заменяет уже
+    # выгруженные строки пользователя
+    id = Column(Integer, primary_key=True)
+    # NULL - пересчет всех пользователей
+    user_id = Column(Integer, nullable=True)
+    rebuilt_at = Column(DateTime, default=datetime.utcnow)
+
+class UserSettings(Base):
+    __tablename__ = 'user_settings'
+    
+    user_id = Column(Integer, primary_key=True)
+    
+    # Часовой пояс: смещение местного времени от UTC в минутах
+    utc_offset_minutes = Column(Integer, default=0, nullable=False)
+    
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class HourlyReadingStats(Base):
+    __tablename__ = 'hourly_reading_stats'
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    
+    # День (полночь) и час суток 0-23
+    date = Column(DateTime, nullable=False)
+    hour = Column(Integer, nullable=False)
+    
+    total_seconds = Column(Float, default=0.0)
+
+class ReadingRollup(Base):
+    __tablename__ = 'reading_rollups'
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    # 0 - итог по всем категориям пользователя
+    category_id = Column(Integer, nullable=False, default=0)
+    
+    # week - с местного понедельника, month - с 1-го числа
+    period = Column(String(10), nullable=False)
+    period_start = Column(DateTime, nullable=False)
+    
+    # Итоги за период (суммы дневной статистики)
+    total_seconds = Column(Float, default=0.0)
+    sessions_count = Column(Integer, default=0)
+    notes_count = Column(Integer, default=0)
+    
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
 # ===========================================
 # НАСТРОЙКА БАЗЫ ДАННЫХ
 # ===========================================
-DATABASE_URL = "sqlite+aiosqlite:///./notes.db"
+# Путь к файлу БД можно переопределить (нагрузочные тесты, бенчмарки)
+DATABASE_PATH = os.getenv("NOTES_DB_PATH", "notes.db")
+DATABASE_URL = f"sqlite+aiosqlite:///{DATABASE_PATH}"
 
-engine = create_async_engine(DATABASE_URL, echo=True)
+# Печать каждого SQL-запроса; для измерений используйте sql_profiler (DB_ECHO=0)
+DB_ECHO = os.getenv("DB_ECHO", "1") == "1"
+
+engine = create_async_engine(DATABASE_URL, echo=DB_ECHO)
 AsyncSessionLocal = async_sessionmaker(
     engine, class_=AsyncSession, expire_on_commit=False
 )
 
+# Заметки пишутся пачками: одна транзакция на все заметки, пришедшие, пока
+# записывалась предыдущая пачка. NOTE_FLUSH_INTERVAL > 0 добавляет к этому
+# ожидание (пока не наберется NOTE_MAX_BATCH), 0 - писать без задержки
+NOTE_FLUSH_INTERVAL = 0.0
+NOTE_MAX_BATCH = 200
+note_write_queue = WriteBehindQueue(AsyncSessionLocal, NOTE_FLUSH_INTERVAL, NOTE_MAX_BATCH)
+
 # ===========================================
 # ФУНКЦИИ ИНИЦИАЛИЗАЦИИ БАЗЫ ДАННЫХ
 # ===========================================
 async def backup_database():
     """Создание резервной копии базы данных"""
-    if os.path.exists("notes.db"):
-        if not os.path.exists("backups"):
-            os.makedirs("backups")
+    if os.path.exists(DATABASE_PATH):
+        backups_dir = os.path.join(os.path.dirname(DATABASE_PATH), "backups")
+        if not os.path.exists(backups_dir):
+            os.makedirs(backups_dir)
         
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_file = f"backups/notes_backup_{timestamp}.db"
+        backup_file = os.path.join(backups_dir, f"notes_backup_{timestamp}.db")
         
         try:
-            shutil.copy2("notes.db", backup_file)
+            shutil.copy2(DATABASE_PATH, backup_file)
             print(f"✅ Создана резервная копия: {backup_file}")
             
             # Удаляем старые бэкапы (оставляем последние 3)
-            backups = sorted([f for f in os.listdir("backups") if f.startswith("notes_backup_")])
+            backups = sorted([f for f in os.listdir(backups_dir) if f.startswith("notes_backup_")])
             if len(backups) > 3:
                 for old_backup in backups[:-3]:
                     try:
-                        os.remove(f"backups/{old_backup}")
+                        os.remove(os.path.join(backups_dir, old_backup))
                         print(f"🗑️ Удален старый бэкап: {old_backup}")
                     except:
                         pass
@@ -169,6 +286,9 @@ async def init_db():
     # Создаем резервную копию
     await backup_database()
     
+    # Режим auto_vacuum нужно выбрать до создания таблиц
+    await enable_incremental_vacuum()
+    
     async with engine.begin() as conn:
         # Создаем все таблицы
         await conn.run_sync(Base.metadata.create_all)
@@ -176,6 +296,12 @@ async def init_db():
     # Обновляем существующие таблицы (миграция)
     await update_existing_tables()
     
+    # Итоги по неделям и месяцам для БД, созданных до их появления
+    await backfill_reading_rollups()
+    
+    # Полнотекстовый индекс заметок
+    await setup_fulltext_search()
+    
     # Проверяем целостность
     await check_data_consistency()
     
@@ -183,6 +309,22 @@ async def init_db():
     print("✅ ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ ЗАВЕРШЕНА")
     print("=" * 50)
 
+async def enable_incremental_vacuum():
+    """Включение auto_vacuum=INCREMENTAL: место от удаленных строк возвращает maintenance.py"""
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        try:
+            if (await conn.execute(text("PRAGMA auto_vacuum"))).scalar() == 2:
+                return
+            await conn.execute(text("PRAGMA auto_vacuum = INCREMENTAL"))
+            # В существующей БД режим меняется только после полного VACUUM
+            # (один раз; резервная копия к этому моменту уже сделана)
+            print("🧹 Включаем инкрементальный VACUUM...")
+            await conn.execute(text("VACUUM"))
+            print("✅ Инкрементальный VACUUM включен")
+        except Exception as e:
+            print(f"⚠️ Не удалось включить инкрементальный VACUUM: {e}")
+
 async def update_existing_tables():
     """Обновление существующих таблиц (миграция)"""
     print("🔄 Обновление существующих таблиц...")
@@ -196,7 +338,9 @@ async def update_existing_tables():
     
     # Список колонок для добавления в таблицу notes
     note_columns = [
-        ('reading_session_id', 'INTEGER')
+        ('reading_session_id', 'INTEGER'),
+        ('deleted_at', 'DATETIME'),
+        ('attachments_count', 'INTEGER DEFAULT 0')
     ]
     
     # Список колонок для добавления в таблицу reading_sessions
@@ -216,6 +360,199 @@ async def update_existing_tables():
         
         # Обновляем таблицу reading_sessions
         await add_columns_to_table(conn, 'reading_sessions', session_columns)
+        
+        # Индексы (create_all создает их только для новых таблиц)
+        await create_indexes(conn, INDEXES)
+        
+        # Upsert статистики опирается на уникальные индексы; дубликаты дней,
+        # которые могли появиться раньше, сначала сливаем в одну строку
+        await merge_duplicate_daily_stats(conn)
+        await create_indexes(conn, UNIQUE_INDEXES, unique=True)
+        
+        # Вложения альбома стираются вместе с заметкой, кто бы ее ни удалил
+        # (обслуживание БД, удаление категории)
+        await conn.execute(text(ATTACHMENTS_CLEANUP_TRIGGER_SQL))
+
+# Индексы, которые нужны и в уже существующих БД
+INDEXES = [
+    # Список категорий пользователя по последней активности (выбор категории)
+    ('ix_categories_user_activity',
+     'categories (user_id, COALESCE(last_read_at, created_at) DESC, id DESC)'),
+    # Заметки категории: просмотр, счетчик перед удалением, удаление пачками
+    ('ix_notes_category', 'notes (category_id, is_deleted)'),
+    # Заметки и сессии пользователя за период (статистика, серия дней)
+    ('ix_notes_user_created', 'notes (user_id, created_at)'),
+    ('ix_reading_sessions_user_start', 'reading_sessions (user_id, start_time)'),
+    # Части альбома по порядку (просмотр, удаление вместе с заметкой)
+    ('ix_note_attachments_note', 'note_attachments (note_id, position)'),
+    # Локальный архив медиа: повторы одного файла и вытеснение по LRU
+    ('ix_media_files_unique', 'media_files (file_unique_id)'),
+    ('ix_media_blobs_last_used', 'media_blobs (last_used_at)'),
+    # Итоги периода по всем пользователям подряд - сборка рейтингов (/top)
+    ('ix_reading_rollups_period', 'reading_rollups (period, period_start, user_id, category_id)'),
+]
+
+ATTACHMENTS_CLEANUP_TRIGGER_SQL = """
+CREATE TRIGGER IF NOT EXISTS note_attachments_ad AFTER DELETE ON notes
+WHEN COALESCE(old.attachments_count, 0) > 0 BEGIN
+    DELETE FROM note_attachments WHERE note_id = old.id;
+END
+"""
+
+# Уникальные индексы - ключи ON CONFLICT для статистики чтения
+UNIQUE_INDEXES = [
+    ('ux_daily_reading_stats_user_date', 'daily_reading_stats (user_id, date)'),
+    ('ux_hourly_reading_stats_user_date_hour', 'hourly_reading_stats (user_id, date, hour)'),
+    # Он же - индекс для /stats week|month|year (периоды пользователя подряд)
+    ('ux_reading_rollups_key', 'reading_rollups (user_id, period, period_start, category_id)'),
+]
+
+async def create_indexes(conn, indexes, unique: bool = False):
+    """Создание недостающих индексов"""
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    for index_name, definition in indexes:
+        try:
+            await conn.execute(text(f"CREATE {kind} IF NOT EXISTS {index_name} ON {definition}"))
+        except Exception as e:
+            print(f"⚠️ Ошибка при создании индекса '{index_name}': {e}")
+
+# Суммируемые колонки дневной статистики
+DAILY_SUM_COLUMNS = (
+    'total_seconds', 'sessions_count', 'notes_count',
+    'morning_seconds', 'afternoon_seconds', 'evening_seconds', 'night_seconds'
+)
+# Суммируемые колонки недельных и месячных итогов
+ROLLUP_SUM_COLUMNS = ('total_seconds', 'sessions_count', 'notes_count')
+
+async def merge_duplicate_daily_stats(conn):
+    """Слияние нескольких строк статистики за один день в одну"""
+    try:
+        result = await conn.execute(text("""
+            SELECT COUNT(*) FROM (
+                SELECT 1 FROM daily_reading_stats GROUP BY user_id, date HAVING COUNT(*) > 1
+            )
+        """))
+        duplicates = result.scalar()
+        if not duplicates:
+            return
+        print(f"🔀 Сливаем дубликаты дневной статистики: {duplicates} дней...")
+        sums = ", ".join(
+            f"{column} = (SELECT SUM({column}) FROM daily_reading_stats x "
+            f"WHERE x.user_id = daily_reading_stats.user_id AND x.date = daily_reading_stats.date)"
+            for column in DAILY_SUM_COLUMNS
+        )
+        await conn.execute(text(f"""
+            UPDATE daily_reading_stats SET {sums}
+            WHERE id IN (
+                SELECT MIN(id) FROM daily_reading_stats GROUP BY user_id, date HAVING COUNT(*) > 1
+            )
+        """))
+        await conn.execute(text("""
+            DELETE FROM daily_reading_stats
+            WHERE id NOT IN (SELECT MIN(id) FROM daily_reading_stats GROUP BY user_id, date)
+        """))
+        print("✅ Дубликаты дневной статистики слиты")
+    except Exception as e:
+        print(f"⚠️ Ошибка при слиянии дневной статистики: {e}")
+
+# Полнотекстовый поиск: внешний FTS5-индекс над notes.content и media_caption.
+# В индексе только неудаленные заметки; синхронизацию держат триггеры.
+# user_id тоже индексируется: условие user_id:"N" пересекается со списками
+# совпадений внутри FTS5, и чужие заметки не попадают в ранжирование.
+# prefix='2 3' строит префиксные индексы, чтобы запросы "слово*" не
+# перебирали весь словарь
+FTS_TABLE_SQL = """
+CREATE VIRTUAL TABLE notes_fts USING fts5(
+    user_id, content, media_caption,
+    content='notes', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2',
+    prefix='2 3'
+)
+"""
+
+# remove_diacritics работает только для латиницы, поэтому ё -> е сворачиваем
+# сами: в индекс пишем свернутый текст, а поисковый запрос сворачиваем так же
+def _fold_yo(column: str) -> str:
+    return f"replace(replace({column}, 'ё', 'е'), 'Ё', 'Е')"
+
+def _fts_row(prefix: str) -> str:
+    return (f"{prefix}.id, {prefix}.user_id, "
+            f"{_fold_yo(prefix + '.content')}, {_fold_yo(prefix + '.media_caption')}")
+
+FTS_TRIGGERS_SQL = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS notes_fts_ai AFTER INSERT ON notes
+    WHEN NOT COALESCE(new.is_deleted, 0) BEGIN
+        INSERT INTO notes_fts(rowid, user_id, content, media_caption)
+        VALUES ({_fts_row('new')});
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS notes_fts_ad AFTER DELETE ON notes
+    WHEN NOT COALESCE(old.is_deleted, 0) BEGIN
+        INSERT INTO notes_fts(notes_fts, rowid, user_id, content, media_caption)
+        VALUES ('delete', {_fts_row('old')});
+    END
+    """,
+    # Удаление старой версии и вставка новой - в одном триггере: порядок
+    # срабатывания разных триггеров SQLite не гарантирует, а вставка до
+    # удаления портит внешний индекс
+    f"""
+    CREATE TRIGGER IF NOT EXISTS notes_fts_au AFTER UPDATE OF content, media_caption, is_deleted ON notes
+    BEGIN
+        INSERT INTO notes_fts(notes_fts, rowid, user_id, content, media_caption)
+        SELECT 'delete', {_fts_row('old')}
+        WHERE NOT COALESCE(old.is_deleted, 0);
+        INSERT INTO notes_fts(rowid, user_id, content, media_caption)
+        SELECT {_fts_row('new')}
+        WHERE NOT COALESCE(new.is_deleted, 0);
+    END
+    """,
+]
+
+FTS_FILL_SQL = f"""
+INSERT INTO notes_fts(rowid, user_id, content, media_caption)
+SELECT {_fts_row('notes')} FROM notes WHERE NOT COALESCE(is_deleted, 0)
+"""
+
+async def setup_fulltext_search():
+    """Создание FTS5-индекса заметок и триггеров синхронизации"""
+    async with engine.begin() as conn:
+        try:
+            result = await conn.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type='table' AND name='notes_fts'")
+            )
+            if result.scalar() is None:
+                print("🔎 Создаем полнотекстовый индекс заметок...")
+                await conn.execute(text(FTS_TABLE_SQL))
+                # Заполняем индекс существующими заметками (кроме удаленных)
+                await conn.execute(text(FTS_FILL_SQL))
+                print("✅ Полнотекстовый индекс создан")
+            for trigger_sql in FTS_TRIGGERS_SQL:
+                await conn.execute(text(trigger_sql))
+        except Exception as e:
+            print(f"⚠️ Полнотекстовый поиск недоступен (нужен SQLite с FTS5): {e}")
+
+async def backfill_reading_rollups():
+    """Один раз собрать итоги периодов из сессий, если таблица reading_rollups пуста.
+
+    Бот еще не запущен, поэтому полный пересчет статистики безопасен. Он
+    идет одной транзакцией: после ошибки таблица остается пустой, и сборка
+    повторится при следующем запуске, а не оставит статистику обрезанной
+    """
+    async with AsyncSessionLocal() as session:
+        has_rollups = await session.scalar(select(ReadingRollup.id).limit(1))
+        has_sessions = await session.scalar(
+            select(ReadingSession.id).where(ReadingSession.is_completed == True).limit(1)
+        )
+    if has_rollups is not None or has_sessions is None:
+        return
+    print("📅 Собираем итоги чтения по неделям и месяцам...")
+    try:
+        processed = await rebuild_reading_stats(single_transaction=True)
+        print(f"✅ Итоги периодов собраны: {processed} сессий")
+    except Exception as e:
+        print(f"⚠️ Ошибка при сборке итогов периодов: {e}")
 
 async def check_data_consistency():
     """Проверка целостности данных"""
@@ -247,24 +584,45 @@ async def check_data_consistency():
 # ===========================================
 # ОСНОВНЫЕ ФУНКЦИИ ДЛЯ РАБОТЫ С БАЗОЙ ДАННЫХ
 # ===========================================
+async def insert_returning_id(session: AsyncSession, model, values: dict) -> int:
+    """Вставка одной строки через Core без unit of work ORM; возвращает id.
+
+    На SQLite >= 3.35 id приходит в ответе на INSERT ... RETURNING, на старых
+    версиях берется из lastrowid - в обоих случаях без повторного SELECT
+    """
+    table = model.__table__
+    statement = insert(table).values(values)
+    if session.bind.dialect.insert_returning:
+        result = await session.execute(statement.returning(table.c.id))
+        return result.scalar_one()
+    result = await session.execute(statement)
+    return result.inserted_primary_key[0]
+
 async def create_reading_session(user_id: int, category_id: int = None) -> ReadingSession:
     """Создание новой сессии чтения"""
+    now = datetime.utcnow()
+    # Все значения по умолчанию задаем явно: объект собирается из них,
+    # и перечитывать строку после вставки (refresh) не нужно
+    values = {
+        "user_id": user_id,
+        "category_id": category_id,
+        "start_time": now,
+        "notes_count": 0,
+        "media_notes_count": 0,
+        "created_at": now,
+        "is_completed": False,
+        "was_interrupted": False,
+    }
     async with AsyncSessionLocal() as session:
-        reading_session = ReadingSession(
-            user_id=user_id,
-            category_id=category_id,
-            start_time=datetime.utcnow(),
-            is_completed=False
-        )
-        session.add(reading_session)
+        session_id = await insert_returning_id(session, ReadingSession, values)
         await session.commit()
-        await session.refresh(reading_session)
-        
-        # Обновляем статистику категории если она указана
-        if category_id:
-            await update_category_stats_after_session_start(category_id, user_id)
-        
-        return reading_session
+    reading_session = ReadingSession(id=session_id, **values)
+    
+    # Обновляем статистику категории если она указана
+    if category_id:
+        await update_category_stats_after_session_start(category_id, user_id)
+    
+    return reading_session
 
 async def update_category_stats_after_session_start(category_id: int, user_id: int):
     """Обновление статистики категории после начала сессии"""
@@ -315,12 +673,17 @@ async def complete_reading_session(session_id: int, duration_seconds: float,
                         reading_session.user_id
                     )
                 
-                # Обновляем дневную статистику
-                await update_daily_stats(
+                # Дневная и почасовая статистика - в той же транзакции
+                ledger = ReadingLedger()
+                ledger.add_session(
                     reading_session.user_id,
-                    datetime.utcnow(),
-                    duration_seconds
+                    reading_session.start_time,
+                    duration_seconds,
+                    notes_count + media_notes_count,
+                    await get_user_utc_offset(reading_session.user_id),
+                    reading_session.category_id
                 )
+                await apply_reading_ledger(session, ledger)
                 
                 await session.commit()
                 return True
@@ -355,57 +718,125 @@ async def update_category_stats_after_session_complete(category_id: int, duratio
             print(f"⚠️ Ошибка при обновлении статистики категории: {e}")
 
 async def update_daily_stats(user_id: int, date_time: datetime, duration_seconds: float):
-    """Обновление дневной статистики"""
+    """Обновление дневной статистики сессией, закончившейся в date_time"""
+    ledger = ReadingLedger()
+    ledger.add_session(
+        user_id, date_time - timedelta(seconds=duration_seconds), duration_seconds,
+        utc_offset_minutes=await get_user_utc_offset(user_id)
+    )
     async with AsyncSessionLocal() as session:
         try:
-            # Получаем дату без времени
-            date_only = date_time.date()
-            date_only_dt = datetime.combine(date_only, datetime.min.time())
-            
-            # Определяем время дня
-            hour = date_time.hour
-            if 6 <= hour < 12:
-                time_column = "morning_seconds"
-            elif 12 <= hour < 18:
-                time_column = "afternoon_seconds"
-            elif 18 <= hour < 24:
-                time_column = "evening_seconds"
-            else:
-                time_column = "night_seconds"
-            
-            # Проверяем существование записи за этот день
-            result = await session.execute(
-                select(DailyReadingStats).where(
-                    DailyReadingStats.user_id == user_id,
-                    DailyReadingStats.date == date_only_dt
+            await apply_reading_ledger(session, ledger)
+            await session.commit()
+        except Exception as e:
+            print(f"⚠️ Ошибка при обновлении дневной статистики: {e}")
+
+def _accumulating_upsert(model, key_columns, sum_columns):
+    """INSERT ... ON CONFLICT DO UPDATE, прибавляющий новые значения к существующим"""
+    table = model.__table__
+    statement = sqlite_insert(table)
+    values = {
+        column: func.coalesce(table.c[column], 0) + statement.excluded[column]
+        for column in sum_columns
+    }
+    if 'updated_at' in table.c:
+        values['updated_at'] = statement.excluded.updated_at
+    return statement.on_conflict_do_update(index_elements=key_columns, set_=values)
+
+async def apply_reading_ledger(session: AsyncSession, ledger: ReadingLedger):
+    """Записать накопленную статистику: по одному пакетному upsert на таблицу"""
+    daily_rows = ledger.daily_rows()
+    if daily_rows:
+        await session.execute(
+            _accumulating_upsert(DailyReadingStats, ['user_id', 'date'], DAILY_SUM_COLUMNS),
+            daily_rows
+        )
+    hourly_rows = ledger.hourly_rows()
+    if hourly_rows:
+        await session.execute(
+            _accumulating_upsert(HourlyReadingStats, ['user_id', 'date', 'hour'], ['total_seconds']),
+            hourly_rows
+        )
+    rollup_rows = ledger.rollup_rows()
+    if rollup_rows:
+        await session.execute(
+            _accumulating_upsert(
+                ReadingRollup, ['user_id', 'period', 'period_start', 'category_id'], ROLLUP_SUM_COLUMNS
+            ),
+            rollup_rows
+        )
+
+async def rebuild_reading_stats(user_id: int = None, chunk: int = 5000, progress=None,
+                                single_transaction: bool = False) -> int:
+    """Пересобрать дневную, почасовую статистику и итоги периодов из завершенных сессий.
+
+    Для одного пользователя - одной транзакцией (удаление и пересчет не
+    пересекаются с его новыми сессиями); для всех - кусками по chunk сессий
+    с коммитом после каждого, тогда бот должен быть остановлен.
+    single_transaction=True и для всех пользователей пересчитывает одной
+    транзакцией: при ошибке статистика остается прежней, а не обрезанной
+    """
+    atomic = single_transaction or user_id is not None
+    daily = DailyReadingStats.__table__.delete()
+    hourly = HourlyReadingStats.__table__.delete()
+    rollups = ReadingRollup.__table__.delete()
+    offsets = {}
+    if user_id is not None:
+        daily = daily.where(DailyReadingStats.user_id == user_id)
+        hourly = hourly.where(HourlyReadingStats.user_id == user_id)
+        rollups = rollups.where(ReadingRollup.user_id == user_id)
+        offsets[user_id] = await get_user_utc_offset(user_id)
+    
+    async with AsyncSessionLocal() as session:
+        await session.execute(daily)
+        await session.execute(hourly)
+        await session.execute(rollups)
+        # В той же транзакции, что и удаление: выгрузка не увидит пересчет без записи о нем
+        session.add(StatsRebuild(user_id=user_id))
+        if user_id is None:
+            result = await session.execute(select(UserSettings.user_id, UserSettings.utc_offset_minutes))
+            offsets = dict(result.all())
+        if not atomic:
+            await session.commit()
+        
+        ledger = ReadingLedger()
+        last_id = 0
+        processed = 0
+        while True:
+            query = (
+                select(
+                    ReadingSession.id, ReadingSession.user_id, ReadingSession.start_time,
+                    ReadingSession.duration_seconds, ReadingSession.notes_count,
+                    ReadingSession.media_notes_count, ReadingSession.category_id
                 )
+                .where(ReadingSession.id > last_id, ReadingSession.is_completed == True)
+                .order_by(ReadingSession.id)
+                .limit(chunk)
             )
-            existing_record = result.scalar_one_or_none()
+            if user_id is not None:
+                query = query.where(ReadingSession.user_id == user_id)
             
-            if existing_record:
-                # Обновляем существующую запись
-                setattr(existing_record, 'total_seconds', existing_record.total_seconds + duration_seconds)
-                setattr(existing_record, 'sessions_count', existing_record.sessions_count + 1)
-                setattr(existing_record, time_column, getattr(existing_record, time_column) + duration_seconds)
-                existing_record.updated_at = datetime.utcnow()
-            else:
-                # Создаем новую запись
-                daily_stats = DailyReadingStats(
-                    user_id=user_id,
-                    date=date_only_dt,
-                    total_seconds=duration_seconds,
-                    sessions_count=1
+            rows = (await session.execute(query)).all()
+            if not rows:
+                break
+            for _, session_user_id, start_time, duration, notes, media_notes, category_id in rows:
+                ledger.add_session(
+                    session_user_id, start_time, duration or 0.0, (notes or 0) + (media_notes or 0),
+                    offsets.get(session_user_id, DEFAULT_UTC_OFFSET_MINUTES), category_id
                 )
-                
-                # Устанавливаем время дня
-                setattr(daily_stats, time_column, duration_seconds)
-                
-                session.add(daily_stats)
-            
-            await session.commit()
+            # День может попасть в несколько кусков - upsert складывает их части
+            await apply_reading_ledger(session, ledger)
+            if not atomic:
+                await session.commit()
             
-        except Exception as e:
-            print(f"⚠️ Ошибка при обновлении дневной статистики: {e}")
+            ledger.clear()
+            last_id = rows[-1][0]
+            processed += len(rows)
+            if progress is not None:
+                progress(processed)
+        
+        await session.commit()
+    return processed
 
 async def get_user_reading_stats(user_id: int, days: int = 30):
     """Получение статистики чтения пользователя"""
@@ -476,6 +907,280 @@ async def get_user_reading_stats(user_id: int, days: int = 30):
                 "daily": []
             }
 
+async def get_reading_rollups(user_id: int, period: str, first_start: datetime, last_start: datetime):
+    """Итоги периодов (week/month) с началом в [first_start, last_start].
+
+    Строки (period_start, category_id, название категории, секунды, сессии,
+    заметки): category_id = 0 - итог по всем категориям, название None -
+    категория удалена
+    """
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(
+                ReadingRollup.period_start, ReadingRollup.category_id, Category.name,
+                ReadingRollup.total_seconds, ReadingRollup.sessions_count, ReadingRollup.notes_count
+            )
+            .outerjoin(Category, Category.id == ReadingRollup.category_id)
+            .where(
+                ReadingRollup.user_id == user_id,
+                ReadingRollup.period == period,
+                ReadingRollup.period_start >= first_start,
+                ReadingRollup.period_start <= last_start
+            )
+            .order_by(ReadingRollup.period_start, ReadingRollup.category_id)
+        )
+        return result.all()
+
+# ===========================================
+# НАСТРОЙКИ ПОЛЬЗОВАТЕЛЯ (ЧАСОВОЙ ПОЯС)
+# ===========================================
+# Пока пользователь не выбрал часовой пояс, дни считаются по UTC
+DEFAULT_UTC_OFFSET_MINUTES = 0
+# Крайние часовые пояса: от UTC-12 до UTC+14
+MIN_UTC_OFFSET_MINUTES = -12 * 60
+MAX_UTC_OFFSET_MINUTES = 14 * 60
+
+# Смещения читаются при каждой статистике и завершении сессии - держим в памяти
+_utc_offsets: dict = {}
+# Значение в _utc_offsets для пользователя, который часовой пояс не выбирал
+_NO_TIMEZONE = object()
+
+async def _cached_utc_offset(user_id: int):
+    """Смещение из кэша (при промахе - из БД); _NO_TIMEZONE, если строки настроек нет"""
+    offset = _utc_offsets.get(user_id)
+    if offset is None:
+        async with AsyncSessionLocal() as session:
+            offset = await session.scalar(
+                select(UserSettings.utc_offset_minutes).where(UserSettings.user_id == user_id)
+            )
+        offset = _utc_offsets[user_id] = _NO_TIMEZONE if offset is None else offset
+    return offset
+
+async def get_user_utc_offset(user_id: int) -> int:
+    """Смещение часового пояса пользователя от UTC, минут"""
+    offset = await _cached_utc_offset(user_id)
+    return DEFAULT_UTC_OFFSET_MINUTES if offset is _NO_TIMEZONE else offset
+
+async def has_user_timezone(user_id: int) -> bool:
+    """Выбирал ли пользователь часовой пояс"""
+    return await _cached_utc_offset(user_id) is not _NO_TIMEZONE
+
+async def set_user_utc_offset(user_id: int, offset_minutes: int) -> bool:
+    """Сохранить часовой пояс; при смене пересобрать статистику пользователя.
+
+    Возвращает True, если смещение изменилось
+    """
+    previous = await get_user_utc_offset(user_id)
+    statement = sqlite_insert(UserSettings).values(
+        user_id=user_id, utc_offset_minutes=offset_minutes, updated_at=datetime.utcnow()
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=['user_id'],
+        set_={'utc_offset_minutes': statement.excluded.utc_offset_minutes,
+              'updated_at': statement.excluded.updated_at}
+    )
+    async with AsyncSessionLocal() as session:
+        await session.execute(statement)
+        await session.commit()
+    _utc_offsets[user_id] = offset_minutes
+    
+    if offset_minutes == previous:
+        return False
+    # Дни и части дня сдвинулись - пересчитываем только этого пользователя
+    await rebuild_reading_stats(user_id)
+    return True
+
+def user_now(offset_minutes: int) -> datetime:
+    """Текущее местное время пользователя"""
+    return datetime.utcnow() + timedelta(minutes=offset_minutes)
+
+def local_day_start_utc(day, offset_minutes: int) -> datetime:
+    """Начало местного дня day (date) в UTC - граница для условий по индексу"""
+    return datetime.combine(day, datetime.min.time()) - timedelta(minutes=offset_minutes)
+
+def sqlite_day_modifier(offset_minutes: int) -> str:
+    """Модификатор для date(колонка, ...): UTC -> местная дата"""
+    return f"{offset_minutes:+d} minutes"
+
+async def create_text_note(user_id: int, category_id: int, text: str, session_id: int = None) -> Note:
+    """Создание текстовой заметки"""
+    new_note = Note(
+        category_id=category_id,
+        user_id=user_id,
+        content=text,
+        media_type=MediaType.TEXT,
+        reading_session_id=session_id,
+        created_at=datetime.utcnow()
+    )
+    return await note_write_queue.submit(new_note)
+
+async def create_media_note(user_id: int, category_id: int, media_type: MediaType, 
+                           file_id: str, caption: str = "", content: str = "", session_id: int = None) -> Note:
+    """Создание медиа-заметки"""
+    new_note = Note(
+        category_id=category_id,
+        user_id=user_id,
+        content=content or caption or f"{media_type.value.capitalize()} заметка",
+        media_type=media_type,
+        media_file_id=file_id,
+        media_caption=caption,
+        reading_session_id=session_id,
+        created_at=datetime.utcnow()
+    )
+    return await note_write_queue.submit(new_note)
+
+async def create_album_note(user_id: int, category_id: int, items, caption: str = "",
+                            content: str = "", session_id: int = None) -> Note:
+    """Создание заметки-альбома: заметка и все ее части одной транзакцией.
+
+    items - список (MediaType, file_id) в порядке альбома
+    """
+    first_type, first_file_id = items[0]
+    new_note = Note(
+        category_id=category_id,
+        user_id=user_id,
+        content=content or caption or f"Альбом: {len(items)} шт.",
+        media_type=first_type,
+        media_file_id=first_file_id,
+        media_caption=caption,
+        attachments_count=len(items),
+        reading_session_id=session_id,
+        created_at=datetime.utcnow()
+    )
+    async with AsyncSessionLocal() as session:
+        session.add(new_note)
+        # flush выдает id заметки, вложения уходят тем же COMMIT
+        await session.flush()
+        session.add_all([
+            NoteAttachment(note_id=new_note.id, position=position, media_type=media_type, media_file_id=file_id)
+            for position, (media_type, file_id) in enumerate(items)
+        ])
+        await session.commit()
+    return new_note
+
+async def append_album_parts(note_id: int, items) -> int:
+    """Дописать части в конец уже сохраненного альбома; возвращает новое число частей"""
+    async with AsyncSessionLocal() as session:
+        # UPDATE первым берет блокировку записи - позиции не пересекутся
+        # с другой досылкой в тот же альбом
+        await session.execute(
+            update(Note)
+            .where(Note.id == note_id)
+            .values(attachments_count=Note.attachments_count + len(items))
+        )
+        count = (await session.execute(
+            select(Note.attachments_count).where(Note.id == note_id)
+        )).scalar_one()
+        first_position = count - len(items)
+        session.add_all([
+            NoteAttachment(note_id=note_id, position=first_position + offset,
+                           media_type=media_type, media_file_id=file_id)
+            for offset, (media_type, file_id) in enumerate(items)
+        ])
+        await session.commit()
+    return count
+
+async def get_note_attachments(note_id: int):
+    """Части альбома по порядку: список (MediaType, file_id)"""
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(NoteAttachment.media_type, NoteAttachment.media_file_id)
+            .where(NoteAttachment.note_id == note_id)
+            .order_by(NoteAttachment.position)
+        )
+        return [tuple(row) for row in result.all()]
+
+async def get_notes_attachments(note_ids) -> dict:
+    """Части альбомов для нескольких заметок одним запросом: note_id -> [(MediaType, file_id)]"""
+    attachments = {}
+    if not note_ids:
+        return attachments
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(NoteAttachment.note_id, NoteAttachment.media_type, NoteAttachment.media_file_id)
+            .where(NoteAttachment.note_id.in_(note_ids))
+            .order_by(NoteAttachment.note_id, NoteAttachment.position)
+        )
+        for note_id, media_type, file_id in result.all():
+            attachments.setdefault(note_id, []).append((media_type, file_id))
+    return attachments
+
+# ===========================================
+# ПОЛНОТЕКСТОВЫЙ ПОИСК
+# ===========================================
+SEARCH_PAGE_SIZE = 5
+SEARCH_MAX_TERMS = 8
+
+# Маркеры совпадений в snippet(): не встречаются в тексте заметок и
+# переживают html.escape, после которого заменяются на теги
+_MATCH_OPEN = "\x02"
+_MATCH_CLOSE = "\x03"
+_WORD_RE = re.compile(r"\w+")
+
+SEARCH_SQL = text("""
+SELECT n.id, n.category_id, c.name, n.media_type, n.created_at,
+       snippet(notes_fts, 1, :match_open, :match_close, '…', 12),
+       snippet(notes_fts, 2, :match_open, :match_close, '…', 12)
+FROM notes_fts
+JOIN notes n ON n.id = notes_fts.rowid
+LEFT JOIN categories c ON c.id = n.category_id
+WHERE notes_fts MATCH :match
+ORDER BY bm25(notes_fts, 0.0, 1.0, 0.5)
+LIMIT :limit OFFSET :offset
+""")
+
+def build_fts_query(user_id: int, query: str) -> str:
+    """Запрос пользователя -> выражение MATCH: все слова, каждое как префикс"""
+    terms = _WORD_RE.findall(query.lower().replace("ё", "е"))[:SEARCH_MAX_TERMS]
+    if not terms:
+        return ""
+    # Слова берем в кавычки: так операторы FTS5 (AND, NOT, NEAR) и
+    # спецсимволы из пользовательского ввода не ломают синтаксис запроса.
+    # Слова ищем только в тексте, иначе "5" совпало бы с колонкой user_id
+    words = " ".join(f'"{term}"*' for term in terms)
+    return f'user_id:"{user_id}" AND {{content media_caption}}: ({words})'
+
+async def search_notes(user_id: int, query: str, page: int = 0,
+                       page_size: int = SEARCH_PAGE_SIZE) -> dict:
+    """Поиск по заметкам пользователя с ранжированием bm25.
+
+    Возвращает {"results": [...], "has_more": bool}; snippet уже
+    экранирован для HTML, совпадения выделены тегом <b>
+    """
+    match = build_fts_query(user_id, query)
+    if not match:
+        return {"results": [], "has_more": False}
+
+    async with AsyncSessionLocal() as session:
+        # Берем на одну строку больше, чтобы узнать, есть ли следующая страница,
+        # не считая COUNT(*) по всем совпадениям
+        result = await session.execute(SEARCH_SQL, {
+            "match": match,
+            "match_open": _MATCH_OPEN,
+            "match_close": _MATCH_CLOSE,
+            "limit": page_size + 1,
+            "offset": page * page_size,
+        })
+        rows = result.all()
+
+    results = []
+    for note_id, category_id, category_name, media_type, created_at, content_snippet, caption_snippet in rows[:page_size]:
+        # Показываем фрагмент из той колонки, где нашлось совпадение
+        snippet = content_snippet or ""
+        if _MATCH_OPEN not in snippet and caption_snippet and _MATCH_OPEN in caption_snippet:
+            snippet = caption_snippet
+        snippet = html.escape(snippet)
+        snippet = snippet.replace(_MATCH_OPEN, "<b>").replace(_MATCH_CLOSE, "</b>")
+        results.append({
+            "id": note_id,
+            "category_id": category_id,
+            "category_name": category_name or "Без категории",
+            "media_type": MediaType[media_type] if media_type else MediaType.TEXT,
+            "created_at": datetime.fromisoformat(created_at) if isinstance(created_at, str) else created_at,
+            "snippet": snippet,
+        })
+    return {"results": results, "has_more": len(rows) > page_size}
+
 # ===========================================
 # ЗАПУСК МИГРАЦИИ ПРИ НЕОБХОДИМОСТИ
 # ===========================================
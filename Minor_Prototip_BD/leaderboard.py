@@ -0,0 +1,251 @@
+﻿"""
+Рейтинги чтения: места пользователей по времени за текущую неделю и месяц
+"""
+import asyncio
+from bisect import bisect_left, insort
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import and_, func, or_, select, tuple_
+
+from accounting import ALL_CATEGORIES, ROLLUP_PERIODS, period_start
+from init_db import (
+    AsyncSessionLocal, Category, DEFAULT_UTC_OFFSET_MINUTES, MAX_UTC_OFFSET_MINUTES,
+    MIN_UTC_OFFSET_MINUTES, ReadingRollup, UserSettings, get_user_utc_offset, user_now
+)
+
+# Строк итогов за одно чтение при сборке рейтингов
+LEADERBOARD_WINDOW = 5000
+# Мест в /top
+TOP_SIZE = 10
+
+BoardId = Tuple[str, str]
+
+
+def board_key(category_name: Optional[str]) -> str:
+    """Ключ рейтинга: "" - общий, иначе название книги без регистра и лишних пробелов.
+
+    Категории у каждого пользователя свои, поэтому рейтинг по книге
+    объединяет категории с одинаковым названием
+    """
+    return " ".join(category_name.split()).casefold() if category_name else ""
+
+
+class RankedScores:
+    """Участники одного рейтинга по убыванию времени.
+
+    Список пар (-секунды, user_id) упорядочен, место ищется бинарным
+    поиском за O(log n); обновление сдвигает хвост списка одним memmove,
+    что на таких объемах быстрее любого дерева на чистом Python
+    """
+
+    def __init__(self):
+        self._scores: Dict[int, float] = {}
+        self._entries: List[Tuple[float, int]] = []
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def set(self, user_id: int, seconds: float):
+        """Задать время участника; 0 - убрать его из рейтинга"""
+        old = self._scores.get(user_id)
+        if old == seconds:
+            return
+        if old is not None:
+            del self._entries[bisect_left(self._entries, (-old, user_id))]
+        if seconds > 0:
+            insort(self._entries, (-seconds, user_id))
+            self._scores[user_id] = seconds
+        else:
+            self._scores.pop(user_id, None)
+
+    def score(self, user_id: int) -> float:
+        return self._scores.get(user_id, 0.0)
+
+    def rank(self, user_id: int) -> Optional[int]:
+        """Место участника (при равном времени - одно место на всех); None - не участвует"""
+        seconds = self._scores.get(user_id)
+        if seconds is None:
+            return None
+        # Кортеж (-секунды,) меньше любой пары с тем же временем: слева - только те, у кого больше
+        return bisect_left(self._entries, (-seconds,)) + 1
+
+    def top(self, limit: int = TOP_SIZE) -> List[Tuple[int, float]]:
+        return [(user_id, -negative) for negative, user_id in self._entries[:limit]]
+
+
+class Leaderboard:
+    """Рейтинги текущих недели и месяца: общий и по каждой книге.
+
+    Текущий период у каждого пользователя свой - местная неделя (месяц) по
+    его часовому поясу, как и в reading_rollups, поэтому время, прочитанное
+    в первые часы местной недели, не теряется на границе UTC. Около смены
+    периода в одном рейтинге могут оказаться и пользователи, у которых
+    неделя уже новая, и те, у кого она еще идет.
+
+    При запуске (и со сменой периода в любом из известных часовых поясов)
+    рейтинги собираются из reading_rollups по индексу (period, period_start,
+    user_id, category_id), дальше после каждой сессии и смены часового
+    пояса обновляются строки одного пользователя
+    """
+
+    def __init__(self, session_factory=AsyncSessionLocal):
+        self.session_factory = session_factory
+        self.boards: Dict[BoardId, RankedScores] = {}
+        # Начала текущих периодов для каждого известного смещения от UTC:
+        # изменились - пора пересобрать рейтинги
+        self.generation: Dict[int, Dict[str, datetime]] = {}
+        # В каких рейтингах участвует пользователь: чтобы убрать его из
+        # рейтинга переименованной или удаленной книги
+        self._user_boards: Dict[int, Set[BoardId]] = {}
+        self._rebuild_lock = asyncio.Lock()
+        # Пользователи, обновленные во время пересборки: ее рейтинги заменят
+        # текущие, поэтому их обновления применяются заново после замены
+        self._pending_refresh: Set[int] = set()
+        # Статистика для метрик
+        self.updates = 0
+        self.rebuilds = 0
+
+    @staticmethod
+    def local_starts(offset_minutes: int) -> Dict[str, datetime]:
+        """Начала текущих местных недели и месяца для смещения от UTC"""
+        today = datetime.combine(user_now(offset_minutes).date(), datetime.min.time())
+        return {period: period_start(period, today) for period in ROLLUP_PERIODS}
+
+    @classmethod
+    def candidate_starts(cls) -> Set[Tuple[str, datetime]]:
+        """Все начала периодов, текущие хоть в одном часовом поясе (UTC-12 ... UTC+14)"""
+        return {(period, start) for offset in (MIN_UTC_OFFSET_MINUTES, 0, MAX_UTC_OFFSET_MINUTES)
+                for period, start in cls.local_starts(offset).items()}
+
+    @staticmethod
+    def _scores(rows) -> Dict[BoardId, Dict[int, float]]:
+        """Строки (период, user_id, category_id, название, секунды) -> время по рейтингам"""
+        scores: Dict[BoardId, Dict[int, float]] = {}
+        for period, user_id, category_id, name, seconds in rows:
+            if category_id == ALL_CATEGORIES:
+                key = ""
+            elif name is None:
+                # Категория удалена
+                continue
+            else:
+                key = board_key(name)
+            board = scores.setdefault((period, key), {})
+            board[user_id] = board.get(user_id, 0.0) + (seconds or 0.0)
+        return scores
+
+    async def rebuild(self):
+        """Собрать рейтинги текущих периодов заново, окнами по LEADERBOARD_WINDOW строк"""
+        async with self._rebuild_lock:
+            offset = func.coalesce(UserSettings.utc_offset_minutes, DEFAULT_UTC_OFFSET_MINUTES)
+            generation = {DEFAULT_UTC_OFFSET_MINUTES: self.local_starts(DEFAULT_UTC_OFFSET_MINUTES)}
+            boards: Dict[BoardId, RankedScores] = {}
+            user_boards: Dict[int, Set[BoardId]] = {}
+            for period, start in sorted(self.candidate_starts()):
+                after = (0, -1)
+                while True:
+                    # Каждое окно - своя короткая транзакция, чтобы не держать БД
+                    async with self.session_factory() as session:
+                        rows = (await session.execute(
+                            select(ReadingRollup.period, ReadingRollup.user_id, ReadingRollup.category_id,
+                                   Category.name, ReadingRollup.total_seconds, offset)
+                            .outerjoin(Category, Category.id == ReadingRollup.category_id)
+                            .outerjoin(UserSettings, UserSettings.user_id == ReadingRollup.user_id)
+                            .where(
+                                ReadingRollup.period == period,
+                                ReadingRollup.period_start == start,
+                                tuple_(ReadingRollup.user_id, ReadingRollup.category_id) > after
+                            )
+                            .order_by(ReadingRollup.user_id, ReadingRollup.category_id)
+                            .limit(LEADERBOARD_WINDOW)
+                        )).all()
+                    if not rows:
+                        break
+                    # В рейтинг идет только текущий местный период пользователя
+                    current = []
+                    for row in rows:
+                        starts = generation.get(row[5])
+                        if starts is None:
+                            starts = generation[row[5]] = self.local_starts(row[5])
+                        if starts[period] == start:
+                            current.append(row[:5])
+                    # Строки одного пользователя могут попасть в два окна -
+                    # его время по книге дособирается в следующем окне
+                    for board_id, users in self._scores(current).items():
+                        board = boards.setdefault(board_id, RankedScores())
+                        for user_id, seconds in users.items():
+                            board.set(user_id, board.score(user_id) + seconds)
+                            user_boards.setdefault(user_id, set()).add(board_id)
+                    after = (rows[-1][1], rows[-1][2])
+            self.boards = boards
+            self._user_boards = user_boards
+            self.generation = generation
+            self.rebuilds += 1
+            # Пересборка могла прочитать итоги этих пользователей до обновления
+            while self._pending_refresh:
+                user_id = self._pending_refresh.pop()
+                self._apply_user(user_id, await self._user_scores(user_id))
+
+    async def _ensure_current(self) -> bool:
+        """Пересобрать рейтинги, если хоть в одном поясе начался новый период; True - если пересобраны"""
+        if self.generation and all(
+            self.local_starts(offset) == starts for offset, starts in self.generation.items()
+        ):
+            return False
+        await self.rebuild()
+        return True
+
+    async def refresh_user(self, user_id: int):
+        """Обновить время пользователя во всех его рейтингах (после сессии или смены часового пояса)"""
+        if await self._ensure_current():
+            return
+        scores = await self._user_scores(user_id)
+        if self._rebuild_lock.locked():
+            # Идет пересборка: ее рейтинги заменят текущие, и обновление
+            # потерялось бы - rebuild применит его после замены
+            self._pending_refresh.add(user_id)
+            return
+        self._apply_user(user_id, scores)
+
+    async def _user_scores(self, user_id: int) -> Dict[BoardId, Dict[int, float]]:
+        """Время пользователя в его текущих местных периодах по рейтингам"""
+        offset = await get_user_utc_offset(user_id)
+        starts = self.generation.setdefault(offset, self.local_starts(offset))
+        async with self.session_factory() as session:
+            rows = (await session.execute(
+                select(ReadingRollup.period, ReadingRollup.user_id, ReadingRollup.category_id,
+                       Category.name, ReadingRollup.total_seconds)
+                .outerjoin(Category, Category.id == ReadingRollup.category_id)
+                .where(
+                    ReadingRollup.user_id == user_id,
+                    or_(*(and_(ReadingRollup.period == period, ReadingRollup.period_start == start)
+                          for period, start in starts.items()))
+                )
+            )).all()
+        return self._scores(rows)
+
+    def _apply_user(self, user_id: int, scores: Dict[BoardId, Dict[int, float]]):
+        """Записать время пользователя в рейтинги; там, где его больше нет, - ноль"""
+        for board_id in self._user_boards.get(user_id, set()) - scores.keys():
+            self.boards[board_id].set(user_id, 0.0)
+        for board_id, users in scores.items():
+            self.boards.setdefault(board_id, RankedScores()).set(user_id, users[user_id])
+        self._user_boards[user_id] = set(scores)
+        self.updates += 1
+
+    async def board(self, period: str, key: str = "") -> RankedScores:
+        """Рейтинг текущего периода (пустой, если в нем никого нет)"""
+        await self._ensure_current()
+        return self.boards.get((period, key)) or RankedScores()
+
+    def stats(self) -> dict:
+        return {
+            "boards": len(self.boards),
+            "week_participants": len(self.boards.get(("week", ""), ())),
+            "month_participants": len(self.boards.get(("month", ""), ())),
+            "updates": self.updates,
+            "rebuilds": self.rebuilds,
+        }
+
+
+leaderboard = Leaderboard()
@@ -0,0 +1,284 @@
+﻿"""
+Нагрузочный тест бота на локальном фейковом Bot API.
+
+Проигрывает сценарии пользователей (категория, таймер, заметки, остановка, /stats)
+с заданной частотой и печатает пропускную способность и перцентили задержек.
+
+Пример:
+    python load_test.py --journeys 200 --rate 10 --latency-ms 20 80 --rate-limit-ratio 0.01
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест HSEBookNotes Bot")
+    parser.add_argument("--journeys", type=int, default=100, help="сколько пользовательских сценариев запустить")
+    parser.add_argument("--rate", type=float, default=5.0, help="новых сценариев в секунду")
+    parser.add_argument("--notes", type=int, default=5, help="заметок за одну сессию чтения")
+    parser.add_argument("--categories", type=int, default=1, help="сколько категорий создает каждый пользователь")
+    parser.add_argument("--menu-loops", type=int, default=0,
+                        help="сколько раз пройти по меню (/category, /notes, назад) в каждом сценарии")
+    parser.add_argument("--think-ms", type=float, default=200.0, help="пауза пользователя между шагами")
+    parser.add_argument("--latency-ms", type=float, nargs=2, default=(20.0, 80.0), metavar=("MIN", "MAX"),
+                        help="задержка ответа фейкового API")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--db", default=None, help="файл БД (по умолчанию временный)")
+    parser.add_argument("--json", default=None, help="сохранить результаты в JSON")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="считать выделения памяти (tracemalloc и сборки мусора)")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args()
+
+
+ARGS = parse_args()
+
+# БД и эхо SQL настраиваются до импорта модулей бота
+_tmp_dir = None
+if ARGS.db is None:
+    _tmp_dir = tempfile.TemporaryDirectory(prefix="notes_load_")
+    ARGS.db = os.path.join(_tmp_dir.name, "notes.db")
+os.environ["NOTES_DB_PATH"] = ARGS.db
+os.environ.setdefault("DB_ECHO", "0")
+
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+from aiogram.types import Update  # noqa: E402
+
+import bot_db  # noqa: E402
+from fake_bot_api import BOT_USER, FakeBotAPI  # noqa: E402
+from init_db import init_db, note_write_queue  # noqa: E402
+from outbound import outbound  # noqa: E402
+
+
+# ===========================================
+# ГЕНЕРАЦИЯ АПДЕЙТОВ
+# ===========================================
+class UpdateFactory:
+    def __init__(self, fake: FakeBotAPI):
+        self.fake = fake
+        self.update_id = 0
+
+    def _next_update_id(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"Load{user_id}", "language_code": "ru"}
+
+    def message(self, user_id: int, text: str) -> Update:
+        return Update.model_validate({
+            "update_id": self._next_update_id(),
+            "message": {
+                "message_id": self.fake.next_message_id(user_id),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": self._user(user_id),
+                "text": text,
+            },
+        }, context={"bot": bot_db.bot})
+
+    def callback(self, user_id: int, data: str, message: Optional[dict] = None) -> Update:
+        message = message or {"message_id": self.fake.next_message_id(user_id), "text": "—"}
+        return Update.model_validate({
+            "update_id": self._next_update_id(),
+            "callback_query": {
+                "id": str(self._next_update_id()),
+                "from": self._user(user_id),
+                "chat_instance": f"ci-{user_id}",
+                "data": data,
+                "message": {
+                    "message_id": message["message_id"],
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": BOT_USER,
+                    "text": message.get("text") or "—",
+                },
+            },
+        }, context={"bot": bot_db.bot})
+
+
+# ===========================================
+# СЦЕНАРИЙ ПОЛЬЗОВАТЕЛЯ
+# ===========================================
+class LoadRunner:
+    def __init__(self, fake: FakeBotAPI):
+        self.fake = fake
+        self.updates = UpdateFactory(fake)
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.completed = 0
+        self.failed = 0
+
+    async def step(self, name: str, update: Update):
+        started = time.perf_counter()
+        try:
+            await bot_db.dp.feed_update(bot_db.bot, update)
+        except Exception as e:
+            self.errors[f"{name}: {type(e).__name__}"] += 1
+            raise
+        finally:
+            self.latencies[name].append(time.perf_counter() - started)
+        await asyncio.sleep(ARGS.think_ms / 1000)
+
+    async def journey(self, user_id: int):
+        try:
+            await self.step("start", self.updates.message(user_id, "/start"))
+            for c in range(ARGS.categories):
+                await self.step("new_category", self.updates.message(user_id, "➕ Новая категория"))
+                await self.step("category_name", self.updates.message(user_id, f"Книга {user_id}-{c}"))
+
+            for _ in range(ARGS.menu_loops):
+                await self.step("menu_category", self.updates.message(user_id, "/category"))
+                await self.step("menu_notes", self.updates.message(user_id, "/notes"))
+                await self.step("menu_back", self.updates.callback(user_id, "back_cats"))
+
+            await self.step("timer", self.updates.message(user_id, "/timer"))
+            found = self.fake.find_button(user_id, "timer_cat_")
+            if not found:
+                raise RuntimeError("нет кнопки выбора категории таймера")
+            picker_message, data = found
+            await self.step("timer_start", self.updates.callback(user_id, data, picker_message))
+
+            for i in range(ARGS.notes):
+                await self.step("note", self.updates.message(user_id, f"Заметка {i} пользователя {user_id}"))
+
+            found = self.fake.find_button(user_id, "stop_timer_reading")
+            control_message = found[0] if found else None
+            await self.step("timer_stop", self.updates.callback(user_id, "stop_timer_reading", control_message))
+            await self.step("stats", self.updates.message(user_id, "/stats"))
+            self.completed += 1
+        except Exception as e:
+            self.failed += 1
+            print(f"⚠️ Сценарий пользователя {user_id} прерван: {e}")
+
+    async def run(self) -> float:
+        started = time.perf_counter()
+        tasks = []
+        base_user_id = 10_000_000
+        for i in range(ARGS.journeys):
+            tasks.append(asyncio.create_task(self.journey(base_user_id + i)))
+            await asyncio.sleep(1.0 / ARGS.rate)
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - started
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def allocation_report(gc_before: List[int], snapshot: "tracemalloc.Snapshot") -> dict:
+    """Пик памяти, число сборок мусора и места, где больше всего выделено"""
+    _, peak = tracemalloc.get_traced_memory()
+    # Сборка поколения 0 запускается примерно каждые threshold[0] новых
+    # объектов-контейнеров, так что их число - грубая мера выделений
+    collections = [stats["collections"] - before for stats, before in zip(gc.get_stats(), gc_before)]
+    # Сторонние библиотеки (matplotlib, aiohttp) интересны меньше - оставляем код бота
+    project_dir = os.path.dirname(os.path.abspath(__file__))
+    top = snapshot.filter_traces([
+        tracemalloc.Filter(True, os.path.join(project_dir, "*")),
+    ]).statistics("lineno")[:10]
+
+    print("Память:")
+    print(f"  пик tracemalloc: {peak / 1024 / 1024:.1f} МБ")
+    print(f"  сборок мусора по поколениям: {collections} "
+          f"(≈{collections[0] * gc.get_threshold()[0]} объектов-контейнеров)")
+    for stat in top:
+        frame = stat.traceback[0]
+        print(f"  {os.path.basename(frame.filename)}:{frame.lineno}: {stat.size / 1024:.1f} КБ в {stat.count} блоках")
+    return {
+        "peak_bytes": peak,
+        "gc_collections": collections,
+        "top": [
+            {"site": f"{os.path.basename(s.traceback[0].filename)}:{s.traceback[0].lineno}",
+             "bytes": s.size, "blocks": s.count}
+            for s in top
+        ],
+    }
+
+
+# ===========================================
+# ЗАПУСК
+# ===========================================
+async def main():
+    fake = FakeBotAPI(tuple(ARGS.latency_ms), ARGS.rate_limit_ratio, seed=ARGS.seed)
+    url = await fake.start(port=0)
+    bot_db.bot.session.api = TelegramAPIServer.from_base(url)
+    print(f"🧪 Фейковый Bot API: {url}, БД: {ARGS.db}")
+
+    await init_db()
+
+    runner = LoadRunner(fake)
+    gc_before = [stats["collections"] for stats in gc.get_stats()]
+    if ARGS.tracemalloc:
+        tracemalloc.start(10)
+    try:
+        elapsed = await runner.run()
+    finally:
+        await bot_db.cleanup_timers()
+        await note_write_queue.close()
+        await outbound.stop()
+        await bot_db.bot.session.close()
+        await fake.stop()
+
+    memory = None
+    if ARGS.tracemalloc:
+        memory = allocation_report(gc_before, tracemalloc.take_snapshot())
+        tracemalloc.stop()
+
+    total_steps = sum(len(v) for v in runner.latencies.values())
+    print("=" * 60)
+    print(f"Сценариев: {runner.completed} завершено, {runner.failed} прервано за {elapsed:.1f} с")
+    print(f"Пропускная способность: {total_steps / elapsed:.1f} апдейтов/с, "
+          f"{runner.completed / elapsed:.2f} сценариев/с")
+    print(f"{'шаг':<16}{'n':>7}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'max мс':>10}")
+    report = {}
+    for name, values in runner.latencies.items():
+        row = {
+            "count": len(values),
+            "p50": percentile(values, 0.50),
+            "p95": percentile(values, 0.95),
+            "p99": percentile(values, 0.99),
+            "max": max(values),
+        }
+        report[name] = row
+        print(f"{name:<16}{row['count']:>7}{row['p50'] * 1000:>10.1f}{row['p95'] * 1000:>10.1f}"
+              f"{row['p99'] * 1000:>10.1f}{row['max'] * 1000:>10.1f}")
+    if runner.errors:
+        print("Ошибки:")
+        for key, count in runner.errors.items():
+            print(f"  {key}: {count}")
+    print("Вызовы Bot API:")
+    for line in fake.summary():
+        print(line)
+
+    if ARGS.json:
+        with open(ARGS.json, "w", encoding="utf-8") as f:
+            json.dump({
+                "timestamp": datetime.now().isoformat(),
+                "args": vars(ARGS),
+                "elapsed_seconds": elapsed,
+                "completed": runner.completed,
+                "failed": runner.failed,
+                "steps": report,
+                "api_calls": dict(fake.calls),
+                "api_rate_limited": dict(fake.rate_limited),
+                "memory": memory,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"💾 Результаты сохранены в {ARGS.json}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,279 @@
+﻿"""
+Фоновое обслуживание БД: удаление старых удаленных заметок, висящих сессий и VACUUM
+"""
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Iterable, Optional
+
+from sqlalchemy import text
+
+from init_db import AsyncSessionLocal, engine
+
+# Удаленные заметки физически стираются через столько дней после удаления
+PURGE_RETENTION_DAYS = 30
+# Незавершенная сессия старше этого считается брошенной (бот перезапустился
+# во время чтения, и таймер уже никто не остановит)
+ABANDONED_SESSION_HOURS = 48
+
+# Таблицы проходятся окнами по id: одно окно - один короткий запрос и одна
+# короткая транзакция. В SQLite писатель один на всю БД, а длинное чтение
+# мешает ему закоммитить, поэтому между окнами успевают пройти заметки
+MAINTENANCE_WINDOW = 2000
+# Доля времени, которую обслуживание держит БД: после окна, занявшего t
+# секунд, ждем t * (1 - доля) / доля (но не меньше MAINTENANCE_MIN_PAUSE)
+MAINTENANCE_DUTY_CYCLE = 0.1
+MAINTENANCE_MIN_PAUSE = 0.01
+# Страниц, возвращаемых ОС за один шаг incremental_vacuum
+VACUUM_PAGES_PER_STEP = 1000
+# Как часто запускать обслуживание
+MAINTENANCE_INTERVAL = 6 * 60 * 60
+# Заметки удаляемой категории стираются пачками по столько штук
+CATEGORY_DELETE_CHUNK = 500
+
+# id текущего окна в условии IN (параметр :ids - список через запятую)
+_IDS = "(SELECT value FROM json_each('[' || :ids || ']'))"
+
+
+async def throttle(window_seconds: float):
+    """Пауза после окна работы с БД, чтобы держать ее не больше MAINTENANCE_DUTY_CYCLE"""
+    pause = window_seconds * (1 - MAINTENANCE_DUTY_CYCLE) / MAINTENANCE_DUTY_CYCLE
+    await asyncio.sleep(max(pause, MAINTENANCE_MIN_PAUSE))
+
+
+async def delete_category_notes(category_id: int,
+                                on_progress: Optional[Callable[[int], Awaitable[None]]] = None,
+                                session_factory=AsyncSessionLocal) -> int:
+    """Стереть заметки уже удаленной категории пачками по CATEGORY_DELETE_CHUNK.
+
+    on_progress получает число удаленных заметок после каждой пачки. Если
+    удаление прервется (перезапуск бота), остаток подберет MaintenanceJob
+    """
+    total = 0
+    while True:
+        started = time.perf_counter()
+        async with session_factory() as session:
+            result = await session.execute(
+                text("DELETE FROM notes WHERE id IN "
+                     "(SELECT id FROM notes WHERE category_id = :category_id LIMIT :chunk)"),
+                {"category_id": category_id, "chunk": CATEGORY_DELETE_CHUNK}
+            )
+            await session.commit()
+        total += result.rowcount
+        if result.rowcount < CATEGORY_DELETE_CHUNK:
+            return total
+        if on_progress is not None:
+            await on_progress(total)
+        await throttle(time.perf_counter() - started)
+
+
+class MaintenanceJob:
+    """Периодическая очистка БД небольшими пачками с паузами между ними.
+
+    За один проход:
+    - стирает заметки, удаленные больше PURGE_RETENTION_DAYS дней назад,
+      и заметки удаленных категорий, которые не успел стереть
+      delete_category_notes;
+    - отвязывает сессии чтения от удаленных категорий (время чтения
+      остается в статистике как «Без категории», дневная статистика
+      по-прежнему сходится с сессиями);
+    - удаляет брошенные незавершенные сессии и обнуляет ссылки заметок
+      на несуществующие сессии;
+    - удаляет итоги периодов по удаленным категориям (общие итоги
+      пользователя остаются);
+    - возвращает освободившиеся страницы через PRAGMA incremental_vacuum.
+    """
+
+    def __init__(self, session_factory=AsyncSessionLocal,
+                 active_sessions: Optional[Callable[[], Iterable[int]]] = None,
+                 interval: float = MAINTENANCE_INTERVAL):
+        self.session_factory = session_factory
+        # Сессии запущенных сейчас таймеров не трогаем, даже если они старые
+        self.active_sessions = active_sessions or (lambda: ())
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        # Статистика для метрик
+        self.runs = 0
+        self.notes_purged = 0
+        self.orphan_notes_purged = 0
+        self.sessions_detached = 0
+        self.sessions_purged = 0
+        self.notes_unlinked = 0
+        self.rollups_purged = 0
+        self.pages_vacuumed = 0
+        self.last_run_seconds = 0.0
+
+    # ===========================================
+    # ПАКЕТНАЯ ОБРАБОТКА
+    # ===========================================
+    async def _scan(self, table: str, condition: str, apply_sql: Iterable[str], params: dict) -> int:
+        """Пройти таблицу окнами по id и применить apply_sql к строкам, где выполнено condition"""
+        async with self.session_factory() as session:
+            max_id = (await session.execute(text(f"SELECT MAX(id) FROM {table}"))).scalar() or 0
+
+        total = 0
+        after = 0
+        while after < max_id:
+            started = time.perf_counter()
+            upto = after + MAINTENANCE_WINDOW
+            async with self.session_factory() as session:
+                result = await session.execute(
+                    text(f"SELECT id FROM {table} WHERE id > :after AND id <= :upto AND ({condition})"),
+                    {**params, "after": after, "upto": upto}
+                )
+                ids = [row[0] for row in result]
+                if ids:
+                    # Список id - одной строкой, разбираем через json_each
+                    ids_param = {"ids": ",".join(map(str, ids))}
+                    for sql in apply_sql:
+                        await session.execute(text(sql), ids_param)
+                    await session.commit()
+            total += len(ids)
+            after = upto
+            await throttle(time.perf_counter() - started)
+        return total
+
+    async def purge_deleted_notes(self, now: datetime) -> int:
+        """Стереть заметки, удаленные раньше срока хранения"""
+        return await self._scan(
+            "notes",
+            "is_deleted AND COALESCE(deleted_at, created_at) < :cutoff",
+            [f"DELETE FROM notes WHERE id IN {_IDS}"],
+            {"cutoff": now - timedelta(days=PURGE_RETENTION_DAYS)},
+        )
+
+    async def purge_orphan_notes(self) -> int:
+        """Стереть заметки категорий, которых больше нет"""
+        return await self._scan(
+            "notes",
+            "NOT EXISTS (SELECT 1 FROM categories c WHERE c.id = notes.category_id)",
+            [f"DELETE FROM notes WHERE id IN {_IDS}"],
+            {},
+        )
+
+    async def detach_orphan_sessions(self) -> int:
+        """Отвязать сессии от удаленных категорий"""
+        return await self._scan(
+            "reading_sessions",
+            "category_id IS NOT NULL AND NOT EXISTS "
+            "(SELECT 1 FROM categories c WHERE c.id = reading_sessions.category_id)",
+            [f"UPDATE reading_sessions SET category_id = NULL WHERE id IN {_IDS}"],
+            {},
+        )
+
+    async def purge_abandoned_sessions(self, now: datetime) -> int:
+        """Удалить незавершенные сессии, которые уже никто не завершит"""
+        active = ",".join(str(int(session_id)) for session_id in self.active_sessions())
+        return await self._scan(
+            "reading_sessions",
+            "NOT COALESCE(is_completed, 0) AND end_time IS NULL AND start_time < :cutoff "
+            "AND id NOT IN (SELECT value FROM json_each('[' || :active || ']'))",
+            [
+                f"UPDATE notes SET reading_session_id = NULL WHERE reading_session_id IN {_IDS}",
+                f"DELETE FROM reading_sessions WHERE id IN {_IDS}",
+            ],
+            {"cutoff": now - timedelta(hours=ABANDONED_SESSION_HOURS), "active": active},
+        )
+
+    async def unlink_orphan_notes(self) -> int:
+        """Обнулить ссылки заметок на несуществующие сессии"""
+        return await self._scan(
+            "notes",
+            "reading_session_id IS NOT NULL AND NOT EXISTS "
+            "(SELECT 1 FROM reading_sessions s WHERE s.id = notes.reading_session_id)",
+            [f"UPDATE notes SET reading_session_id = NULL WHERE id IN {_IDS}"],
+            {},
+        )
+
+    async def purge_orphan_rollups(self) -> int:
+        """Удалить итоги периодов по категориям, которых больше нет"""
+        return await self._scan(
+            "reading_rollups",
+            "category_id != 0 AND NOT EXISTS "
+            "(SELECT 1 FROM categories c WHERE c.id = reading_rollups.category_id)",
+            [f"DELETE FROM reading_rollups WHERE id IN {_IDS}"],
+            {},
+        )
+
+    async def incremental_vacuum(self) -> int:
+        """Вернуть ОС свободные страницы файла БД (нужен auto_vacuum=INCREMENTAL)"""
+        total = 0
+        async with engine.connect() as conn:
+            if (await conn.execute(text("PRAGMA auto_vacuum"))).scalar() != 2:
+                return 0
+        while True:
+            started = time.perf_counter()
+            async with engine.connect() as conn:
+                free_pages = (await conn.execute(text("PRAGMA freelist_count"))).scalar() or 0
+                if not free_pages:
+                    return total
+                step = min(free_pages, VACUUM_PAGES_PER_STEP)
+                # Прагма освобождает по странице за шаг выполнения, а execute()
+                # делает только первый шаг - executescript выполняет ее до конца
+                raw = await conn.get_raw_connection()
+                await raw.driver_connection.executescript(f"PRAGMA incremental_vacuum({step})")
+            total += step
+            await throttle(time.perf_counter() - started)
+
+    # ===========================================
+    # ЗАПУСК
+    # ===========================================
+    async def run_once(self) -> dict:
+        """Один проход обслуживания"""
+        started = time.perf_counter()
+        now = datetime.utcnow()
+        report = {
+            "notes_purged": await self.purge_deleted_notes(now),
+            "orphan_notes_purged": await self.purge_orphan_notes(),
+            "sessions_detached": await self.detach_orphan_sessions(),
+            "sessions_purged": await self.purge_abandoned_sessions(now),
+            "notes_unlinked": await self.unlink_orphan_notes(),
+            "rollups_purged": await self.purge_orphan_rollups(),
+            "pages_vacuumed": await self.incremental_vacuum(),
+        }
+        self.runs += 1
+        self.notes_purged += report["notes_purged"]
+        self.orphan_notes_purged += report["orphan_notes_purged"]
+        self.sessions_detached += report["sessions_detached"]
+        self.sessions_purged += report["sessions_purged"]
+        self.notes_unlinked += report["notes_unlinked"]
+        self.rollups_purged += report["rollups_purged"]
+        self.pages_vacuumed += report["pages_vacuumed"]
+        self.last_run_seconds = time.perf_counter() - started
+        if any(report.values()):
+            print(f"🧹 Обслуживание БД за {self.last_run_seconds:.1f} с: {report}")
+        return report
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f"⚠️ Ошибка обслуживания БД: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "notes_purged": self.notes_purged,
+            "orphan_notes_purged": self.orphan_notes_purged,
+            "sessions_detached": self.sessions_detached,
+            "sessions_purged": self.sessions_purged,
+            "notes_unlinked": self.notes_unlinked,
+            "rollups_purged": self.rollups_purged,
+            "pages_vacuumed": self.pages_vacuumed,
+            "last_run_seconds": self.last_run_seconds,
+        }
@@ -0,0 +1,328 @@
+﻿"""
+Локальный архив медиа: файлы Telegram в хранилище с адресацией по sha256
+"""
+import asyncio
+import hashlib
+import os
+import uuid
+from datetime import datetime
+from typing import List, Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramNotFound, TelegramRetryAfter
+from sqlalchemy import delete, func, select, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from init_db import AsyncSessionLocal, MediaBlob, MediaFailure, MediaFile
+
+# Каталог архива; не задан - архив выключен и бот хранит только file_id
+MEDIA_ARCHIVE_DIR = os.getenv("MEDIA_ARCHIVE_DIR") or None
+# Квота на диске: сверх нее удаляются давно не использованные файлы
+MEDIA_ARCHIVE_MAX_BYTES = int(os.getenv("MEDIA_ARCHIVE_MAX_BYTES", str(2 * 1024 ** 3)))
+# Одновременных скачиваний
+MEDIA_ARCHIVE_CONCURRENCY = 3
+# Длина очереди на скачивание; что не влезло, подберет досылка при следующем запуске
+MEDIA_ARCHIVE_QUEUE = 1000
+# Строк за один запрос при досылке старых медиа
+MEDIA_BACKFILL_WINDOW = 500
+# Файлов за один запрос при вытеснении
+MEDIA_EVICT_BATCH = 50
+
+# Ошибки, после которых тот же файл скачивать бессмысленно: getFile
+# отклоняет файлы больше 20 МБ и неизвестные file_id
+PERMANENT_ERRORS = (TelegramBadRequest, TelegramNotFound)
+
+# Где искать file_id старых заметок для досылки
+_BACKFILL_SOURCES = {
+    "notes": "NOT COALESCE(is_deleted, 0)",
+    "note_attachments": "1",
+}
+
+
+class _HashingWriter:
+    """Приемник для Bot.download_file: пишет в файл и заодно считает sha256 и размер"""
+
+    def __init__(self, file):
+        self.file = file
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk: bytes):
+        self.hash.update(chunk)
+        self.size += len(chunk)
+        self.file.write(chunk)
+
+    def flush(self):
+        self.file.flush()
+
+
+class MediaArchive:
+    """Фоновое скачивание медиа заметок в локальное хранилище.
+
+    Файл лежит по пути <root>/ab/cd/<sha256>: одинаковое содержимое хранится
+    один раз, сколько бы заметок (и file_id) на него ни ссылалось. Таблица
+    media_files связывает file_id и file_unique_id с sha256, media_blobs
+    хранит размер и время последнего обращения для вытеснения по LRU,
+    media_failures - файлы, которые Telegram отдавать отказался.
+    Скачивание идет в MEDIA_ARCHIVE_CONCURRENCY воркеров из ограниченной
+    очереди и не задерживает ответы пользователю
+    """
+
+    def __init__(self, bot, root: Optional[str] = MEDIA_ARCHIVE_DIR,
+                 max_bytes: int = MEDIA_ARCHIVE_MAX_BYTES, concurrency: int = MEDIA_ARCHIVE_CONCURRENCY,
+                 session_factory=AsyncSessionLocal):
+        self.bot = bot
+        self.root = root
+        self.max_bytes = max_bytes
+        self.concurrency = concurrency
+        self.session_factory = session_factory
+        self._queue: Optional[asyncio.Queue] = None
+        # file_id в очереди или в работе - чтобы не качать один файл дважды
+        self._queued = set()
+        self._tasks: List[asyncio.Task] = []
+        self.total_bytes = 0
+        # Проверка наличия blob, его перенос, запись в media_blobs, учет
+        # total_bytes и вытеснение идут по одному: иначе две загрузки одного
+        # содержимого обе сочтут его новым, а два вытеснения удалят (и
+        # вычтут) одни и те же файлы
+        self._blob_lock = asyncio.Lock()
+        # Статистика для метрик
+        self.downloaded = 0
+        self.bytes_downloaded = 0
+        self.deduplicated = 0
+        self.already_archived = 0
+        self.failed = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.evicted = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.root is not None
+
+    def blob_path(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    # ===========================================
+    # ОЧЕРЕДЬ
+    # ===========================================
+    def submit(self, file_id: str):
+        """Поставить файл в очередь на скачивание; не ждет и не падает при переполнении"""
+        if self._queue is None or not file_id or file_id in self._queued:
+            return
+        try:
+            self._queue.put_nowait(file_id)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return
+        self._queued.add(file_id)
+
+    async def start(self, backfill: bool = True):
+        """Запустить воркеры (и досылку медиа, сохраненных до включения архива)"""
+        if not self.enabled or self._tasks:
+            return
+        os.makedirs(os.path.join(self.root, "tmp"), exist_ok=True)
+        async with self.session_factory() as session:
+            self.total_bytes = (await session.execute(
+                select(func.coalesce(func.sum(MediaBlob.size), 0))
+            )).scalar()
+        self._queue = asyncio.Queue(MEDIA_ARCHIVE_QUEUE)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        if backfill:
+            self._tasks.append(asyncio.create_task(self.backfill()))
+
+    async def join(self):
+        """Дождаться, пока очередь опустеет"""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+        self._queued.clear()
+
+    async def _worker(self):
+        while True:
+            file_id = await self._queue.get()
+            try:
+                while True:
+                    try:
+                        await self.archive(file_id)
+                    except TelegramRetryAfter as e:
+                        await asyncio.sleep(e.retry_after)
+                        continue
+                    break
+            except Exception as e:
+                self.failed += 1
+                print(f"⚠️ Не удалось сохранить медиа в архив: {e}")
+            finally:
+                self._queued.discard(file_id)
+                self._queue.task_done()
+
+    async def backfill(self):
+        """Поставить в очередь медиа старых заметок, которых еще нет в архиве"""
+        for table, condition in _BACKFILL_SOURCES.items():
+            after = 0
+            while True:
+                async with self.session_factory() as session:
+                    rows = (await session.execute(
+                        text(f"SELECT id, media_file_id FROM {table} "
+                             f"WHERE id > :after AND media_file_id IS NOT NULL AND ({condition}) "
+                             f"AND media_file_id NOT IN (SELECT file_id FROM media_files) "
+                             f"AND media_file_id NOT IN (SELECT file_id FROM media_failures) "
+                             f"ORDER BY id LIMIT :limit"),
+                        {"after": after, "limit": MEDIA_BACKFILL_WINDOW}
+                    )).all()
+                if not rows:
+                    break
+                for _, file_id in rows:
+                    if file_id not in self._queued:
+                        self._queued.add(file_id)
+                        # Очередь ограничена: досылка идет не быстрее скачивания
+                        await self._queue.put(file_id)
+                after = rows[-1][0]
+
+    # ===========================================
+    # СКАЧИВАНИЕ
+    # ===========================================
+    async def archive(self, file_id: str) -> str:
+        """Скачать файл в архив, если его там еще нет; возвращает sha256"""
+        known = await self._lookup(MediaFile.file_id == file_id)
+        if known is not None:
+            self.already_archived += 1
+            await self._touch(known)
+            return known
+
+        try:
+            file = await self.bot.get_file(file_id)
+        except PERMANENT_ERRORS as e:
+            self.rejected += 1
+            await self._record_failure(file_id, str(e))
+            raise
+        # Тот же файл под другим file_id уже скачан - второй раз не качаем
+        sha256 = await self._lookup(MediaFile.file_unique_id == file.file_unique_id)
+        if sha256 is not None:
+            self.deduplicated += 1
+            await self._record(file_id, file.file_unique_id, sha256, os.path.getsize(self.blob_path(sha256)))
+            return sha256
+
+        tmp_path = os.path.join(self.root, "tmp", f"{uuid.uuid4().hex}.part")
+        try:
+            with open(tmp_path, "wb") as tmp:
+                writer = _HashingWriter(tmp)
+                await self.bot.download_file(file.file_path, writer, seek=False)
+            sha256 = writer.hash.hexdigest()
+            path = self.blob_path(sha256)
+            async with self._blob_lock:
+                is_new = not os.path.exists(path)
+                if is_new:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    os.replace(tmp_path, path)
+                await self._record(file_id, file.file_unique_id, sha256, writer.size)
+                if is_new:
+                    self.total_bytes += writer.size
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        self.downloaded += 1
+        self.bytes_downloaded += writer.size
+        if not is_new:
+            # Другой файл Telegram с тем же содержимым
+            self.deduplicated += 1
+        if is_new and self.total_bytes > self.max_bytes:
+            async with self._blob_lock:
+                await self._evict(keep=sha256)
+        return sha256
+
+    async def _lookup(self, condition) -> Optional[str]:
+        """sha256 файла из media_files, если его содержимое еще лежит в архиве"""
+        async with self.session_factory() as session:
+            sha256 = (await session.execute(select(MediaFile.sha256).where(condition).limit(1))).scalar()
+        if sha256 is not None and os.path.exists(self.blob_path(sha256)):
+            return sha256
+        return None
+
+    async def _record(self, file_id: str, file_unique_id: str, sha256: str, size: int):
+        """Запомнить blob и привязать к нему file_id одной транзакцией"""
+        now = datetime.utcnow()
+        blob = sqlite_insert(MediaBlob).values(sha256=sha256, size=size, created_at=now, last_used_at=now)
+        media_file = sqlite_insert(MediaFile).values(
+            file_id=file_id, file_unique_id=file_unique_id, sha256=sha256, archived_at=now
+        )
+        async with self.session_factory() as session:
+            await session.execute(blob.on_conflict_do_update(
+                index_elements=[MediaBlob.sha256], set_={"last_used_at": now}
+            ))
+            await session.execute(media_file.on_conflict_do_update(
+                index_elements=[MediaFile.file_id],
+                set_={"file_unique_id": file_unique_id, "sha256": sha256, "archived_at": now}
+            ))
+            await session.commit()
+
+    async def _record_failure(self, file_id: str, error: str):
+        """Запомнить файл, который скачать нельзя, чтобы досылка не пробовала его снова"""
+        statement = sqlite_insert(MediaFailure).values(
+            file_id=file_id, error=error[:500], failed_at=datetime.utcnow()
+        )
+        async with self.session_factory() as session:
+            await session.execute(statement.on_conflict_do_update(
+                index_elements=[MediaFailure.file_id],
+                set_={"error": statement.excluded.error, "failed_at": statement.excluded.failed_at}
+            ))
+            await session.commit()
+
+    async def _touch(self, sha256: str):
+        async with self.session_factory() as session:
+            await session.execute(
+                MediaBlob.__table__.update()
+                .where(MediaBlob.sha256 == sha256)
+                .values(last_used_at=datetime.utcnow())
+            )
+            await session.commit()
+
+    async def _evict(self, keep: str):
+        """Удалять давно не использованные файлы, пока архив не уложится в квоту.
+
+        Строки media_files остаются: архив помнит, что файл уже видел, и
+        не скачивает вытесненное снова при досылке
+        """
+        while self.total_bytes > self.max_bytes:
+            async with self.session_factory() as session:
+                victims = (await session.execute(
+                    select(MediaBlob.sha256, MediaBlob.size)
+                    .where(MediaBlob.sha256 != keep)
+                    .order_by(MediaBlob.last_used_at)
+                    .limit(MEDIA_EVICT_BATCH)
+                )).all()
+                if not victims:
+                    return
+                evicted = []
+                for sha256, size in victims:
+                    if self.total_bytes <= self.max_bytes:
+                        break
+                    try:
+                        os.remove(self.blob_path(sha256))
+                    except FileNotFoundError:
+                        pass
+                    self.total_bytes -= size
+                    evicted.append(sha256)
+                await session.execute(delete(MediaBlob).where(MediaBlob.sha256.in_(evicted)))
+                await session.commit()
+            self.evicted += len(evicted)
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self._queued),
+            "bytes": self.total_bytes,
+            "downloaded": self.downloaded,
+            "bytes_downloaded": self.bytes_downloaded,
+            "deduplicated": self.deduplicated,
+            "already_archived": self.already_archived,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "dropped": self.dropped,
+            "evicted": self.evicted,
+        }
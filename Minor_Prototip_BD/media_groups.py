@@ -0,0 +1,125 @@
+﻿"""
+Сборка альбомов: части одной медиагруппы Telegram -> одна заметка
+"""
+import asyncio
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from aiogram.types import Message
+
+from init_db import MediaType
+
+# Части альбома приходят отдельными апдейтами почти одновременно; альбом
+# считается собранным, если за столько секунд не пришло новой части
+ALBUM_WAIT = 1.0
+# Больше частей Telegram в один альбом не кладет
+ALBUM_MAX_ITEMS = 10
+# Сколько последних сохраненных альбомов помнить ради опоздавших частей
+FINISHED_ALBUMS = 1000
+
+
+class _PendingAlbum:
+    """Части одного альбома, пришедшие на данный момент"""
+    __slots__ = ("messages", "arrived")
+
+    def __init__(self, message: Message):
+        self.messages = [message]
+        self.arrived = asyncio.Event()
+
+
+class MediaGroupCollector:
+    """Буфер частей альбомов по (чат, media_group_id).
+
+    Обработчик первой части ждет остальные и получает весь альбом, а
+    обработчики следующих частей получают None и ничего не делают. Пока
+    первый обработчик ждет, состояние FSM не меняется, поэтому все части
+    попадают в тот же обработчик
+    """
+
+    def __init__(self, wait: float = ALBUM_WAIT, max_items: int = ALBUM_MAX_ITEMS,
+                 max_finished: int = FINISHED_ALBUMS):
+        self.wait = wait
+        self.max_items = max_items
+        self.max_finished = max_finished
+        self._pending: Dict[Tuple[int, str], _PendingAlbum] = {}
+        # Уже сохраненные альбомы: (чат, media_group_id) -> [id заметки, частей]
+        self._finished: "OrderedDict[Tuple[int, str], List[int]]" = OrderedDict()
+        # Статистика для метрик
+        self.albums = 0
+        self.parts = 0
+
+    async def collect(self, message: Message) -> Optional[List[Message]]:
+        """Все части альбома в порядке отправки - для первой части, None - для остальных"""
+        key = (message.chat.id, message.media_group_id)
+        album = self._pending.get(key)
+        if album is not None:
+            album.messages.append(message)
+            album.arrived.set()
+            return None
+
+        album = self._pending[key] = _PendingAlbum(message)
+        try:
+            while len(album.messages) < self.max_items:
+                album.arrived.clear()
+                try:
+                    await asyncio.wait_for(album.arrived.wait(), timeout=self.wait)
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            # Опоздавшая часть начнет новый альбом, а не потеряется
+            del self._pending[key]
+
+        self.albums += 1
+        self.parts += len(album.messages)
+        return sorted(album.messages, key=lambda part: part.message_id)
+
+    def finish(self, chat_id: int, media_group_id: Optional[str], note_id: int, count: int):
+        """Запомнить, в какую заметку сохранен альбом: опоздавшие части пойдут туда же"""
+        if not media_group_id:
+            return
+        self._finished[(chat_id, media_group_id)] = [note_id, count]
+        while len(self._finished) > self.max_finished:
+            self._finished.popitem(last=False)
+
+    def finished(self, message: Message) -> Optional[List[int]]:
+        """[id заметки, частей] для части уже сохраненного альбома, иначе None"""
+        if not message.media_group_id:
+            return None
+        return self._finished.get((message.chat.id, message.media_group_id))
+
+    def stats(self) -> dict:
+        return {"pending": len(self._pending), "albums": self.albums, "parts": self.parts,
+                "finished": len(self._finished)}
+
+
+# С чем можно собрать медиа в один альбом: фото и видео смешиваются,
+# документы идут только с документами, голосовые в альбом не входят
+ALBUM_KINDS = {
+    MediaType.PHOTO: "visual",
+    MediaType.VIDEO: "visual",
+    MediaType.DOCUMENT: "document",
+}
+
+
+def pack_media_groups(items: List[tuple], max_items: int = ALBUM_MAX_ITEMS) -> List[List[tuple]]:
+    """Разложить медиа (первый элемент кортежа - MediaType) по альбомам для sendMediaGroup.
+
+    Порядок сохраняется внутри каждого вида альбома; голосовые и
+    оставшиеся в одиночку медиа возвращаются группами из одного элемента
+    """
+    groups = []
+    open_groups: Dict[str, List[tuple]] = {}
+    for item in items:
+        kind = ALBUM_KINDS.get(item[0])
+        if kind is None:
+            groups.append([item])
+            continue
+        group = open_groups.setdefault(kind, [])
+        group.append(item)
+        if len(group) == max_items:
+            groups.append(open_groups.pop(kind))
+    groups.extend(open_groups.values())
+    return groups
+
+
+media_groups = MediaGroupCollector()
@@ -0,0 +1,258 @@
+﻿"""
+Метрики бота: задержки обработчиков, время БД и Telegram API, HTTP-эндпоинт в формате Prometheus
+"""
+import contextvars
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
+from sqlalchemy import event
+
+# Все метрики обновляются из одного потока цикла событий (включая хуки
+# SQLAlchemy, которые выполняются в greenlet того же потока), поэтому
+# блокировки не нужны: счетчик - это просто прибавление к числу в словаре.
+
+# Границы корзин гистограмм (секунды), заданы заранее
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# ===========================================
+# ПРИМИТИВЫ МЕТРИК
+# ===========================================
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1.0):
+        self.values[label_values] = self.values.get(label_values, 0.0) + amount
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        for label_values, value in self.values.items():
+            yield f"{self.name}{_labels(self.labels, label_values)} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # label_values -> [счетчики по корзинам..., +Inf], сумма
+        self.counts: Dict[Tuple[str, ...], List[int]] = {}
+        self.sums: Dict[Tuple[str, ...], float] = {}
+
+    def observe(self, value: float, *label_values: str):
+        counts = self.counts.get(label_values)
+        if counts is None:
+            counts = self.counts[label_values] = [0] * (len(self.buckets) + 1)
+            self.sums[label_values] = 0.0
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[label_values] += value
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        for label_values, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield (f"{self.name}_bucket"
+                       f"{_labels(self.labels + ('le',), label_values + (le,))} {cumulative}")
+            yield f"{self.name}_sum{_labels(self.labels, label_values)} {self.sums[label_values]}"
+            yield f"{self.name}_count{_labels(self.labels, label_values)} {cumulative}"
+
+
+class GaugeCollector:
+    """Gauge, значения которого вычисляются функцией в момент чтения /metrics"""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...],
+                 collect: Callable[[], Iterable[Tuple[Tuple[str, ...], float]]]):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.collect = collect
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} gauge"
+        for label_values, value in self.collect():
+            yield f"{self.name}{_labels(self.labels, label_values)} {value}"
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+handler_latency = registry.register(Histogram(
+    "bot_handler_latency_seconds", "Время обработки апдейта обработчиком", ("handler",)))
+handler_calls = registry.register(Counter(
+    "bot_handler_calls_total", "Количество вызовов обработчика", ("handler",)))
+handler_errors = registry.register(Counter(
+    "bot_handler_errors_total", "Количество исключений в обработчике", ("handler", "error")))
+update_db_time = registry.register(Histogram(
+    "bot_update_db_seconds", "Суммарное время запросов к БД за один апдейт", ("handler",)))
+update_api_time = registry.register(Histogram(
+    "bot_update_api_seconds", "Суммарное время запросов к Telegram API за один апдейт", ("handler",)))
+db_queries = registry.register(Counter(
+    "bot_db_queries_total", "Количество SQL-запросов", ("handler",)))
+api_requests = registry.register(Histogram(
+    "bot_api_request_seconds", "Время одного запроса к Telegram API", ("method",)))
+api_errors = registry.register(Counter(
+    "bot_api_errors_total", "Ошибки запросов к Telegram API", ("method", "error")))
+
+
+# ===========================================
+# КОНТЕКСТ ТЕКУЩЕГО АПДЕЙТА
+# ===========================================
+class UpdateContext:
+    """Накопители времени для одного апдейта; живут в contextvar задачи"""
+    __slots__ = ("handler", "db_seconds", "db_queries", "api_seconds", "query_counts")
+
+    def __init__(self, handler: str):
+        self.handler = handler
+        self.db_seconds = 0.0
+        self.db_queries = 0
+        self.api_seconds = 0.0
+        # Счетчики отпечатков SQL за апдейт (заполняет профилировщик)
+        self.query_counts = None
+
+
+current_update: contextvars.ContextVar[Optional[UpdateContext]] = contextvars.ContextVar(
+    "current_update", default=None
+)
+
+# Метка для запросов вне обработчиков (таймеры, фоновые задачи)
+BACKGROUND = "background"
+
+
+def current_handler_name() -> str:
+    ctx = current_update.get()
+    return ctx.handler if ctx else BACKGROUND
+
+
+# ===========================================
+# MIDDLEWARE
+# ===========================================
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner-middleware: знает, какой обработчик выбран, и измеряет его"""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        ctx = UpdateContext(name)
+        token = current_update.set(ctx)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            handler_errors.inc(name, type(e).__name__)
+            raise
+        finally:
+            handler_latency.observe(time.perf_counter() - started, name)
+            handler_calls.inc(name)
+            update_db_time.observe(ctx.db_seconds, name)
+            update_api_time.observe(ctx.api_seconds, name)
+            current_update.reset(token)
+
+
+class ApiTimingMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: время каждого вызова Telegram API"""
+
+    async def __call__(self, make_request, bot, method):
+        api_method = getattr(method, "__api_method__", type(method).__name__)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            api_errors.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            api_requests.observe(elapsed, api_method)
+            ctx = current_update.get()
+            if ctx is not None:
+                ctx.api_seconds += elapsed
+
+
+def install_db_timing(engine):
+    """Подключить учет времени SQL-запросов к движку (AsyncEngine или Engine)"""
+    sync_engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["metrics_query_start"].pop()
+        ctx = current_update.get()
+        db_queries.inc(ctx.handler if ctx else BACKGROUND)
+        if ctx is not None:
+            ctx.db_seconds += elapsed
+            ctx.db_queries += 1
+
+
+def register_gauges(name: str, help_text: str, labels: Tuple[str, ...],
+                    collect: Callable[[], Iterable[Tuple[Tuple[str, ...], float]]]):
+    """Зарегистрировать gauge, значения которого берутся из другого модуля"""
+    return registry.register(GaugeCollector(name, help_text, labels, collect))
+
+
+# ===========================================
+# HTTP-ЭНДПОИНТ
+# ===========================================
+async def _metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+
+def create_metrics_app(*route_installers: Callable[[web.Application], None]) -> web.Application:
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_handler)
+    for install_routes in route_installers:
+        install_routes(app)
+    return app
+
+
+async def start_metrics_server(host: str = "127.0.0.1", port: int = 9101,
+                               *route_installers: Callable[[web.Application], None]) -> web.AppRunner:
+    """Запуск локального HTTP-сервера метрик; вернуть runner для остановки"""
+    runner = web.AppRunner(create_metrics_app(*route_installers), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    print(f"📈 Метрики доступны на http://{host}:{port}/metrics")
+    return runner
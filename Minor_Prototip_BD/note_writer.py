@@ -0,0 +1,155 @@
+﻿"""
+Очередь отложенной записи (write-behind): группирует вставки в одну транзакцию
+"""
+import asyncio
+import time
+from typing import Any, List, Optional, Tuple
+
+
+class WriteBehindQueue:
+    """Собирает новые ORM-объекты от многих пользователей и пишет их пачкой.
+
+    Пока одна пачка пишется, следующая копится в очереди и уходит сразу после
+    нее: один COMMIT (и один fsync) на всю пачку вместо одного на каждую
+    заметку. Если очередь простаивает, заметка пишется сразу в задаче
+    вызывающего, без перехода в сборщик, - одиночная заметка не ждет
+    лишнего. При ``flush_interval`` > 0 сборщик дополнительно ждет до этого
+    времени (или до ``max_batch`` объектов), прежде чем писать. Вызывающий код
+    по-прежнему получает объект с заполненным id - ``submit`` ждет, пока его
+    пачка будет записана.
+    """
+
+    def __init__(self, session_factory, flush_interval: float = 0.0, max_batch: int = 200):
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending: List[Tuple[Any, asyncio.Future]] = []
+        self._has_items: Optional[asyncio.Event] = None
+        self._batch_full: Optional[asyncio.Event] = None
+        self._flusher: Optional[asyncio.Task] = None
+        # Пишет одна пачка за раз: заметки, пришедшие во время записи, уйдут следующей пачкой
+        self._write_lock = asyncio.Lock()
+        self._closed = False
+        # Статистика для метрик
+        self.batches = 0
+        self.rows = 0
+        self.max_batch_seen = 0
+        self.flush_seconds = 0.0
+
+    async def submit(self, obj):
+        """Поставить объект в очередь и дождаться его записи в БД"""
+        if self._closed:
+            # После остановки пишем напрямую, чтобы ничего не потерять
+            await self._write_one(obj)
+            return obj
+        future = asyncio.get_running_loop().create_future()
+        self._ensure_started()
+        self._pending.append((obj, future))
+        if self.flush_interval <= 0 and len(self._pending) == 1 and not self._write_lock.locked():
+            # Очередь простаивает - пачку пишет сам вызывающий, без перехода в сборщик.
+            # Один проход цикла событий, чтобы в пачку попали заметки, пришедшие одновременно
+            async with self._write_lock:
+                await asyncio.sleep(0)
+                batch = self._take_batch()
+                if batch:
+                    await self._write_batch(batch)
+            return await future
+        self._has_items.set()
+        if len(self._pending) >= self.max_batch:
+            self._batch_full.set()
+        return await future
+
+    def _ensure_started(self):
+        if self._flusher is not None and not self._flusher.done():
+            return
+        if self._has_items is None:
+            self._has_items = asyncio.Event()
+            self._batch_full = asyncio.Event()
+        self._flusher = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await self._has_items.wait()
+            if self.flush_interval > 0 and not self._closed:
+                # Даем пачке набраться, но не дольше flush_interval
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            await self.flush()
+            if self._closed:
+                return
+
+    async def flush(self):
+        """Записать все накопленное одной транзакцией"""
+        while self._pending:
+            async with self._write_lock:
+                # Пачка набирается, пока пишется предыдущая
+                batch = self._take_batch()
+                if batch:
+                    await self._write_batch(batch)
+
+    def _take_batch(self) -> List[Tuple[Any, asyncio.Future]]:
+        batch = self._pending[:self.max_batch]
+        del self._pending[:self.max_batch]
+        if not self._pending:
+            self._has_items.clear()
+            self._batch_full.clear()
+        return batch
+
+    async def _write_batch(self, batch: List[Tuple[Any, asyncio.Future]]):
+        started = time.perf_counter()
+        try:
+            async with self.session_factory() as session:
+                session.add_all([obj for obj, _ in batch])
+                # SQLAlchemy 2.0 вставляет пачку одним INSERT ... RETURNING,
+                # так что id заполняются без отдельного refresh()
+                await session.commit()
+        except Exception as e:
+            print(f"⚠️ Ошибка пакетной записи ({len(batch)} шт.), пишем по одной: {e}")
+            for obj, future in batch:
+                try:
+                    await self._write_one(obj)
+                except Exception as row_error:
+                    if not future.done():
+                        future.set_exception(row_error)
+                else:
+                    if not future.done():
+                        future.set_result(obj)
+            return
+        finally:
+            self.flush_seconds += time.perf_counter() - started
+
+        self.batches += 1
+        self.rows += len(batch)
+        self.max_batch_seen = max(self.max_batch_seen, len(batch))
+        for obj, future in batch:
+            if not future.done():
+                future.set_result(obj)
+
+    async def _write_one(self, obj):
+        async with self.session_factory() as session:
+            session.add(obj)
+            await session.commit()
+
+    async def close(self):
+        """Корректная остановка: дописать очередь и перейти на прямую запись"""
+        self._closed = True
+        if self._flusher is not None and not self._flusher.done():
+            # Будим сборщик: он сбросит текущую пачку без ожидания и завершится
+            self._has_items.set()
+            self._batch_full.set()
+            await self._flusher
+        self._flusher = None
+        if self._pending:
+            print(f"💾 Дописываем {len(self._pending)} заметок из очереди...")
+            await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "batches": self.batches,
+            "rows": self.rows,
+            "avg_batch": self.rows / self.batches if self.batches else 0.0,
+            "max_batch": self.max_batch_seen,
+        }
@@ -0,0 +1,287 @@
+﻿"""
+Центральный диспетчер исходящих сообщений с приоритетами и backpressure
+"""
+import asyncio
+import contextvars
+import enum
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+from aiogram.exceptions import TelegramRetryAfter
+
+
+# ===========================================
+# КЛАССЫ ПРИОРИТЕТА
+# ===========================================
+class Priority(enum.IntEnum):
+    """Чем меньше значение, тем раньше отправляется сообщение"""
+    INTERACTIVE = 0  # ответы на действия пользователя («Заметка сохранена»)
+    TIMER = 1        # обновления сообщения таймера
+    BULK = 2         # массовые списки (заметки категории)
+    UPLOAD = 3       # загрузка графиков и файлов
+
+
+# Максимальный размер очереди для каждого класса приоритета
+DEFAULT_QUEUE_LIMITS = {
+    Priority.INTERACTIVE: 1000,
+    Priority.TIMER: 500,
+    Priority.BULK: 200,
+    Priority.UPLOAD: 20,
+}
+
+# Сколько последних задержек хранить для расчета перцентилей
+LATENCY_WINDOW = 1024
+
+
+class _OutboundJob:
+    __slots__ = ("priority", "chat_id", "method", "args", "kwargs", "future", "enqueued_at", "context")
+
+    def __init__(self, priority: Priority, chat_id: int, method: Callable[..., Awaitable[Any]], args, kwargs):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        # Запрос выполняется в контексте отправителя, чтобы метрики
+        # и профилировщик относили его к нужному обработчику
+        self.context = contextvars.copy_context()
+
+
+class _PriorityClass:
+    """Очередь одного класса приоритета: отдельная FIFO на каждый чат"""
+
+    def __init__(self, priority: Priority, limit: int):
+        self.priority = priority
+        self.limit = limit
+        self.slots = asyncio.Semaphore(limit)
+        # chat_id -> очередь задач; порядок ключей = порядок обхода round-robin
+        self.chats: "OrderedDict[int, Deque[_OutboundJob]]" = OrderedDict()
+        self.depth = 0
+        self.sent = 0
+        self.failed = 0
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+    def push(self, job: _OutboundJob):
+        queue = self.chats.get(job.chat_id)
+        if queue is None:
+            queue = self.chats[job.chat_id] = deque()
+        queue.append(job)
+        self.depth += 1
+
+    def pop(self, busy_chats=()) -> Optional[_OutboundJob]:
+        # Берем первый свободный чат, отдаем одну задачу и переносим чат в конец,
+        # чтобы длинный список одного пользователя не блокировал остальных.
+        # Чаты, у которых запрос уже в полете, пропускаем: так сохраняется порядок
+        for chat_id, queue in self.chats.items():
+            if chat_id not in busy_chats:
+                break
+        else:
+            return None
+        job = queue.popleft()
+        if queue:
+            self.chats.move_to_end(chat_id)
+        else:
+            del self.chats[chat_id]
+        self.depth -= 1
+        self.slots.release()
+        return job
+
+
+# ===========================================
+# ДИСПЕТЧЕР
+# ===========================================
+class OutboundDispatcher:
+    """Отправляет запросы к Telegram по приоритетам с общим ограничением скорости.
+
+    Внутри одного приоритета чаты обслуживаются по очереди (round-robin).
+    Очереди ограничены: если очередь заполнена, ``enqueue`` ждет свободного
+    места, и отправитель естественным образом замедляется.
+    """
+
+    def __init__(self, rate_per_second: float = 25.0, max_in_flight: int = 8,
+                 queue_limits: Optional[Dict[Priority, int]] = None, metrics_interval: float = 60.0):
+        self.min_interval = 1.0 / rate_per_second
+        self.max_in_flight = max_in_flight
+        self.queue_limits = dict(DEFAULT_QUEUE_LIMITS)
+        if queue_limits:
+            self.queue_limits.update(queue_limits)
+        self.metrics_interval = metrics_interval
+        self._classes: Optional[Dict[Priority, _PriorityClass]] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._in_flight: Optional[asyncio.Semaphore] = None
+        self._busy_chats = set()
+        self._tasks = set()
+        self._last_sent_at = 0.0
+        self._last_report_at = time.monotonic()
+
+    def start(self):
+        """Запуск фоновой задачи отправки (вызывается лениво при первой отправке)"""
+        if self._worker is not None and not self._worker.done():
+            return
+        if self._classes is None:
+            # Примитивы asyncio создаем внутри работающего цикла событий
+            self._classes = {p: _PriorityClass(p, self.queue_limits[p]) for p in Priority}
+            self._wakeup = asyncio.Event()
+            self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        self._worker = asyncio.create_task(self._run(), context=contextvars.Context())
+
+    async def stop(self, timeout: float = 10.0):
+        """Дождаться отправки оставшихся сообщений и остановить диспетчер"""
+        if self._worker is None:
+            return
+        deadline = time.monotonic() + timeout
+        while (self.queue_depth() or self._busy_chats) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        # Все, что не успели отправить, отменяем, чтобы никто не ждал вечно
+        for cls in self._classes.values():
+            while cls.depth:
+                job = cls.pop()
+                if not job.future.done():
+                    job.future.cancel()
+
+    async def enqueue(self, priority: Priority, chat_id: int,
+                      method: Callable[..., Awaitable[Any]], /, *args, **kwargs) -> asyncio.Future:
+        """Поставить вызов в очередь. Ждет только места в очереди, а не самой отправки.
+
+        Первые три аргумента только позиционные, чтобы chat_id и прочие
+        именованные аргументы самого метода Bot API передавались как есть.
+        """
+        self.start()
+        cls = self._classes[priority]
+        await cls.slots.acquire()
+        job = _OutboundJob(priority, chat_id, method, args, kwargs)
+        cls.push(job)
+        self._wakeup.set()
+        return job.future
+
+    async def send(self, priority: Priority, chat_id: int,
+                   method: Callable[..., Awaitable[Any]], /, *args, **kwargs) -> Any:
+        """Поставить вызов в очередь и дождаться результата"""
+        future = await self.enqueue(priority, chat_id, method, *args, **kwargs)
+        return await future
+
+    def _next_job(self) -> Optional[_OutboundJob]:
+        for priority in Priority:
+            cls = self._classes[priority]
+            if cls.depth:
+                job = cls.pop(self._busy_chats)
+                if job is not None:
+                    return job
+        return None
+
+    async def _run(self):
+        while True:
+            # Сначала ждем свободный слот, и только потом выбираем задачу:
+            # так срочный ответ, пришедший во время ожидания, уйдет первым
+            await self._in_flight.acquire()
+
+            # Общий лимит скорости на весь бот
+            delay = self._last_sent_at + self.min_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            job = self._next_job()
+            while job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                job = self._next_job()
+
+            self._last_sent_at = time.monotonic()
+            self._busy_chats.add(job.chat_id)
+            task = asyncio.create_task(self._execute(job), context=job.context)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            self._maybe_report()
+
+    async def _execute(self, job: _OutboundJob):
+        try:
+            if not job.future.cancelled():
+                await self._call(job)
+        finally:
+            self._busy_chats.discard(job.chat_id)
+            self._in_flight.release()
+            self._wakeup.set()
+
+    async def _call(self, job: _OutboundJob):
+        cls = self._classes[job.priority]
+        while True:
+            try:
+                result = await job.method(*job.args, **job.kwargs)
+            except TelegramRetryAfter as e:
+                # Telegram просит подождать: ждем и повторяем тот же запрос
+                print(f"⏳ Flood control, ждем {e.retry_after} с")
+                await asyncio.sleep(e.retry_after)
+                continue
+            except Exception as e:
+                cls.failed += 1
+                if "message is not modified" not in str(e):
+                    print(f"⚠️ Ошибка отправки в чат {job.chat_id}: {e}")
+                if not job.future.done():
+                    job.future.set_exception(e)
+                    # Ошибка уже залогирована; помечаем ее прочитанной, чтобы
+                    # asyncio не ругался, если результат никто не ждет
+                    job.future.exception()
+                return
+            break
+        cls.sent += 1
+        cls.latencies.append(time.monotonic() - job.enqueued_at)
+        if not job.future.done():
+            job.future.set_result(result)
+
+    # ===========================================
+    # МЕТРИКИ
+    # ===========================================
+    def queue_depth(self, priority: Optional[Priority] = None) -> int:
+        if self._classes is None:
+            return 0
+        if priority is not None:
+            return self._classes[priority].depth
+        return sum(cls.depth for cls in self._classes.values())
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Снимок метрик по каждому классу приоритета"""
+        result = {}
+        for priority in Priority:
+            cls = self._classes[priority] if self._classes else None
+            latencies = sorted(cls.latencies) if cls else []
+            result[priority.name.lower()] = {
+                "depth": cls.depth if cls else 0,
+                "limit": self.queue_limits[priority],
+                "sent": cls.sent if cls else 0,
+                "failed": cls.failed if cls else 0,
+                "latency_p50": _percentile(latencies, 0.50),
+                "latency_p95": _percentile(latencies, 0.95),
+                "latency_max": latencies[-1] if latencies else 0.0,
+            }
+        return result
+
+    def _maybe_report(self):
+        now = time.monotonic()
+        if not self.metrics_interval or now - self._last_report_at < self.metrics_interval:
+            return
+        self._last_report_at = now
+        parts = []
+        for name, s in self.stats().items():
+            parts.append(f"{name}: очередь {s['depth']}/{s['limit']}, p95 {s['latency_p95'] * 1000:.0f} мс")
+        print("📤 Исходящие: " + "; ".join(parts))
+
+
+def _percentile(sorted_values, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[index]
+
+
+# Общий экземпляр для всего бота
+outbound = OutboundDispatcher()
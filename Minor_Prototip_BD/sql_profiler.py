@@ -0,0 +1,216 @@
+﻿"""
+Профилировщик SQL-запросов с привязкой к обработчикам бота
+"""
+import re
+import time
+from collections import deque
+from functools import lru_cache
+from typing import Deque, Dict, List, Optional, Tuple
+
+from aiohttp import web
+from sqlalchemy import event
+
+from metrics import BACKGROUND, current_update
+
+# Сколько последних длительностей хранить на каждый запрос для p95
+SAMPLES_PER_QUERY = 512
+
+# Сколько одинаковых запросов за один апдейт считаем признаком N+1
+N_PLUS_ONE_THRESHOLD = 5
+
+
+# ===========================================
+# НОРМАЛИЗАЦИЯ ЗАПРОСОВ
+# ===========================================
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r"\bIN\s*\((?:\s*\?\s*,)*\s*\?\s*\)", re.IGNORECASE)
+_VALUES_RE = re.compile(r"\bVALUES\s*(\([^)]*\))(?:\s*,\s*\([^)]*\))+", re.IGNORECASE)
+_SPACE_RE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=4096)
+def fingerprint(statement: str) -> str:
+    """Отпечаток запроса: литералы заменены на ?, списки IN и VALUES свернуты"""
+    fp = _STRING_RE.sub("?", statement)
+    fp = _NUMBER_RE.sub("?", fp)
+    fp = _IN_LIST_RE.sub("IN (...)", fp)
+    fp = _VALUES_RE.sub(r"VALUES \1, ...", fp)
+    return _SPACE_RE.sub(" ", fp).strip()
+
+
+class QueryStats:
+    __slots__ = ("count", "total", "rows", "samples", "max_per_update", "updates")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.rows = 0
+        self.samples: Deque[float] = deque(maxlen=SAMPLES_PER_QUERY)
+        self.max_per_update = 0
+        self.updates = 0
+
+    def p95(self) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
+
+
+# ===========================================
+# ПРОФИЛИРОВЩИК
+# ===========================================
+class SQLProfiler:
+    """Собирает статистику по отпечаткам запросов в разрезе обработчиков.
+
+    Включается и выключается на лету: при выключении слушатели событий
+    снимаются с движка, так что в обычном режиме накладных расходов нет.
+    """
+
+    def __init__(self, engine):
+        self.sync_engine = getattr(engine, "sync_engine", engine)
+        self.enabled = False
+        self.started_at: Optional[float] = None
+        # (обработчик, отпечаток) -> статистика
+        self.stats: Dict[Tuple[str, str], QueryStats] = {}
+
+    def enable(self):
+        if self.enabled:
+            return
+        event.listen(self.sync_engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(self.sync_engine, "after_cursor_execute", self._after_cursor_execute)
+        self.enabled = True
+        self.started_at = time.time()
+        print("🔬 SQL-профилировщик включен")
+
+    def disable(self):
+        if not self.enabled:
+            return
+        event.remove(self.sync_engine, "before_cursor_execute", self._before_cursor_execute)
+        event.remove(self.sync_engine, "after_cursor_execute", self._after_cursor_execute)
+        self.enabled = False
+        print("🔬 SQL-профилировщик выключен")
+
+    def reset(self):
+        self.stats.clear()
+        self.started_at = time.time() if self.enabled else None
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("profiler_query_start", []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("profiler_query_start")
+        if not starts:
+            # Профилировщик включили между before и after этого запроса
+            return
+        elapsed = time.perf_counter() - starts.pop()
+
+        fp = fingerprint(statement)
+        ctx = current_update.get()
+        handler = ctx.handler if ctx else BACKGROUND
+        stats = self.stats.get((handler, fp))
+        if stats is None:
+            stats = self.stats[(handler, fp)] = QueryStats()
+        stats.count += 1
+        stats.total += elapsed
+        stats.samples.append(elapsed)
+        stats.rows += _rows_returned(cursor)
+
+        if ctx is not None:
+            # Сколько раз этот запрос выполнен в рамках текущего апдейта
+            if ctx.query_counts is None:
+                ctx.query_counts = {}
+            per_update = ctx.query_counts.get(fp, 0) + 1
+            ctx.query_counts[fp] = per_update
+            if per_update == 1:
+                stats.updates += 1
+            if per_update > stats.max_per_update:
+                stats.max_per_update = per_update
+
+    # ===========================================
+    # ОТЧЕТЫ
+    # ===========================================
+    def top(self, limit: int = 20) -> List[Tuple[str, str, QueryStats]]:
+        """Самые дорогие запросы по суммарному времени"""
+        items = sorted(self.stats.items(), key=lambda item: item[1].total, reverse=True)
+        return [(handler, fp, stats) for (handler, fp), stats in items[:limit]]
+
+    def n_plus_one(self, threshold: int = N_PLUS_ONE_THRESHOLD) -> List[Tuple[str, str, QueryStats]]:
+        """Запросы, которые повторяются внутри одного апдейта - кандидаты на N+1"""
+        items = [
+            (handler, fp, stats)
+            for (handler, fp), stats in self.stats.items()
+            if stats.max_per_update >= threshold
+        ]
+        items.sort(key=lambda item: item[2].total, reverse=True)
+        return items
+
+    def report(self, limit: int = 20) -> str:
+        state = "включен" if self.enabled else "выключен"
+        lines = [f"SQL-профилировщик: {state}, отпечатков: {len(self.stats)}", ""]
+
+        lines.append(f"ТОП-{limit} по суммарному времени:")
+        for handler, fp, s in self.top(limit):
+            lines.append(
+                f"  [{handler}] n={s.count} total={s.total * 1000:.1f}ms "
+                f"p95={s.p95() * 1000:.2f}ms rows={s.rows}"
+            )
+            lines.append(f"      {fp[:300]}")
+
+        suspects = self.n_plus_one()
+        lines.append("")
+        lines.append(f"Подозрения на N+1 (>= {N_PLUS_ONE_THRESHOLD} одинаковых запросов за апдейт):")
+        if not suspects:
+            lines.append("  нет")
+        for handler, fp, s in suspects:
+            avg_per_update = s.count / s.updates if s.updates else s.count
+            lines.append(
+                f"  [{handler}] до {s.max_per_update} раз за апдейт "
+                f"(в среднем {avg_per_update:.1f}), total={s.total * 1000:.1f}ms"
+            )
+            lines.append(f"      {fp[:300]}")
+        return "\n".join(lines) + "\n"
+
+
+def _rows_returned(cursor) -> int:
+    # Адаптер aiosqlite заранее выбирает все строки SELECT в cursor._rows;
+    # для INSERT/UPDATE/DELETE полезен rowcount
+    rows = getattr(cursor, "_rows", None)
+    if rows:
+        return len(rows)
+    rowcount = getattr(cursor, "rowcount", -1)
+    return rowcount if rowcount and rowcount > 0 else 0
+
+
+# ===========================================
+# УПРАВЛЕНИЕ ЧЕРЕЗ HTTP
+# ===========================================
+def install_profiler_routes(app: web.Application, profiler: SQLProfiler):
+    """Маршруты /debug/sql на локальном сервере метрик"""
+
+    async def show_report(request: web.Request) -> web.Response:
+        try:
+            limit = int(request.query.get("limit", 20))
+        except ValueError:
+            return web.Response(text="limit must be an integer\n", status=400)
+        # Отрицательный limit срезал бы список с конца
+        limit = min(max(limit, 1), 1000)
+        return web.Response(text=profiler.report(limit),
+                            content_type="text/plain", charset="utf-8")
+
+    async def enable(request: web.Request) -> web.Response:
+        profiler.enable()
+        return web.Response(text="enabled\n")
+
+    async def disable(request: web.Request) -> web.Response:
+        profiler.disable()
+        return web.Response(text="disabled\n")
+
+    async def reset(request: web.Request) -> web.Response:
+        profiler.reset()
+        return web.Response(text="reset\n")
+
+    app.router.add_get("/debug/sql", show_report)
+    app.router.add_post("/debug/sql/enable", enable)
+    app.router.add_post("/debug/sql/disable", disable)
+    app.router.add_post("/debug/sql/reset", reset)
@@ -0,0 +1,376 @@
+﻿"""
+Статистика чтения на NumPy: дневные ряды заметок и времени и расчеты над ними без циклов
+"""
+import warnings
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from sqlalchemy import func, select, union
+
+from init_db import (
+    AsyncSessionLocal, DEFAULT_UTC_OFFSET_MINUTES, DailyReadingStats, HourlyReadingStats,
+    Note, UserSettings, sqlite_day_modifier, user_now
+)
+
+# Пользователей за одно чтение в пакетном режиме: каждая пачка - своя
+# короткая транзакция, чтобы не держать БД во время расчета по всем
+BATCH_USERS = 500
+# Дни недели в тепловой карте, с понедельника
+WEEKDAY_NAMES = ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс")
+# Недель в календаре активности (/heatmap), как на GitHub
+CALENDAR_WEEKS = 53
+
+
+# ===========================================
+# РАСЧЕТЫ ПО РЯДАМ
+# ===========================================
+# Все функции считают по последней оси: одинаково работают с рядом
+# одного пользователя (дни) и матрицей пакетного режима (пользователи x дни)
+
+def to_days(values) -> np.ndarray:
+    """Даты (date, datetime или строки 'YYYY-MM-DD') -> номера дней от 1970-01-01"""
+    return np.array(values, dtype="datetime64[D]").astype(np.int64)
+
+
+def weekday(days: np.ndarray) -> np.ndarray:
+    """День недели по номеру дня: 0 - понедельник (1970-01-01 - четверг)"""
+    return (days + 3) % 7
+
+
+def rolling_mean(values: np.ndarray, window: int) -> np.ndarray:
+    """Скользящее среднее за window дней; в начале ряда - по неполному окну"""
+    values = np.asarray(values, dtype=np.float64)
+    total = np.cumsum(values, axis=-1)
+    shifted = np.zeros_like(total)
+    shifted[..., window:] = total[..., :-window]
+    counts = np.minimum(np.arange(1, values.shape[-1] + 1), window)
+    return (total - shifted) / counts
+
+
+def run_lengths(active: np.ndarray) -> np.ndarray:
+    """Длина серии активных дней, закончившейся в каждый день (0 - день без активности)"""
+    active = np.asarray(active, dtype=bool)
+    count = np.cumsum(active, axis=-1)
+    # Накопленное число на последний пропуск - от него серия считается заново
+    reset = np.maximum.accumulate(np.where(active, 0, count), axis=-1)
+    return count - reset
+
+
+def current_streak(active: np.ndarray) -> np.ndarray:
+    """Серия, идущая на последний день ряда (0, если в этот день активности нет)"""
+    runs = run_lengths(active)
+    return runs[..., -1] if runs.shape[-1] else np.zeros(runs.shape[:-1], dtype=np.int64)
+
+
+def best_streak(active: np.ndarray) -> np.ndarray:
+    """Самая длинная серия активных дней"""
+    return run_lengths(active).max(axis=-1, initial=0)
+
+
+def trend(values: np.ndarray) -> np.ndarray:
+    """Наклон прямой наименьших квадратов: прирост значения в день"""
+    values = np.asarray(values, dtype=np.float64)
+    n = values.shape[-1]
+    if n < 2:
+        return np.zeros(values.shape[:-1])
+    x = np.arange(n) - (n - 1) / 2
+    return (values * x).sum(axis=-1) / (x * x).sum()
+
+
+def active_percentiles(values: np.ndarray, q: Sequence[float] = (50, 90)) -> np.ndarray:
+    """Процентили значений по активным (ненулевым) дням; 0, если таких дней нет.
+
+    Форма результата: (..., len(q))
+    """
+    values = np.asarray(values, dtype=np.float64)
+    masked = np.where(values > 0, values, np.nan)
+    with warnings.catch_warnings():
+        # Строка без активных дней - не ошибка
+        warnings.simplefilter("ignore", RuntimeWarning)
+        result = np.nanpercentile(masked, q, axis=-1) if masked.shape[-1] else \
+            np.full((len(q),) + masked.shape[:-1], np.nan)
+    return np.moveaxis(np.nan_to_num(result), 0, -1)
+
+
+def weekday_hour_heatmap(days: np.ndarray, hours: np.ndarray, seconds: np.ndarray) -> np.ndarray:
+    """Секунды чтения по дню недели и часу: матрица 7 x 24"""
+    cells = weekday(np.asarray(days)) * 24 + np.asarray(hours)
+    return np.bincount(cells, weights=seconds, minlength=7 * 24).reshape(7, 24)
+
+
+# ===========================================
+# РЯДЫ ОДНОГО ПОЛЬЗОВАТЕЛЯ
+# ===========================================
+class ReadingSeries:
+    """Дневные ряды пользователя по местным дням: элемент i - день first_day + i,
+    последний элемент - сегодня. Загружаются один раз, все показатели
+    считаются по массивам
+    """
+
+    def __init__(self, today: date, first_day: date, notes: np.ndarray, seconds: np.ndarray,
+                 heatmap: np.ndarray):
+        self.today = today
+        self.first_day = first_day
+        self.notes = notes
+        self.seconds = seconds
+        self.heatmap = heatmap
+
+    @property
+    def days(self) -> np.ndarray:
+        return np.arange(np.datetime64(self.first_day, "D"), np.datetime64(self.today, "D") + 1)
+
+    def window(self, days: int) -> "ReadingSeries":
+        """Последние days дней (история короче - дополняется нулями в начале)"""
+        pad = max(0, days - len(self.notes))
+        return ReadingSeries(
+            self.today, self.today - timedelta(days=days - 1),
+            np.concatenate([np.zeros(pad, dtype=self.notes.dtype), self.notes[-days:]]),
+            np.concatenate([np.zeros(pad), self.seconds[-days:]]),
+            self.heatmap,
+        )
+
+    @property
+    def active(self) -> np.ndarray:
+        """Дни с заметками"""
+        return self.notes > 0
+
+    def current_streak(self) -> int:
+        return int(current_streak(self.active))
+
+    def best_streak(self) -> int:
+        return int(best_streak(self.active))
+
+    def summary(self, days: int = 30) -> dict:
+        """Показатели за последние days дней"""
+        recent = self.window(days)
+        notes_days = int(np.count_nonzero(recent.notes))
+        reading_days = int(np.count_nonzero(recent.seconds))
+        labels = recent.days
+        return {
+            "notes": int(recent.notes.sum()),
+            "seconds": float(recent.seconds.sum()),
+            "notes_days": notes_days,
+            "reading_days": reading_days,
+            "max_notes_day": labels[recent.notes.argmax()].item() if notes_days else None,
+            "max_notes": int(recent.notes.max(initial=0)),
+            "max_seconds_day": labels[recent.seconds.argmax()].item() if reading_days else None,
+            "max_seconds": float(recent.seconds.max(initial=0)),
+            "notes_rolling_7": rolling_mean(recent.notes, 7),
+            "seconds_rolling_7": rolling_mean(recent.seconds, 7),
+            "seconds_percentiles": active_percentiles(recent.seconds, (50, 90)),
+            "notes_trend": float(trend(recent.notes)),
+            "seconds_trend": float(trend(recent.seconds)),
+            "current_streak": self.current_streak(),
+            "best_streak": self.best_streak(),
+        }
+
+    def by_date(self, kind: str, days: int = 30, fmt: str = "%d.%m") -> Dict[str, float]:
+        """Ненулевые дни окна ряда kind ("notes" или "seconds"): {дата: значение} (для графиков)"""
+        recent = self.window(days)
+        series = getattr(recent, kind)
+        nonzero = np.flatnonzero(series)
+        labels = recent.days[nonzero]
+        return {label.item().strftime(fmt): series[i].item() for label, i in zip(labels, nonzero)}
+
+
+async def load_user_series(user_id: int, utc_offset_minutes: int,
+                           session_factory=AsyncSessionLocal) -> ReadingSeries:
+    """Загрузить ряды пользователя тремя сгруппированными запросами в одной транзакции.
+
+    Заметки - по местной дате создания (вся история, для серий), время - из
+    daily_reading_stats, тепловая карта - из hourly_reading_stats
+    """
+    today = user_now(utc_offset_minutes).date()
+    note_day = func.date(Note.created_at, sqlite_day_modifier(utc_offset_minutes)).label("day")
+    async with session_factory() as session:
+        notes_rows = (await session.execute(
+            select(note_day, func.count(Note.id))
+            .where(Note.user_id == user_id, Note.is_deleted == False)
+            .group_by(note_day)
+        )).all()
+        daily_rows = (await session.execute(
+            select(DailyReadingStats.date, DailyReadingStats.total_seconds)
+            .where(DailyReadingStats.user_id == user_id)
+        )).all()
+        hourly_rows = (await session.execute(
+            select(HourlyReadingStats.date, HourlyReadingStats.hour, HourlyReadingStats.total_seconds)
+            .where(HourlyReadingStats.user_id == user_id)
+        )).all()
+
+    today_number = int(to_days([today])[0])
+    note_days = to_days([row[0] for row in notes_rows])
+    reading_days = to_days([row[0].date() for row in daily_rows])
+    first = min(np.concatenate([note_days, reading_days, [today_number]]))
+    length = today_number - first + 1
+
+    notes = np.zeros(length, dtype=np.int64)
+    seconds = np.zeros(length)
+    # Дни «из будущего» (смена часового пояса на западный) отбрасываются
+    keep = note_days <= today_number
+    np.add.at(notes, note_days[keep] - first, np.array([row[1] for row in notes_rows], dtype=np.int64)[keep])
+    keep = reading_days <= today_number
+    np.add.at(seconds, reading_days[keep] - first,
+              np.array([row[1] or 0.0 for row in daily_rows], dtype=np.float64)[keep])
+
+    heatmap = weekday_hour_heatmap(
+        to_days([row[0].date() for row in hourly_rows]),
+        np.array([row[1] for row in hourly_rows], dtype=np.int64),
+        np.array([row[2] or 0.0 for row in hourly_rows], dtype=np.float64),
+    )
+    return ReadingSeries(today, today - timedelta(days=int(length) - 1), notes, seconds, heatmap)
+
+
+class ReadingHeatmaps:
+    """Время чтения за последние недели: по дням календаря (daily[i] - день
+    first_day + i, first_day - понедельник) и по дню недели x часу (7 x 24)
+    """
+
+    def __init__(self, today: date, first_day: date, daily: np.ndarray, hourly: np.ndarray):
+        self.today = today
+        self.first_day = first_day
+        self.daily = daily
+        self.hourly = hourly
+
+    @property
+    def total_seconds(self) -> float:
+        return float(self.daily.sum())
+
+    def peak(self) -> Optional[tuple]:
+        """(день недели, час) с наибольшим временем чтения; None, если чтения не было"""
+        if not self.hourly.any():
+            return None
+        weekday_index, hour = np.unravel_index(self.hourly.argmax(), self.hourly.shape)
+        return int(weekday_index), int(hour)
+
+
+async def load_reading_heatmaps(user_id: int, utc_offset_minutes: int, weeks: int = CALENDAR_WEEKS,
+                                session_factory=AsyncSessionLocal) -> ReadingHeatmaps:
+    """Обе тепловые карты из одного запроса к hourly_reading_stats.
+
+    Условие (user_id, date >= ...) идет по уникальному индексу
+    (user_id, date, hour); дни и часы в таблице уже местные
+    """
+    today = user_now(utc_offset_minutes).date()
+    first_day = today - timedelta(days=today.weekday(), weeks=weeks - 1)
+    async with session_factory() as session:
+        rows = (await session.execute(
+            select(HourlyReadingStats.date, HourlyReadingStats.hour, HourlyReadingStats.total_seconds)
+            .where(
+                HourlyReadingStats.user_id == user_id,
+                HourlyReadingStats.date >= datetime.combine(first_day, datetime.min.time())
+            )
+        )).all()
+
+    length = (today - first_day).days + 1
+    days = to_days([row[0].date() for row in rows])
+    hours = np.array([row[1] for row in rows], dtype=np.int64)
+    seconds = np.array([row[2] or 0.0 for row in rows], dtype=np.float64)
+    # Дни «из будущего» (смена часового пояса на западный) отбрасываются
+    keep = days <= to_days([today])[0]
+    days, hours, seconds = days[keep], hours[keep], seconds[keep]
+    daily = np.bincount(days - to_days([first_day])[0], weights=seconds, minlength=length)
+    return ReadingHeatmaps(today, first_day, daily, weekday_hour_heatmap(days, hours, seconds))
+
+
+# ===========================================
+# ПАКЕТНЫЙ РЕЖИМ (ВСЕ ПОЛЬЗОВАТЕЛИ)
+# ===========================================
+class BatchSeries:
+    """Ряды всех пользователей за последние days местных дней: матрицы
+    пользователи x дни. Для рейтингов и рассылок - показатели считаются
+    сразу для всех, без цикла по пользователям; серии - в пределах окна
+    """
+
+    def __init__(self, user_ids: np.ndarray, notes: np.ndarray, seconds: np.ndarray):
+        self.user_ids = user_ids
+        self.notes = notes
+        self.seconds = seconds
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def metrics(self) -> Dict[str, np.ndarray]:
+        """Показатели всех пользователей: массивы в порядке user_ids"""
+        active = self.notes > 0
+        return {
+            "notes": self.notes.sum(axis=1),
+            "seconds": self.seconds.sum(axis=1),
+            "active_days": np.count_nonzero(active | (self.seconds > 0), axis=1),
+            "current_streak": current_streak(active),
+            "best_streak": best_streak(active),
+            "notes_trend": trend(self.notes),
+            "seconds_trend": trend(self.seconds),
+            "seconds_median": active_percentiles(self.seconds, (50,))[:, 0],
+        }
+
+    def top(self, metric: str, limit: int = 10) -> List[tuple]:
+        """(user_id, значение) с наибольшим значением показателя, по убыванию"""
+        values = self.metrics()[metric]
+        order = np.argsort(-values, kind="stable")[:limit]
+        order = order[values[order] > 0]
+        return [(int(self.user_ids[i]), values[i].item()) for i in order]
+
+
+async def _active_user_ids(since: datetime, session_factory) -> List[int]:
+    """Пользователи с заметками или чтением начиная с since (UTC, с запасом на часовые пояса)"""
+    async with session_factory() as session:
+        result = await session.execute(union(
+            select(Note.user_id).where(Note.created_at >= since, Note.is_deleted == False),
+            select(DailyReadingStats.user_id).where(DailyReadingStats.date >= since),
+        ))
+        return sorted(row[0] for row in result.all())
+
+
+async def load_batch(days: int = 30, user_ids: Optional[Sequence[int]] = None,
+                     session_factory=AsyncSessionLocal) -> BatchSeries:
+    """Загрузить ряды всех активных за days дней пользователей пачками по BATCH_USERS.
+
+    У каждого пользователя окно заканчивается его местным сегодня
+    """
+    now = datetime.utcnow()
+    # Запас в сутки с обеих сторон покрывает любой часовой пояс
+    since = now - timedelta(days=days + 1)
+    if user_ids is None:
+        user_ids = await _active_user_ids(since, session_factory)
+    user_ids = np.array(sorted(user_ids), dtype=np.int64)
+    notes = np.zeros((len(user_ids), days), dtype=np.int64)
+    seconds = np.zeros((len(user_ids), days))
+
+    offset = func.coalesce(UserSettings.utc_offset_minutes, DEFAULT_UTC_OFFSET_MINUTES)
+    note_day = func.date(Note.created_at, offset.concat(" minutes")).label("day")
+    now_minutes = int(np.datetime64(now, "m").astype(np.int64))
+
+    for start in range(0, len(user_ids), BATCH_USERS):
+        chunk = [int(user_id) for user_id in user_ids[start:start + BATCH_USERS]]
+        async with session_factory() as session:
+            notes_rows = (await session.execute(
+                select(Note.user_id, offset, note_day, func.count(Note.id))
+                .outerjoin(UserSettings, UserSettings.user_id == Note.user_id)
+                .where(Note.user_id.in_(chunk), Note.created_at >= since, Note.is_deleted == False)
+                .group_by(Note.user_id, note_day)
+            )).all()
+            daily_rows = (await session.execute(
+                select(DailyReadingStats.user_id, offset, DailyReadingStats.date, DailyReadingStats.total_seconds)
+                .outerjoin(UserSettings, UserSettings.user_id == DailyReadingStats.user_id)
+                .where(DailyReadingStats.user_id.in_(chunk), DailyReadingStats.date >= since)
+            )).all()
+        _accumulate(notes, user_ids, notes_rows, now_minutes, days, lambda day: day)
+        _accumulate(seconds, user_ids, daily_rows, now_minutes, days, lambda day: day.date())
+
+    return BatchSeries(user_ids, notes, seconds)
+
+
+def _accumulate(matrix: np.ndarray, user_ids: np.ndarray, rows: list, now_minutes: int, days: int, to_date):
+    """Разложить строки (user_id, смещение, местный день, значение) по матрице пользователи x дни"""
+    if not rows:
+        return
+    users = np.searchsorted(user_ids, np.array([row[0] for row in rows], dtype=np.int64))
+    offsets = np.array([row[1] for row in rows], dtype=np.int64)
+    day_numbers = to_days([to_date(row[2]) for row in rows])
+    values = np.array([row[3] or 0 for row in rows], dtype=matrix.dtype)
+    # Местное сегодня каждого пользователя - последний столбец матрицы
+    today = (now_minutes + offsets) // (24 * 60)
+    columns = days - 1 - (today - day_numbers)
+    keep = (columns >= 0) & (columns < days)
+    np.add.at(matrix, (users[keep], columns[keep]), values[keep])